@@ -1,28 +1,61 @@
-import csv
-import json
-import multiprocessing
 import os
+import queue
 import random
+import threading
 import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from multiprocessing.pool import ApplyResult
 from time import sleep, time
 
+import langchain
+import openai
 from dotenv import find_dotenv, load_dotenv
 from openai.error import (AuthenticationError, InvalidRequestError,
                           RateLimitError)
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, UpdateOne
 from pymongo.database import Database
 
-from helpers import remove_non_numbers_regex
+from archive import LLMArchive, ReplayMiss
+from chunker import encode
+from compress import CompressedArticle, compress_article
+from dedup import NearDuplicateIndex
+from engine import LLMEngine
+from grouping import TopicGrouper, noun_chunker
+from helpers import article_fingerprint
+from keyhealth import KeyRegistry
+from llmcache import LLMCache
 from logger import Logger
-from stages import (categorize, deep_research, extra_research, impactul_news,
-                    prediction, summarize_article)
+from metrics import metrics
+from persist import CollectionSink
+from ratelimit import RateLimiter
+from registry import registry
+from resolver import TitleResolver
+from retry import DeadLetters, Retrier, classify, handler_error
+from stages import (SHORT_ARTICLE_TOKENS, adeep_research, aextra_research,
+                    asummarize_article, asummarize_articles, categorize,
+                    impactul_news, prediction, set_llm_archive,
+                    set_rate_limiter)
+from store import RecordStore, SchemaError
+from structured import OutputError, parse_fields, parse_output
+from table import Stage1Tables
 
 # find and load .env file
 load_dotenv(find_dotenv())
 
-csv.field_size_limit(50000000)
+# fields of an article document stage 1 reads
+STAGE_1_PROJECTION = {'_id': 0, 'article': 1, 'siteName': 1, 'link': 1}
+# lines of the stage 1 answer format
+STAGE_1_FIELDS = [
+    'Title',
+    'Summary',
+    'Importance 1 day',
+    'Reasoning for 1 day score',
+    'Importance 1 week',
+    'Reasoning for 1 week score',
+    'Importance 1 month',
+    'Reasoning for 1 month score',
+]
 
 class Analyzer:
     """Article analyzer using Langchain and GPT"""
@@ -31,11 +64,23 @@ class Analyzer:
     collections: dict
     categories: list[str]
     apikeys: list[str]
+    keys_dir: str
+    key_health: KeyRegistry
     logger: Logger
+    limiter: RateLimiter
+    engine: LLMEngine
+    cache: LLMCache
+    archive: LLMArchive
+    dead_letters: DeadLetters
+    stage1_tables: Stage1Tables
 
-    def __init__(self) -> None:
+    def __init__(self, mongo_client: MongoClient = None, keys_dir: str = 'keys') -> None:
         self.logger = Logger()
-        self.session = MongoClient(os.environ["MONGODB_URL"])
+        self.keys_dir = keys_dir
+        # pooled client shared by every stage, stage 1 reads the category collections concurrently
+        if mongo_client is None:
+            mongo_client = MongoClient(os.environ["MONGODB_URL"], maxPoolSize=int(os.environ.get("MONGODB_POOL_SIZE", 100)))
+        self.session = mongo_client
         self.db = self.session["news-test"]
         self.article_db = self.session["test"]
         self.collections = {
@@ -63,562 +108,677 @@ class Analyzer:
             "Lifestyle and Health",
             "Gaming",
         ]
-        with open('keys/keys.txt', 'r', encoding='utf-8') as keys_file:
+        with open(os.path.join(keys_dir, 'keys.txt'), 'r', encoding='utf-8') as keys_file:
             # Maximum 50 processes
-            self.apikeys = [line.strip() for line in keys_file.readlines()[:50]]
+            keys = [line.strip() for line in keys_file.readlines()[:50]]
+        # key states are shared with every other process using the same file, keys.txt is never rewritten
+        self.key_health = KeyRegistry(
+            os.environ.get("KEY_REGISTRY_PATH", os.path.join(keys_dir, 'key_health.sqlite')),
+            keys,
+            probation=float(os.environ.get("KEY_PROBATION_SECONDS", 600)),
+            max_probation=float(os.environ.get("KEY_MAX_PROBATION_SECONDS", 86400)),
+        )
+        self.apikeys = self.key_health.usable()
+        # default per key limits until the first response reports the real ones
+        self.limiter = RateLimiter(
+            self.apikeys,
+            rpm=int(os.environ.get("RATE_LIMIT_RPM", 3500)),
+            tpm=int(os.environ.get("RATE_LIMIT_TPM", 90000)),
+            key_health=self.key_health,
+        )
+        # LLM_ARCHIVE_MODE=record stores every LLM exchange, replay answers a rerun from them without the API
+        mode = os.environ.get("LLM_ARCHIVE_MODE", "")
+        self.archive = LLMArchive(
+            os.environ.get("LLM_ARCHIVE_PATH", "archive/llm_archive.sqlite"),
+            mode,
+            latency_scale=float(os.environ.get("LLM_REPLAY_LATENCY_SCALE", 1)),
+        ) if mode else None
+        set_llm_archive(self.archive)
+        replaying = self.archive is not None and self.archive.replaying
+        if not replaying and os.environ.get("KEY_PREFLIGHT", "1") == "1":
+            # dead and rate limited keys are found before the first real request
+            states = Counter(self.key_health.preflight().values())
+            self.logger.log(f"API keys - preflight: {dict(states)}")
+            self.key_health.sync(self.apikeys)
+        if not replaying:
+            # a replay sends nothing, there is no budget to wait for
+            set_rate_limiter(self.limiter)
+            openai.requestssession = self.limiter.session()
+        # identical LLM calls are answered from disk on reruns
+        self.cache = LLMCache(
+            os.environ.get("LLM_CACHE_PATH", "cache/llm_cache.sqlite"),
+            max_bytes=int(os.environ.get("LLM_CACHE_MAX_MB", 2048)) * 1024 * 1024,
+            # a recording must see every exchange
+            bypass=os.environ.get("LLM_CACHE_BYPASS", "") == "1" or mode == 'record',
+        )
+        # cache hits would skip the replayed latencies
+        langchain.llm_cache = None if replaying else self.cache
+        # items that used up their retries are kept here instead of being retried forever
+        self.dead_letters = DeadLetters(os.environ.get("DEAD_LETTER_PATH", "deadletter/dead_letters.sqlite"))
+        # stage 1 output is parsed once and shared by stages 2 and 5 of every timeframe
+        self.stage1_tables = Stage1Tables()
+        # number of concurrent requests sent with each API key
+        self.engine = LLMEngine(
+            self.apikeys,
+            per_key=int(os.environ.get("REQUESTS_PER_KEY", 2)),
+            max_pending=int(os.environ.get("MAX_PENDING_ITEMS", 1000)),
+            limiter=None if replaying else self.limiter,
+            key_health=self.key_health,
+        )
     
-    def log_invalid_key(self, apikey):
-        # remove invallid apikey from valid list
+    def log_invalid_key(self, apikey: str, reason: str = 'invalid key'):
+        """Put the key on probation and stop using it, here and in every other process"""
+        if self.key_health.quarantine(apikey, reason):
+            self.logger.log(f"API keys - {apikey[:8]}... quarantined: {reason}")
         if apikey in self.apikeys:
             self.apikeys.remove(apikey)
-            with open('keys/keys.txt', 'w', encoding='utf-8') as keys_file:
-                for key in self.apikeys:
-                    keys_file.write(key + '\n')
 
-            # add apikey to invalid key file
-            with open('keys/invalid_keys.txt', 'a', encoding='utf-8') as invalid_file:
-                invalid_file.write(apikey + '\n')
+    def retrier(self, stage: str, key=None) -> Retrier:
+        """Retry decisions for one run of `stage`, `key` names the items in the dead letters"""
+        return Retrier(
+            stage,
+            self.dead_letters,
+            key,
+            budget_ratio=float(os.environ.get("RETRY_BUDGET_RATIO", 0.2)),
+            budget_min=int(os.environ.get("RETRY_BUDGET_MIN", 10)),
+        )
 
-    def stage_1(self, csv_filename: str, curDate: str):
-        os.remove(csv_filename) if os.path.exists(csv_filename) else None
+    def call_llm(self, stage: str, key: str, item, call):
+        """Result of `call(apikey)` with a random valid key, retried as the retry policies allow, None when given up"""
+        retrier = self.retrier(stage, lambda _: key)
+        used = []
 
+        def attempt():
+            keys = self.key_health.sync(self.apikeys)
+            # throttled keys are only picked when every key is
+            ready = set(self.key_health.usable())
+            used.append(random.choice([key for key in keys if key in ready] or keys))
+            # the key's slots are shared with the stages the engine runs at the same time
+            return self.engine.call(used[-1], call)
+
+        def on_error(er):
+            self.logger.log(f"{stage}: {classify(er)} error: {er}")
+            if used and retrier.policy(er).retire_key:
+                self.logger.log(f"{stage}: Invalid apikey: {used[-1]}")
+                self.log_invalid_key(used[-1], classify(er))
+
+        return retrier.call(item, attempt, on_error)
+
+    def sink(self, collection: str, curDate: str, to_operation, store: RecordStore, resume: bool = False) -> CollectionSink:
+        """Staging collection the records of a stage are streamed into while it runs"""
+        sink = CollectionSink(
+            self.db, collection, curDate, to_operation,
+            batch_size=int(os.environ.get("MONGO_BATCH_SIZE", 500)),
+            resume=resume,
+        )
+        if resume:
+            # records written before the interruption may not have reached the staging collection
+            for record in store:
+                sink.write(record)
+        return sink
+
+    def publish(self, sink: CollectionSink, stage: str, collection: str):
         start_t = time()
-        # to test
-        collection_name = [self.collections[i] for i in range(1, 11)]
-        articles = []
-        article_count = 0
+        count = sink.publish()
+        self.logger.log(f"{stage} - {count} documents published into {collection} collection in {time() - start_t} seconds")
+
+    def save_db(self, store: RecordStore, collection: str, curDate: str, to_operation, stage: str):
+        """Write a finished stage output into its collection, replacing the previous one"""
+        sink = self.sink(collection, curDate, to_operation, store)
+        for record in store:
+            sink.write(record)
+        self.publish(sink, stage, collection)
+
+    def stage_1_index(self, filename: str) -> dict[str, dict]:
+        """Records of a previous stage 1 output keyed by the fingerprint of their source article"""
+        summarized = {}
+        for record in RecordStore(filename, 'stage_1'):
+            # records written before token counts were recorded
+            record.setdefault('token_count', None)
+            record.setdefault('compressed_token_count', None)
+            record.setdefault('duplicate_of', None)
+            summarized[article_fingerprint(record['link'], record['article'])] = record
+        return summarized
+
+    def stage_1_documents(
+            self,
+            curDate: str,
+            summarized: dict[str, dict],
+            kept_records: list,
+            lock: threading.Lock,
+            done: set = frozenset(),
+            skip_links: set = frozenset(),
+            duplicates: NearDuplicateIndex = None,
+            on_duplicate=None,
+        ):
+        """Stream new or changed articles of every category collection as stage 1 work items.
+
+        The category collections are read concurrently, each with its own
+        cursor from the client's connection pool, and only the fields stage 1
+        needs are fetched. Articles shorter than STAGE_1_MIN_ARTICLE_LENGTH and
+        links in `skip_links` are filtered out by the server. Documents that
+        already have a summary in `summarized` are moved to `kept_records`
+        instead, and documents whose fingerprint is in `done` are skipped.
+
+        The articles are streamed in the same order on every run with the
+        same input: one from each collection being read in turn, in collection
+        order, not in the order the readers happen to deliver them.
+
+        With a `duplicates` index, an article that is a near-duplicate of one
+        already streamed is passed to `on_duplicate(item, representative)`
+        instead, where `representative` is the (link, category) of the first
+        article of its cluster in the same category. The MinHash signatures
+        are computed by the reader threads.
+        """
+        batch_size = int(os.environ.get("STAGE_1_BATCH_SIZE", 200))
+        min_length = int(os.environ.get("STAGE_1_MIN_ARTICLE_LENGTH", 0))
+        query = {}
+        if min_length > 0:
+            query['$expr'] = {'$gte': [{'$strLenCP': {'$ifNull': ['$article', '']}}, min_length]}
+        if skip_links:
+            query['link'] = {'$nin': list(skip_links)}
+        # one queue per collection, bounded so that fast readers wait for the LLM workers instead of filling the memory
+        items = {idx: queue.Queue(maxsize=batch_size) for idx in range(1, 11)}
+        closed = threading.Event()
+        finished = object()
+
+        def put(idx: int, item) -> bool:
+            while not closed.is_set():
+                try:
+                    items[idx].put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
 
-        for idx, category in enumerate(collection_name):
+        def read(idx: int):
+            category = self.collections[idx]
+            rcategory = self.categories[idx - 1]
             collection = self.article_db[category][curDate]
-            rcategory = self.categories[idx]
-            documents = collection.find()
-            cate_article_count = 0
-            for document in documents:
-                article_count += 1
-                cate_article_count += 1
-                # print(f"{article_count} : {rcategory}: {document['siteName']}, {document['link']}")
-                articles.append([document['article'], document['siteName'], document['link'], rcategory])
-            self.logger.log(f'Stage 1 - {category} {curDate} {cate_article_count} articles')
-        end_t = time()
-        
-        self.logger.log(f'Stage 1 - {len(articles)} articles uploaded in {end_t - start_t} seconds, start processing...')
-        
+            count = 0
+            size = 0
+            start_t = time()
+            try:
+                for document in collection.find(query, STAGE_1_PROJECTION, batch_size=batch_size):
+                    count += 1
+                    size += len(document['article'])
+                    fingerprint = article_fingerprint(document['link'], document['article'])
+                    if fingerprint in done:
+                        continue
+                    with lock:
+                        record = summarized.pop(fingerprint, None)
+                        if record is not None:
+                            kept_records.append(record)
+                    if record is not None:
+                        continue
+                    item = (document['article'], document['siteName'], document['link'], rcategory)
+                    signature = duplicates.signature(document['article']) if duplicates is not None else None
+                    if not put(idx, (item, signature)):
+                        return count
+                elapsed = max(time() - start_t, 1e-6)
+                self.logger.log(
+                    f'Stage 1 - {category} {curDate} {count} articles in {elapsed:.1f} seconds '
+                    f'({count / elapsed:.0f} articles/s, {size / elapsed / 1024 / 1024:.2f} MB/s)'
+                )
+                return count
+            finally:
+                put(idx, finished)
+
+        readers = max(int(os.environ.get("STAGE_1_READ_THREADS", 10)), 1)
         start_t = time()
-        article_count = 0
-
-        with open(csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                'baseData',
-                'Title',
-                'Category',
-                'Summary',
-                'Importance 1 day',
-                'Reasoning for 1 day score',
-                'Importance 1 week',
-                'Reasoning for 1 week score',
-                'Importance 1 month',
-                'Reasoning for 1 month score',
-                'site_name',
-                'link'
-            ])
-            csvfile.close()
+        with ThreadPoolExecutor(max_workers=readers) as executor:
+            futures = [executor.submit(read, idx) for idx in range(1, 11)]
+            # the collections being read, the executor starts the next one when a reader is done
+            waiting = list(range(1, 11))
+            active = waiting[:readers]
+            del waiting[:readers]
+            try:
+                while active:
+                    for idx in list(active):
+                        entry = items[idx].get()
+                        if entry is finished:
+                            active.remove(idx)
+                            if waiting:
+                                active.append(waiting.pop(0))
+                            continue
+                        item, signature = entry
+                        if signature is not None:
+                            representative = duplicates.find_or_add((item[2], item[3]), signature, scope=item[3])
+                            if representative is not None:
+                                on_duplicate(item, representative)
+                                continue
+                        yield item
+            finally:
+                closed.set()
+            # surface errors raised while reading
+            article_count = sum(future.result() for future in futures)
+        self.logger.log(f'Stage 1 - {article_count} articles read in {time() - start_t} seconds')
+
+    def stage_1_packs(self, documents):
+        """Group the stage 1 work items of `documents` into packs summarized by one request each.
+
+        Articles are cleaned here, in the thread that feeds the engine. Those
+        that stay under SHORT_ARTICLE_TOKENS are packed together, up to
+        STAGE_1_PACK_TOKENS tokens and STAGE_1_PACK_SIZE articles per pack, so
+        the prompt and the round trip are paid once for the pack; longer
+        articles are a pack of their own. Short articles are packed
+        STAGE_1_PACK_WINDOW at a time, sorted by category and link, so the
+        same articles make the same prompts on every run, which the LLM
+        cache and the replay archive depend on.
+        """
+        compress = os.environ.get("STAGE_1_COMPRESS", "1") == "1"
+        token_budget = int(os.environ.get("STAGE_1_TOKEN_BUDGET", 11088))
+        pack_tokens = int(os.environ.get("STAGE_1_PACK_TOKENS", 6000))
+        pack_size = max(int(os.environ.get("STAGE_1_PACK_SIZE", 8)), 1)
+        window_size = max(int(os.environ.get("STAGE_1_PACK_WINDOW", 64)), 1)
+
+        def packs(window: list):
+            pack = []
+            tokens = 0
+            for item in sorted(window, key=lambda item: (item[3], item[2])):
+                if pack and (tokens + len(item[4].tokens) > pack_tokens or len(pack) >= pack_size):
+                    yield tuple(pack)
+                    pack = []
+                    tokens = 0
+                pack.append(item)
+                tokens += len(item[4].tokens)
+            if pack:
+                yield tuple(pack)
+
+        window = []
+        for article, site_name, link, rCategory in documents:
+            if compress:
+                compressed = compress_article(article, token_budget)
+            else:
+                article_tokens = encode(article)
+                compressed = CompressedArticle(article, article_tokens, len(article_tokens))
+            item = (article, site_name, link, rCategory, compressed)
+            if len(compressed.tokens) >= SHORT_ARTICLE_TOKENS:
+                yield (item,)
+                continue
+            window.append(item)
+            if len(window) >= window_size:
+                yield from packs(window)
+                window = []
+        yield from packs(window)
+
+    def stage_1(self, filename: str, curDate: str, incremental: bool = True, resume: bool = False, collection: str = None):
+        store = RecordStore(filename, 'stage_1')
+        done = set()
+        skip_links = set()
+        summarized = {}
+        if resume:
+            # continue an interrupted run: the summaries it wrote stay in place
+            written = self.stage_1_index(filename) if store.exists() else {}
+            done = set(written)
+            # articles of this run do not change, so their links are not even read again
+            skip_links = {record['link'] for record in written.values()}
+            self.logger.log(f'Stage 1 - resuming, {len(done)} articles were already summarized')
+        elif incremental:
+            # articles summarized by an earlier run with the same link and content are kept as they are
+            summarized = self.stage_1_index(filename)
+        self.logger.log(f'Stage 1 - {len(summarized)} articles were summarized by an earlier run, start processing...')
+
+        start_t = time()
+        first_t = None
         sumarized_count = 0
-        total = len(articles)
-        while len(articles) != 0:
-            pool = multiprocessing.Pool(processes=min(len(self.apikeys), 50))
-            results: list[ApplyResult] = []
-
-            for i, (article, site_name, link, rCategory) in enumerate(articles):
-                api_key = self.apikeys[i % len(self.apikeys)]  # Use a different API key for each process
-                if len(self.apikeys) > len(articles):
-                    api_key = random.choice(self.apikeys)
-                results.append(pool.apply_async(stage_1_thread_handler, (api_key, article, site_name, link, rCategory)))
-            articles = []
-            with open(csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                for result in results:
-                    article_data = result.get()
-                    if article_data[1] == 'APIKey_Error':
-                        api_key = article_data[0]
-                        self.log_invalid_key(api_key)
-                    elif article_data[1] == 'Error':
-                        print(f"Statge 1 - Error was occurred while get summary\n: {article_data[0]}")
+        dropped = 0
+        saved_tokens = 0
+        kept_records = []
+        lock = threading.Lock()
+        # the same wire story on several sites is summarized once and its summary is given to every copy
+        duplicates = None
+        if os.environ.get("STAGE_1_DEDUP", "1") == "1":
+            duplicates = NearDuplicateIndex(threshold=float(os.environ.get("STAGE_1_DUPLICATE_THRESHOLD", 0.8)))
+        # (link, category) of each representative -> [its record once summarized, duplicates waiting for it]
+        clusters = {}
+        duplicate_count = 0
+        retrier = self.retrier('Stage 1', lambda pack: tuple(item[2] for item in pack))
+
+        # summaries are streamed into the collection as they are written
+        sink = self.sink(collection, curDate, stage_1_operation, store, resume) if collection else None
+        # records of articles that are gone or changed since the last run are dropped here
+        with store.writer(truncate=not resume, on_write=sink.write if sink else None) as writer:
+
+            def write_duplicate(record: dict, item: tuple):
+                nonlocal duplicate_count
+                article, site_name, link, rcategory = item
+                writer.write({
+                    **record,
+                    'article': article,
+                    'site_name': site_name,
+                    'link': link,
+                    'category': rcategory,
+                    'token_count': None,
+                    'compressed_token_count': None,
+                    'duplicate_of': record['link'],
+                })
+                duplicate_count += 1
+
+            def on_duplicate(item: tuple, representative: tuple):
+                with lock:
+                    cluster = clusters.setdefault(representative, [None, []])
+                    if cluster[0] is None:
+                        cluster[1].append(item)
                     else:
-                        writer.writerow(article_data[0:-1])
-                        self.logger.log(f"Statge 1 - {sumarized_count}/{total} : {article_data[-1]}")
-                        sumarized_count += 1
-                        continue
-                    articles.append([article_data[2], article_data[3], article_data[4]])
-            pool.close()
-            pool.join()
+                        write_duplicate(cluster[0], item)
+                        writer.flush()
+
+            def on_result(article_data):
+                nonlocal sumarized_count, first_t, dropped, saved_tokens
+                if article_data[1] == 'APIKey_Error':
+                    api_key = article_data[0]
+                    self.log_invalid_key(api_key)
+                elif article_data[1] == 'Error':
+                    print(f"Statge 1 - Error was occurred while get summary\n: {article_data[0]}")
+                elif article_data[1] == 'UnexpectedError':
+                    print(f"Statge 1 - UnexpectedError was occurred while get summary\n: {article_data[0]}")
+                else:
+                    records = article_data[0]
+                    with lock:
+                        writer.writerows(kept_records)
+                        kept_records.clear()
+                        for record in records:
+                            writer.write(record)
+                            cluster = clusters.setdefault((record['link'], record['category']), [None, []])
+                            # the article text of the representative is not needed by its duplicates
+                            cluster[0] = {key: value for key, value in record.items() if key != 'article'}
+                            for item in cluster[1]:
+                                write_duplicate(cluster[0], item)
+                            cluster[1] = []
+                        # every finished summary is on disk before the next one, for --resume
+                        writer.flush()
+                    sumarized_count += len(records)
+                    saved_tokens += sum(record['token_count'] - record['compressed_token_count'] for record in records)
+                    if first_t is None and records:
+                        first_t = time()
+                        self.logger.log(f'Stage 1 - first summary after {first_t - start_t} seconds')
+                    self.logger.progress(f"Statge 1 - {sumarized_count} : {article_data[1]}", filename)
+                    retrier.attempted()
+                    if len(article_data) == 2:
+                        return None
+                    # articles of a pack that failed on their own after the packed answer left them out
+                    article_data = [None, 'Error', *article_data[2:]]
+                retry = retrier.retry(tuple(article_data[2:]), handler_error(article_data))
+                if retry is None:
+                    dropped += len(article_data) - 2
+                return retry
+
+            documents = self.stage_1_documents(curDate, summarized, kept_records, lock, done, skip_links, duplicates, on_duplicate)
+            completed = self.engine.run(self.stage_1_packs(documents), stage_1_pack_task_handler, on_result)
+            writer.writerows(kept_records)
+        # duplicates of representatives that were dropped have no summary either
+        dropped += sum(len(waiting) for record, waiting in clusters.values() if record is None)
+        if sink:
+            self.publish(sink, 'Stage 1', collection)
+        if completed and not dropped:
+            store.mark_complete()
         end_t = time()
         self.logger.log(f'Stage 1 - {sumarized_count} articles were summarized in {end_t - start_t} seconds')
+        self.logger.log(f'Stage 1 - article cleaning saved {saved_tokens} input tokens')
+        if duplicates is not None:
+            self.logger.log(f'Stage 1 - {duplicate_count} near-duplicate articles got the summary of one of {len(duplicates)} distinct articles')
 
-    def stage_1_save_db(self, csv_filename, curDate: str):
-        self.logger.log(f'Stage 1 - loading summaries from {csv_filename}')
+    def stage_1_save_db(self, filename, curDate: str):
+        self.logger.log(f'Stage 1 - saving summaries from {filename} in db...')
+        self.save_db(RecordStore(filename, 'stage_1'), 'analyzed_articles', curDate, stage_1_operation, 'Stage 1')
+
+    def stage_2(self, stage1_file: str, filename: str, timeframe: str, resume: bool = False, collection: str = None, curDate: str = None):
+        self.logger.log(f'Stage 2 - loading articles from {stage1_file}')
         start_t = time()
-        data_list = []
-        with open(csv_filename, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if not row:
-                    continue
-                try:
-                    baseData = json.loads(row[0])
-                except Exception as e:
-                    self.logger.log(f'Stage 1 - Failed to save analyzed article', e)
-                    print("Failed to save summarized article:\ncontent======", row[0])
-                    print("error ===========", e)
-                    continue
-                article = baseData['article']
-                title = row[1]
-                category = row[2]
-                summary = row[3]
-                day_score = row[4]
-                day_reason = row[5]
-                week_score = row[6]
-                week_reason = row[7]
-                month_score = row[8]
-                month_reason = row[9]
-                site_name = row[10]
-                link = row[11]
-
-                score = {
-                    "day": {"score": day_score, "reason": day_reason},
-                    "week": {"score": week_score, "reason": week_reason},
-                    "month": {"score": month_score, "reason": month_reason}
-                }
-                data_list.append(
-                    {"article": article,
-                    "title": title,
-                    "category": category,
-                    "summary": summary,
-                    "score": score,
-                    "site_name": site_name,
-                    "link": link}
-                )
+        table = self.stage1_tables.get(stage1_file)
         end_t = time()
-        self.logger.log(f'Stage 1 - loaded {len(data_list)} summaries in {end_t - start_t} seconds')
-        self.logger.log(f'Stage 1 - saving summaries in db...')
-        new_collection = self.db['analyzed_articles'][curDate]
-        new_collection.drop()
-        result = new_collection.insert_many(data_list)
-        print("Data inserted successfully. Inserted IDs:", result.inserted_ids)
-        end_t = time()
-        self.logger.log(f'Stage 1 - Saved {len(result.inserted_ids)} summaries in db...')
+        self.logger.log(f'Stage 2 - {len(table)} articles were loaded from {stage1_file} in {end_t - start_t} second')
 
-    def stage_2(self, stage1_csv: str, csv_filename: str, timeframe: str):
-        os.remove(csv_filename) if os.path.exists(csv_filename) else None
-        self.logger.log(f'Stage 2 - loading articles from {stage1_csv}')
-        titles = []
-        categories = set()
-        total = 0
-        start_t = time()
-        with open(stage1_csv, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
+        store = RecordStore(filename, 'stage_2')
+        done = store.completed(lambda record: record['category']) if resume else set()
+        failed = 0
+        # local: titles are grouped without the LLM, hybrid: the LLM only decides the ambiguous titles, llm: as before
+        mode = os.environ.get("STAGE_2_GROUPING", "hybrid")
+        grouper = None
+        # categories grouped without a categorize call
+        skipped = 0
+        category_count = 0
+        if mode != 'llm':
+            spacy_model = os.environ.get("STAGE_2_SPACY_MODEL")
+            grouper = TopicGrouper(
+                threshold=float(os.environ.get("STAGE_2_GROUP_THRESHOLD", 0.3)),
+                margin=float(os.environ.get("STAGE_2_GROUP_MARGIN", 0.05)),
+                nlp=registry.get(('spacy', spacy_model), lambda: noun_chunker(spacy_model)) if spacy_model else None,
+            )
+        sink = self.sink(collection, curDate, stage_2_operation, store, resume) if collection else None
+        with store.writer(truncate=not resume, on_write=sink.write if sink else None) as writer:
+            for category in table.timeframe_categories(timeframe):
+                if category not in self.categories or category in done:
+                    continue
+                rows = table.top_k(category, timeframe, 270)
+                primaries = [table.titles[row] for row in rows[0:20]]
+                secondaries = [table.titles[row] for row in rows[20:270]]
 
-            for row in csv_reader:
-                total += 1
+                category_count += 1
+                if grouper is None:
+                    data = self.stage_2_llm_groups(category, timeframe, primaries, secondaries)
+                else:
+                    group_t = time()
+                    data, ambiguous, unmatched = grouper.group(primaries, secondaries)
+                    grouped = sum(len(topic['Secondary']) - 1 for topic in data)
+                    self.logger.log(
+                        f"Stage 2: {category} for {timeframe}-timeframe: {grouped} titles grouped locally, "
+                        f"{len(ambiguous)} ambiguous and {len(unmatched)} unmatched in {time() - group_t:.3f} seconds"
+                    )
+                    # unmatched titles are like no primary or their topic is full, the LLM is only asked to break ties
+                    if ambiguous and mode == 'hybrid':
+                        # a failed call only loses these titles
+                        llm_data = self.stage_2_llm_groups(category, timeframe, primaries, ambiguous)
+                        added = grouper.merge(data, llm_data, ambiguous) if llm_data else 0
+                        self.logger.log(f"Stage 2: {added} of {len(ambiguous)} ambiguous titles grouped by the LLM")
+                    else:
+                        skipped += 1
+                        metrics.inc('stage_2_categorize_skipped_total', mode=mode)
+                        if ambiguous:
+                            self.logger.log(f"Stage 2: {len(ambiguous)} ambiguous titles are not grouped")
+                    if unmatched:
+                        self.logger.log(f"Stage 2: {len(unmatched)} unmatched titles are not grouped")
                 try:
-                    if row[1] == '': continue
-                    if timeframe == 'day' and row[4] == '': continue
-                    if timeframe == 'week' and row[6] == '': continue
-                    if timeframe == 'month' and row[8] == '': continue
-                    score = 0
-                    if timeframe == 'day':
-                        score = int(remove_non_numbers_regex(row[4]))
-                    elif timeframe == 'week':
-                        score = int(remove_non_numbers_regex(row[6]))
-                    elif timeframe == 'month':
-                        score = int(remove_non_numbers_regex(row[8]))
-
-                    article = json.loads(row[0])['article']
-                    title = row[1]
-                    category = row[2]  # Assuming the category is in the 4th column
-                    summary = row[3]
-                    categories.add(category)  # Add category to the set of unique categories
-
-                    if any(item['title'] == title for item in titles):
-                        print(title)
-                        continue
-                    titles.append({'article': article, 'title': title, 'score': score, 'category': category, 'summary': summary})
-                except IndexError as err:
-                    self.logger.log(f'Stage 2 - Error while loading articles: {err}')
-                    pass
-        end_t = time()
-        self.logger.log(f'Stage 2 - articles were loaded from {stage1_csv} in {end_t - start_t} second')
+                    if data:
+                        self.logger.log(f"Stage 2: {len(data)}")
+                        writer.write({'category': category, 'primaries': primaries, 'secondaries': secondaries, 'data': data})
+                        writer.flush()
+                    else:
+                        failed += 1
+                        print('Error')
+                except SchemaError as err:
+                    failed += 1
+                    self.logger.log(f"Stage 2: Schema Error: {err} in {data}")
+        if sink:
+            self.publish(sink, 'Stage 2', collection)
+        if grouper is not None:
+            self.logger.log(f"Stage 2 - {skipped} of {category_count} categories were grouped without a categorize call")
+        if not failed:
+            store.mark_complete()
 
-        for category in categories:
-            if category not in self.categories:
-                continue
-            category_titles = [title for title in titles if title['category'] == category]
-            sorted_titles = sorted(category_titles, key=lambda x: x['score'], reverse=True)
-
-            primaries = []
-            for title in sorted_titles[0:20]:
-                if title['title'] != '' and title['title'] not in primaries:
-                    primaries.append(title['title'])
-            secondaries = []
-            for title in sorted_titles[20:270]:
-                if title['title'] != '' and title['title'] not in primaries and title['title'] not in secondaries:
-                    secondaries.append(title['title'])
-
-            result = []
-            try:
-                result = self.stage_2_category(primaries=primaries, secondaries=secondaries)
-                print(result[0])
-                self.logger.log(f"Stage 2: {category} for {timeframe}-timeframe:\n {result[1]}")
-            except Exception as er:
-                error = str(traceback.print_exc())
-                self.logger.log(f"Stage 2: Error while categorizing: {er} in {error}")
-            try:
-                data = json.loads(result[0])
-                if data:
-                    self.logger.log(f"Stage 2: {len(data)}")
-                    with open(csv_filename, "a", encoding='utf-8') as file:
-                        writer = csv.writer(file)
-                        writer.writerow([category, primaries, secondaries, data])
-                else:
-                    print('Error')
-            except json.decoder.JSONDecodeError as err:
-                self.logger.log(f"Stage 2: JSONDecode Error: {err} in {result}")
+    def stage_2_llm_groups(self, category: str, timeframe: str, primaries: list[str], secondaries: list[str]):
+        """Topics of the categorize answer, None when it failed"""
+        result = []
+        try:
+            result = self.stage_2_category(primaries=primaries, secondaries=secondaries)
+            print(result[0])
+            self.logger.log(f"Stage 2: {category} for {timeframe}-timeframe:\n {result[1]}")
+        except Exception as er:
+            error = str(traceback.print_exc())
+            self.logger.log(f"Stage 2: Error while categorizing: {er} in {error}")
+        try:
+            return parse_output(result[0], 'categorize')
+        except (OutputError, IndexError, TypeError) as err:
+            self.logger.log(f"Stage 2: Output Error: {err} in {result}")
+            return None
 
     def stage_2_category(self, primaries, secondaries):
-        apikey = random.choice(self.apikeys)
-        try:
-            result = categorize(apikey=apikey, primaries=primaries, secondaries=secondaries)
-            return result
-        except InvalidRequestError as er:
-            print(er)
-        except AuthenticationError as er:
-            self.log_invalid_key(apikey)
-            self.logger.log(f"Stage 2: Invalid apikey: {apikey}")
-            return self.stage_2_category(primaries, secondaries)
-        except RateLimitError as er:
-            print(f"args: {er.args}\nparam: {er.code}, error: {er.error}, header: {er.headers}")
-            if er.error['type'] == 'insufficient_quota':
-                self.logger.log(f"Stage 2: Invalid apikey: {apikey}")
-                self.log_invalid_key(apikey)
-                return self.stage_2_category(primaries, secondaries)
-            # elif er.error['type'] == 'requests' and er.error['code'] == 'rate_limit_exceeded':
-            elif er.error['code'] == 'rate_limit_exceeded':
-                # check if remaining requests are not 0
-                return self.stage_2_category(primaries, secondaries)
-                # if er.headers['x-ratelimit-remaining-requests'] == 0:
-                # else:
-                #     sleep(20)
-                #     return stage_1_thread_handler( apikey, article, site_name, link,)
-    
-    def stage_2_save_db(self, csv_filename: str, collection: str, curDate: str):
-        data_list = []
-        with open(csv_filename, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            for row in csv_reader:
-                if not row:
-                    continue
-                category = row[0]
-                data = row[3]
-                dictionary = eval(data)
-                data_list.append({"category": category, "data": dictionary})
-
-        new_collection = self.db[collection][curDate]
-        new_collection.drop()
-
-        result = new_collection.insert_many(data_list)
-        self.logger.log(f"Stage 2 - data saved from {csv_filename} into {collection} collection")
-
-    def stage_3(self, category_csv, summary_csv, csv_filename):
-        os.remove(csv_filename) if os.path.exists(csv_filename) else None
-        with open(csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                'category',
-                'topic',
-                'research',
-                'articles'
-            ])
+        return self.call_llm(
+            'Stage 2', 'categorize', {'primaries': primaries, 'secondaries': secondaries},
+            lambda apikey: categorize(apikey=apikey, primaries=primaries, secondaries=secondaries),
+        )
+
+    def stage_2_save_db(self, filename: str, collection: str, curDate: str):
+        self.save_db(RecordStore(filename, 'stage_2'), collection, curDate, stage_2_operation, 'Stage 2')
+
+    def stage_3(self, category_file, summary_file, filename, resume: bool = False, collection: str = None, curDate: str = None):
+        store = RecordStore(filename, 'stage_3')
+        done = store.completed(lambda record: (record['category'], record['topic'])) if resume else set()
         toprompts = []
-        summaries = []
         self.logger.log(f"Stage 3 - Preparing article and topic datas")
 
-        with open(summary_csv, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                summaries.append({
-                    "category": row[2],
-                    "title": row[1],
-                    "summary": row[3],
-                    "content": json.loads(row[0])['article'],
-                })
+        table = self.stage1_tables.get(summary_file)
+        resolver = TitleResolver(table.titles, threshold=float(os.environ.get("TITLE_MATCH_THRESHOLD", 0.6)))
         total = 0
-        with open(category_csv, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            for row in csv_reader:
-                if not row:
-                    continue
-                category = row[0]
-                topics =  eval(row[3])
-                print(len(topics))
-                if len(topics) < 20:
-                    print(category, topics)
-                for topic in topics:
-                    total += 1
-                    primary = topic["Primary"]
-                    secondary = topic["Secondary"]
-                    articles = []
-                    for title in secondary:
-                        summary = ""
-                        content = ""
-                        for ele in summaries:
-                            if ele["title"] == title:
-                                summary = ele["summary"]
-                                content = ele["content"]
-                                break
-                        articles.append({
-                            "title": title,
-                            "summary": summary,
-                            "content": content,
-                        })
-                    if len(articles) == 0: continue
-                    toprompt = {
-                        "topic": primary,
-                        "category": category,
-                        "articles": articles,
-                    }
-                    toprompts.append(toprompt)
+        for record in RecordStore(category_file, 'stage_2'):
+            category = record['category']
+            topics = record['data']
+            print(len(topics))
+            if len(topics) < 20:
+                print(category, topics)
+            for topic in topics:
+                total += 1
+                primary = topic["Primary"]
+                secondary = topic["Secondary"]
+                articles = []
+                token_counts = []
+                for title in secondary:
+                    row = resolver.resolve(title)
+                    if row is None:
+                        # never send an article without content to extra research
+                        continue
+                    articles.append({
+                        "title": table.titles[row],
+                        "summary": table.summaries[row],
+                        "content": table.articles[row],
+                    })
+                    token_counts.append(table.token_counts[row])
+                if len(articles) == 0 or (category, primary) in done: continue
+                toprompt = {
+                    "topic": primary,
+                    "category": category,
+                    "articles": articles,
+                    "token_counts": token_counts,
+                }
+                toprompts.append(toprompt)
+        self.logger.log(f"Stage 3 - Resolved {resolver.stats()}")
         self.logger.log(f"Stage 3 - Prepared {len(toprompts)} article and topic data")
         self.logger.log(f"Stage 3 - Start extra research...")
         
         researched_count = 0
+        dropped = 0
         total = len(toprompts)
+        retrier = self.retrier('Stage 3', lambda item: (item[0], item[1]))
         start_t = time()
-        while len(toprompts) != 0:
-            pool = multiprocessing.Pool(processes=min(len(self.apikeys), 50))
-            results: list[ApplyResult] = []
-
-            for i, toprompt in enumerate(toprompts):
-                topic = toprompt["topic"]
-                category = toprompt["category"]
-                articles = toprompt["articles"]
-                api_key = self.apikeys[i % len(self.apikeys)]  # Use a different API key for each process
-                if len(self.apikeys) > len(toprompts):
-                    api_key = random.choice(self.apikeys)
-                results.append(pool.apply_async(stage_3_thread_handler, (api_key, category, topic, articles,)))
-            toprompts = []
-            with open(csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                for result in results:
-                    article_data = result.get()
-                    if article_data[1] == 'APIKey_Error':
-                        api_key = article_data[0]
-                        self.log_invalid_key(api_key)
-                    elif article_data[1] == 'Error':
-                        print(f"Statge 3 - Error was occurred in extra research\n: {article_data[0]}")
-                    elif article_data[1] == 'UnexpectedError':
-                        print(f"Statge 3 - UnexpectedError was occurred in extra research\n: {article_data[0]}")
-                        continue
-                    else:
-                        writer.writerow(article_data[0:-1])
-                        researched_count += 1
-                        self.logger.log(f"Statge 3 - {researched_count}/{total} : {article_data[-1]}")
-                        continue
-                    toprompt = {
-                        "topic": article_data[2],
-                        "category": article_data[3],
-                        "articles": article_data[4],
-                    }
-                    toprompts.append(toprompt)
-            pool.close()
-            pool.join()
+        sink = self.sink(collection, curDate, stage_3_operation, store, resume) if collection else None
+        with store.writer(truncate=not resume, on_write=sink.write if sink else None) as writer:
+
+            def on_result(article_data):
+                nonlocal researched_count, dropped
+                if article_data[1] == 'APIKey_Error':
+                    api_key = article_data[0]
+                    self.log_invalid_key(api_key)
+                elif article_data[1] == 'Error':
+                    print(f"Statge 3 - Error was occurred in extra research\n: {article_data[0]}")
+                elif article_data[1] == 'UnexpectedError':
+                    print(f"Statge 3 - UnexpectedError was occurred in extra research\n: {article_data[0]}")
+                else:
+                    writer.write(article_data[0])
+                    writer.flush()
+                    researched_count += 1
+                    self.logger.progress(f"Statge 3 - {researched_count}/{total} : {article_data[-1]}", filename)
+                    retrier.attempted()
+                    return None
+                retry = retrier.retry((article_data[2], article_data[3], article_data[4], article_data[5]), handler_error(article_data))
+                if retry is None:
+                    dropped += 1
+                return retry
+
+            items = [(toprompt["category"], toprompt["topic"], toprompt["articles"], toprompt["token_counts"]) for toprompt in toprompts]
+            completed = self.engine.run(items, stage_3_task_handler, on_result)
+        if sink:
+            self.publish(sink, 'Stage 3', collection)
+        if completed and not dropped:
+            store.mark_complete()
         end_t = time()
         self.logger.log(f'Stage 3 - {researched_count} articles were extra researched in {end_t - start_t} seconds')
 
-    def stage_3_save_db(self, csv_filename: str, collection: str, curDate: str):
-        data_list = []
-        categories = set()
-        researches = []
-        with open(csv_filename, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if not row:
-                    continue
-                categories.add(row[0])
-                researches.append({
-                    "category": row[0],
-                    "topic": row[1],
-                    "research": eval(row[2]),
-                })
-        for category in categories:
-            data_list.append({
-                "category": category,
-                "data": [{
-                    "topic": item["topic"],
-                    "research": item["research"]
-                } for item in researches if item["category"] == category]
-            })
-        new_collection = self.db[collection][curDate]
-        new_collection.drop()
-        result = new_collection.insert_many(data_list)
-        self.logger.log(f"Stage 3 - data saved from {csv_filename} into {collection} collection")
+    def stage_3_save_db(self, filename: str, collection: str, curDate: str):
+        self.save_db(RecordStore(filename, 'stage_3'), collection, curDate, stage_3_operation, 'Stage 3')
     
-    def stage_4(self, stage3_csv: str, csv_filename: str):
-        os.remove(csv_filename) if os.path.exists(csv_filename) else None
-        with open(csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                'category',
-                'topic',
-                'background',
-                'deep_research'
-                'articles'
-            ])
-
+    def stage_4(self, stage3_file: str, filename: str, resume: bool = False, collection: str = None, curDate: str = None):
         data = []
         categories = set()
         start_t = time()
-        self.logger.log(f"Stage 4 - Loading data from {stage3_csv}...")
-        with open(stage3_csv, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if not row:
-                    continue
-                categories.add(row[0])
-                data.append({
-                    "category": row[0],
-                    "topic": row[1],
-                    "research": eval(row[2]),
-                    "articles": eval(row[3])
-                })
+        self.logger.log(f"Stage 4 - Loading data from {stage3_file}...")
+        store = RecordStore(filename, 'stage_4')
+        done = store.completed(lambda record: (record['category'], record['topic'])) if resume else set()
+        for record in RecordStore(stage3_file, 'stage_3'):
+            if (record['category'], record['topic']) in done:
+                continue
+            categories.add(record['category'])
+            data.append(record)
         end_t = time()
-        self.logger.log(f"Stage 4 - loaded {len(data)} data from {stage3_csv} in {end_t - start_t} seconds")
+        self.logger.log(f"Stage 4 - loaded {len(data)} data from {stage3_file} in {end_t - start_t} seconds")
 
         total = len(data)
         start_t = time()
         researched = 0
-        while len(data) != 0:
-            pool = multiprocessing.Pool(processes=min(len(self.apikeys), 50))
-            results: list[ApplyResult] = []
-
-            for i, item in enumerate(data):
-                topic = item["topic"]
-                category = item["category"]
-                research = item["research"]
-                articles = item["articles"]
-                api_key = self.apikeys[i % len(self.apikeys)]  # Use a different API key for each process
-                if len(self.apikeys) > len(data):
-                    api_key = random.choice(self.apikeys)
-                results.append(pool.apply_async(stage_4_thread_handler, (api_key, category, topic, research, articles,)))
-            data = []
-            with open(csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                for result in results:
-                    article_data = result.get()
-                    if article_data[1] == 'APIKey_Error':
-                        api_key = article_data[0]
-                        self.log_invalid_key(api_key)
-                    elif article_data[1] == 'Error':
-                        print(f"Statge 4 - Error was occurred in deep research\n: {article_data[0]}")
-                        continue
-                    else:
-                        writer.writerow([article_data[0], article_data[1], article_data[2], article_data[3], str(article_data[4])])
-                        researched += 1
-                        self.logger.log(f"Statge 4 - {researched}/{total} : {article_data[-1]}")
-                        continue
-                    data.append({
-                        "category": article_data[2],
-                        "topic": article_data[3],
-                        "research": article_data[4],
-                        "articles": article_data[5]
-                    })
-            pool.close()
-            pool.join()
+        dropped = 0
+        retrier = self.retrier('Stage 4', lambda item: (item[0], item[1]))
+        sink = self.sink(collection, curDate, stage_4_operation, store, resume) if collection else None
+        with store.writer(truncate=not resume, on_write=sink.write if sink else None) as writer:
+
+            def on_result(article_data):
+                nonlocal researched, dropped
+                if article_data[1] == 'APIKey_Error':
+                    api_key = article_data[0]
+                    self.log_invalid_key(api_key)
+                elif article_data[1] == 'Error':
+                    print(f"Statge 4 - Error was occurred in deep research\n: {article_data[0]}")
+                else:
+                    writer.write(article_data[0])
+                    writer.flush()
+                    researched += 1
+                    self.logger.progress(f"Statge 4 - {researched}/{total} : {article_data[-1]}", filename)
+                    retrier.attempted()
+                    return None
+                retry = retrier.retry((article_data[2], article_data[3], article_data[4], article_data[5]), handler_error(article_data))
+                if retry is None:
+                    dropped += 1
+                return retry
+
+            items = [(item["category"], item["topic"], item["research"], item["articles"]) for item in data]
+            completed = self.engine.run(items, stage_4_task_handler, on_result)
+        if sink:
+            self.publish(sink, 'Stage 4', collection)
+        if completed and not dropped:
+            store.mark_complete()
         end_t = time()
         self.logger.log(f'Stage 4 - {researched} articles were extra researched in {end_t - start_t} seconds')
     
-    def stage_4_save_db(self, csv_filename: str, collection: str, curDate: str):
-        data_list = []
-        categories = set()
-        dresearches = []
-        with open(csv_filename, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if not row:
-                    continue
-                categories.add(row[0])
-                dresearches.append({
-                    "category": row[0],
-                    "topic": row[1],
-                    "deep_research": eval(row[3]),
-                })
-        for category in categories:
-            print(row[3])
-            data_list.append({
-                "category": category,
-                "data": [{
-                    "topic": item["topic"],
-                    "deep_research": item["deep_research"]
-                } for item in dresearches if item["category"] == category]
-            })
-        new_collection = self.db[collection][curDate]
-        new_collection.drop()
-        result = new_collection.insert_many(data_list)
-        self.logger.log(f"Stage 4 - data saved from {csv_filename} into {collection} collection")
+    def stage_4_save_db(self, filename: str, collection: str, curDate: str):
+        self.save_db(RecordStore(filename, 'stage_4'), collection, curDate, stage_4_operation, 'Stage 4')
     
-    def stage_5(self, stage1_csv, csv_filename, timeframe):
-        self.logger.log(f'Stage 5 - loading articles from {stage1_csv}')
-        articles = []
-        categories = set()
-        total = 0
+    def stage_5(self, stage1_file, filename, timeframe, collection: str = None, curDate: str = None):
+        self.logger.log(f'Stage 5 - loading articles from {stage1_file}')
         start_t = time()
-        with open(stage1_csv, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-
-            for row in csv_reader:
-                total += 1
-                try:
-                    if row[1] == '': continue
-                    if timeframe == 'day' and row[4] == '': continue
-                    if timeframe == 'week' and row[6] == '': continue
-                    if timeframe == 'month' and row[8] == '': continue
-                    score = 0
-                    if timeframe == 'day':
-                        score = int(remove_non_numbers_regex(row[4]))
-                    elif timeframe == 'week':
-                        score = int(remove_non_numbers_regex(row[6]))
-                    elif timeframe == 'month':
-                        score = int(remove_non_numbers_regex(row[8]))
-
-                    # article = row[0]
-                    title = row[1]
-                    category = row[2]  # Assuming the category is in the 4th column
-                    summary = row[3]
-                    categories.add(category)  # Add category to the set of unique categories
-
-                    if any(item['title'] == title for item in articles):
-                        continue
-                    articles.append({'title': title, 'score': score, 'category': category, 'summary': summary})
-                except IndexError as err:
-                    self.logger.log(f'Stage 2 - Error while loading articles: {err}')
-                    pass
+        table = self.stage1_tables.get(stage1_file)
         end_t = time()
-        self.logger.log(f'Stage 5 - articles were loaded from {stage1_csv} in {end_t - start_t} second')
+        self.logger.log(f'Stage 5 - {len(table)} articles were loaded from {stage1_file} in {end_t - start_t} second')
         top30 = []
         start_t = time()
-        for category in categories:
+        for category in table.timeframe_categories(timeframe):
             if category not in self.categories:
                 continue
-            category_articles = [article for article in articles if article['category'] == category]
-            sorted_articles = sorted(category_articles, key=lambda x: x['score'], reverse=True)
-            for tmp in sorted_articles[0:3]:
-                top30.append(tmp)
+            for row in table.top_k(category, timeframe, 3):
+                top30.append({
+                    'title': table.titles[row],
+                    'score': int(table.scores[timeframe][row]),
+                    'category': category,
+                    'summary': table.summaries[row],
+                })
         end_t = time()
         self.logger.log(f'Stage 5 - articles were sorted in {end_t - start_t} second')
         start_t = time()
@@ -628,83 +788,51 @@ class Analyzer:
         except Exception as er:
             error = str(traceback.print_exc())
             self.logger.log(f"Stage 5: Error : {er} in {error}")
+        if not result:
+            self.logger.log(f'Stage 5 - no impactful news for the {timeframe} timeframe')
+            return
         self.logger.log(f'Stage 5 - {result[1]}')
-        with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["no", "title", "explanation"])
-            print(result[0])
-            tops: list = eval(result[0])
+        store = RecordStore(filename, 'stage_5')
+        sink = self.sink(collection, curDate, stage_5_operation, store) if collection else None
+        with store.writer(truncate=True, on_write=sink.write if sink else None) as writer:
+            tops: list = result[0]
             print(tops)
             for i, top in enumerate(tops):
-                writer.writerow([i+1, top['title'], top['explanation']])
+                writer.write({'no': i+1, 'title': top['title'], 'explanation': top['explanation']})
+        if sink:
+            self.publish(sink, 'Stage 5', collection)
+        store.mark_complete()
 
         end_t = time()
         self.logger.log(f'Stage 5 - got the result in {end_t - start_t} second')
     
     def stage_5_impactful_news(self, articles):
-        apikey = random.choice(self.apikeys)
-        try:
+        def attempt(apikey):
             result = impactul_news(apikey=apikey, articles=articles)
-            try:
-                eval(result[0])
-            except NameError as er:
-                return self.stage_5_impactful_news(articles)
-            except SyntaxError as er:
-                return self.stage_5_impactful_news(articles)
-            return result
-        except InvalidRequestError as er:
-            result = self.stage_5_impactful_news(articles)
-            return result
-        except AuthenticationError as er:
-            self.log_invalid_key(apikey)
-            self.logger.log(f"Stage 5: Invalid apikey: {apikey}")
-            return self.stage_5_impactful_news(articles)
-        except RateLimitError as er:
-            print(f"args: {er.args}\nparam: {er.code}, error: {er.error}, header: {er.headers}")
-            if er.error['type'] == 'insufficient_quota':
-                self.logger.log(f"Stage 5: Invalid apikey: {apikey}")
-                self.log_invalid_key(apikey)
-                return self.stage_5_impactful_news(articles)
-            elif er.error['code'] == 'rate_limit_exceeded':
-                return self.stage_5_impactful_news(articles)
+            # only an answer that cannot be repaired is asked for again
+            return [parse_output(result[0], 'impactful-news'), result[1]]
+        return self.call_llm('Stage 5', 'impactful-news', articles, attempt)
     
-    def stage_5_save_db(self, csv_filename: str, collection: str, curDate: str):
-        data_list = []
-        with open(csv_filename, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if not row:
-                    continue
-                title = row[1]
-                explanation = row[2]
-                data_list.append({"title": title, "explanation": explanation})
-
-        new_collection = self.db[collection][curDate]
-        new_collection.drop()
-        result = new_collection.insert_many(data_list)
-        self.logger.log(f"Stage 5 - data saved from {csv_filename} into {collection} collection")
+    def stage_5_save_db(self, filename: str, collection: str, curDate: str):
+        self.save_db(RecordStore(filename, 'stage_5'), collection, curDate, stage_5_operation, 'Stage 5')
     
-    def stage_6(self, stage4_csv: str, csv_filename: str, timeframe: str):
-        self.logger.log(f'Stage 6 - loading topics from {stage4_csv}')
+    def stage_6(self, stage4_file: str, filename: str, timeframe: str, resume: bool = False, collection: str = None, curDate: str = None):
+        self.logger.log(f'Stage 6 - loading topics from {stage4_file}')
         topics = []
         data_list = []
         categories = set()
         start_t = time()
-        with open(stage4_csv, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if not row:
-                    continue
-                categories.add(row[0])
-                deep_research = eval(row[3])
-                topics.append({
-                    "category": row[0],
-                    "topic": row[1],
-                    "prediction": f"Description: {deep_research['1 day timeframe']['Most likely']['Description']}\nExplanation: {deep_research['1 day timeframe']['Most likely']['Explanation']}",
-                })
-        for category in categories:
+        for record in RecordStore(stage4_file, 'stage_4'):
+            categories.add(record['category'])
+            deep_research = record['deep_research']
+            topics.append({
+                "category": record['category'],
+                "topic": record['topic'],
+                "prediction": f"Description: {deep_research['1 day timeframe']['Most likely']['Description']}\nExplanation: {deep_research['1 day timeframe']['Most likely']['Explanation']}",
+            })
+        # stage 4 writes topics in the order they finish, the prompts must not depend on it
+        topics.sort(key=lambda topic: (topic["category"], topic["topic"]))
+        for category in sorted(categories):
             if category not in self.categories:
                 continue
             data_list.append({
@@ -722,173 +850,248 @@ class Analyzer:
             } for topic in topics]
         })
         end_t = time()
-        self.logger.log(f'Stage 6 - topics were loaded from {stage4_csv} in {end_t - start_t} second')
+        self.logger.log(f'Stage 6 - topics were loaded from {stage4_file} in {end_t - start_t} second')
         start_t = time()
-        results = []
-        try:
-            for i, data in enumerate(data_list):
-                result = self.stage_6_prediction(data, timeframe)
-                results.append([result[0], eval(result[1][0])])
-                self.logger.log(f'Stage 6 - {i+1}/{len(data_list)} - {result[1][1]}')
-        except Exception as er:
-            error = str(traceback.print_exc())
-            self.logger.log(f"Stage 6: Error : {er} in {error}")
-        with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["category", "prediction"])
-            for result in results:
-                writer.writerow(result)
+        store = RecordStore(filename, 'stage_6')
+        completed = False
+        done = store.completed(lambda record: record['category']) if resume else set()
+        sink = self.sink(collection, curDate, stage_6_operation, store, resume) if collection else None
+        with store.writer(truncate=not resume, on_write=sink.write if sink else None) as writer:
+            try:
+                failed = 0
+                for i, data in enumerate(data_list):
+                    if data["category"] in done:
+                        continue
+                    result = self.stage_6_prediction(data, timeframe)
+                    if result is None:
+                        # given up on, the other categories still get their prediction
+                        failed += 1
+                        continue
+                    writer.write({'category': result[0], 'prediction': result[1][0]})
+                    writer.flush()
+                    self.logger.log(f'Stage 6 - {i+1}/{len(data_list)} - {result[1][1]}')
+            except Exception as er:
+                error = str(traceback.print_exc())
+                self.logger.log(f"Stage 6: Error : {er} in {error}")
+            else:
+                completed = not failed
+        if sink:
+            self.publish(sink, 'Stage 6', collection)
+        if completed:
+            store.mark_complete()
 
         end_t = time()
         self.logger.log(f'Stage 6 - got the result in {end_t - start_t} second')
 
     def stage_6_prediction(self, topics, timeframe):
-        apikey = random.choice(self.apikeys)
-        try:
+        def attempt(apikey):
             result = prediction(apikey, topics["data"], topics["category"], timeframe)
-            return [topics["category"], result]
-        except InvalidRequestError as er:
-            result = self.stage_6_prediction(topics, timeframe)
-            return result
-        except AuthenticationError as er:
-            self.log_invalid_key(apikey)
-            self.logger.log(f"Stage 6: Invalid apikey: {apikey}")
-            return self.stage_6_prediction(topics, timeframe)
-        except RateLimitError as er:
-            print(f"args: {er.args}\nparam: {er.code}, error: {er.error}, header: {er.headers}")
-            if er.error['type'] == 'insufficient_quota':
-                self.logger.log(f"Stage 6: Invalid apikey: {apikey}")
-                self.log_invalid_key(apikey)
-                return self.stage_6_prediction(topics, timeframe)
-            elif er.error['code'] == 'rate_limit_exceeded':
-                return self.stage_6_prediction(topics, timeframe)
+            return [topics["category"], [parse_output(result[0], 'prediction'), result[1]]]
+        return self.call_llm('Stage 6', f"{topics['category']} {timeframe}", topics, attempt)
     
-    def stage_6_save_db(self, csv_filename: str, collection: str, curDate: str):
-        data_list = []
-        with open(csv_filename, 'r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if not row:
-                    continue
-                data_list.append({"category": row[0], "prediction": eval(row[1])})
+    def stage_6_save_db(self, filename: str, collection: str, curDate: str):
+        self.save_db(RecordStore(filename, 'stage_6'), collection, curDate, stage_6_operation, 'Stage 6')
 
-        new_collection = self.db[collection][curDate]
-        new_collection.drop()
-        result = new_collection.insert_many(data_list)
-        self.logger.log(f"Stage 6 - data saved from {csv_filename} into {collection} collection")
+# Write operations of the stage records in their collections, keyed by stable ids
+# so that writing a record again (e.g. on --resume) does not duplicate it
 
-def stage_1_thread_handler(
-        apikey: str,
+def stage_1_operation(record: dict):
+    score = {
+        "day": {"score": record['day_score'], "reason": record['day_reason']},
+        "week": {"score": record['week_score'], "reason": record['week_reason']},
+        "month": {"score": record['month_score'], "reason": record['month_reason']}
+    }
+    document = {"article": record['article'],
+        "title": record['title'],
+        "category": record['category'],
+        "summary": record['summary'],
+        "score": score,
+        "site_name": record['site_name'],
+        "link": record['link']}
+    return ReplaceOne({'_id': article_fingerprint(record['link'], record['article'])}, document, upsert=True)
+
+def stage_2_operation(record: dict):
+    return ReplaceOne({'_id': record['category']}, {"category": record['category'], "data": record['data']}, upsert=True)
+
+# stages 3 and 4 keep one document per category holding all of its topics
+def stage_3_operation(record: dict):
+    return UpdateOne(
+        {'_id': record['category']},
+        {'$set': {"category": record['category']}, '$addToSet': {"data": {"topic": record['topic'], "research": record['research']}}},
+        upsert=True,
+    )
+
+def stage_4_operation(record: dict):
+    return UpdateOne(
+        {'_id': record['category']},
+        {'$set': {"category": record['category']}, '$addToSet': {"data": {"topic": record['topic'], "deep_research": record['deep_research']}}},
+        upsert=True,
+    )
+
+def stage_5_operation(record: dict):
+    return ReplaceOne({'_id': record['no']}, {"title": record['title'], "explanation": record['explanation']}, upsert=True)
+
+def stage_6_operation(record: dict):
+    return ReplaceOne({'_id': record['category']}, {"category": record['category'], "prediction": record['prediction']}, upsert=True)
+
+def _stage_1_record(
         article: str,
         site_name: str,
         link: str,
         rCategory: str,
-    ):
-    items = [
-        'Title:',
-        'Category:',
-        'Summary:',
-        'Importance 1 day:',
-        'Reasoning for 1 day score:',
-        'Importance 1 week:',
-        'Reasoning for 1 week score:',
-        'Importance 1 month:',
-        'Reasoning for 1 month score:',
-    ]
-
-    item_dict = {
-        'Title:': None,
-        'Category:': rCategory,
-        'Summary:': None,
-        'Importance 1 day:': None,
-        'Reasoning for 1 day score:': None,
-        'Importance 1 week:': None,
-        'Reasoning for 1 week score:': None,
-        'Importance 1 month:': None,
-        'Reasoning for 1 month score:': None
+        result: str,
+        token_count: int,
+        compressed_token_count: int,
+    ) -> dict:
+    fields = parse_fields(result, STAGE_1_FIELDS)
+    return {
+        'article': article,
+        'result': result,
+        'title': fields['Title'],
+        'category': rCategory,
+        'summary': fields['Summary'],
+        'day_score': fields['Importance 1 day'],
+        'day_reason': fields['Reasoning for 1 day score'],
+        'week_score': fields['Importance 1 week'],
+        'week_reason': fields['Reasoning for 1 week score'],
+        'month_score': fields['Importance 1 month'],
+        'month_reason': fields['Reasoning for 1 month score'],
+        'site_name': site_name,
+        'link': link,
+        # tokens of the article as stored, later stages send it whole
+        'token_count': token_count,
+        'compressed_token_count': compressed_token_count,
+        'duplicate_of': None,
     }
 
+async def stage_1_task_handler(
+        apikey: str,
+        article: str,
+        site_name: str,
+        link: str,
+        rCategory: str,
+        compressed: CompressedArticle = None,
+    ):
     try:
-        summary = summarize_article(apikey, article)
-        for item in items:
-            for line in summary[0].split('\n'):
-                if line.startswith(item):
-                    content = line[len(item):].strip()
-                    item_dict[item] = content
-                    break
-        baseData = {
-            'article': article,
-            'result': summary[0]
-        }
-        return [
-            json.dumps(baseData),            
-            item_dict['Title:'],
-            rCategory,
-            item_dict['Summary:'],
-            item_dict['Importance 1 day:'],
-            item_dict['Reasoning for 1 day score:'],
-            item_dict['Importance 1 week:'],
-            item_dict['Reasoning for 1 week score:'],
-            item_dict['Importance 1 month:'],
-            item_dict['Reasoning for 1 month score:'],
-            site_name,
-            link,
-            summary[1]
-        ]
+        if compressed is None and os.environ.get("STAGE_1_COMPRESS", "1") == "1":
+            # boilerplate and repeated sentences cost tokens and push articles onto the 16k model and map-reduce
+            compressed = compress_article(article, int(os.environ.get("STAGE_1_TOKEN_BUDGET", 11088)))
+        if compressed is not None:
+            summary = await asummarize_article(apikey, compressed.text, compressed.tokens)
+            token_count = compressed.original_tokens
+        else:
+            summary = await asummarize_article(apikey, article)
+            token_count = summary[2]
+        metrics.inc('article_tokens_total', token_count)
+        metrics.inc('article_tokens_saved_total', token_count - summary[2])
+        record = _stage_1_record(article, site_name, link, rCategory, summary[0], token_count, summary[2])
+        return [record, summary[1]]
+    except ReplayMiss as er:
+        # asking again cannot help, the article is dropped
+        return [er, 'UnexpectedError', article, site_name, link, rCategory]
     except InvalidRequestError as er:
         return [er, 'Error', article, site_name, link, rCategory]
     except RateLimitError as er:
         print(f"args: {er.args}\nparam: {er.code}, error: {er.error}, header: {er.headers}")
-        if er.error['type'] == 'insufficient_quota':
+        if classify(er) == 'quota':
             return [apikey, 'APIKey_Error', article, site_name, link, rCategory]
-        # elif er.error['type'] == 'requests' and er.error['code'] == 'rate_limit_exceeded':
-        elif er.error['code'] == 'rate_limit_exceeded':
-            # check if remaining requests are not 0
-            return [er, 'Error', article, site_name, link, rCategory]
-            # if er.headers['x-ratelimit-remaining-requests'] == 0:
-            # else:
-            #     sleep(20)
-            #     return stage_1_thread_handler( apikey, article, site_name, link,)
+        # rate_limit_exceeded and any other 429, the retry policies tell them apart
+        return [er, 'Error', article, site_name, link, rCategory]
     except AuthenticationError as er:
         return [apikey, 'APIKey_Error', article, site_name, link, rCategory]
     except Exception as er:
         # if 'Limit: 200 / day' in str(er):
         #     sleep(450)
-        #     return stage_1_thread_handler( apikey, article, site_name, link,)
+        #     return stage_1_task_handler( apikey, article, site_name, link,)
         # if 'Limit: 3 / min' in str(er):
         #     sleep(20)
-        #     return stage_1_thread_handler( apikey, article, site_name, link,)
+        #     return stage_1_task_handler( apikey, article, site_name, link,)
         # if 'Limit: 3 / min' in str(er) and 'Rate limit reached' in str(er):
-        #     return stage_1_thread_handler(str, article, site_name, link)
+        #     return stage_1_task_handler(str, article, site_name, link)
         return [er, 'Error', article, site_name, link, rCategory]
 
-def stage_3_thread_handler(
+async def stage_1_pack_task_handler(apikey: str, *pack: tuple):
+    """Summarize a pack of (article, site_name, link, rCategory, compressed) items with one request.
+
+    Returns [records, cb, *items left to retry], or [error or key, marker, *pack]
+    like stage_1_task_handler when the request failed. Articles the packed
+    answer left out are summarized on their own.
+    """
+    if len(pack) == 1:
+        result = await stage_1_task_handler(apikey, *pack[0])
+        if isinstance(result[1], str):
+            return [result[0], result[1], pack[0]]
+        return [[result[0]], result[1]]
+
+    try:
+        completion_tokens = int(os.environ.get("STAGE_1_PACK_COMPLETION_TOKENS", 600))
+        results, cb = await asummarize_articles(
+            apikey, [item[4].text for item in pack], [item[4].tokens for item in pack], completion_tokens,
+        )
+    except ReplayMiss as er:
+        return [er, 'UnexpectedError', *pack]
+    except InvalidRequestError as er:
+        # the pack does not fit the context, its articles are summarized one by one
+        print(f"Statge 1 - packed request failed, summarizing {len(pack)} articles alone\n: {er}")
+        results, cb = [None] * len(pack), None
+    except RateLimitError as er:
+        if classify(er) == 'quota':
+            return [apikey, 'APIKey_Error', *pack]
+        return [er, 'Error', *pack]
+    except AuthenticationError as er:
+        return [apikey, 'APIKey_Error', *pack]
+    except Exception as er:
+        return [er, 'Error', *pack]
+
+    records = []
+    missing = []
+    for item, result in zip(pack, results):
+        if result is None or 'Summary:' not in result:
+            missing.append(item)
+            continue
+        article, site_name, link, rCategory, compressed = item
+        metrics.inc('article_tokens_total', compressed.original_tokens)
+        metrics.inc('article_tokens_saved_total', compressed.saved_tokens)
+        records.append(_stage_1_record(
+            article, site_name, link, rCategory, result, compressed.original_tokens, len(compressed.tokens),
+        ))
+    left = []
+    for item in missing:
+        result = await stage_1_task_handler(apikey, *item)
+        if isinstance(result[1], str):
+            left.append(item)
+        else:
+            records.append(result[0])
+            cb = cb or result[1]
+    return [records, cb, *left]
+
+async def stage_3_task_handler(
         apikey: str,
         category: str,
         topic: str,
         articles: dict,
+        token_counts: list,
     ):
     try:
         contents = [article['content'] for article in articles]
-        summary = extra_research(apikey, contents)
-        return [category, topic, json.loads(summary[0].replace("\n", " ")), articles,  summary[1]]
+        summary = await aextra_research(apikey, contents, token_counts)
+        research = parse_output(summary[0], 'extra-research')
+        return [{'category': category, 'topic': topic, 'research': research, 'articles': articles}, summary[1]]
     except InvalidRequestError as er:
-        return [er, 'Error', category, topic, articles]
+        return [er, 'Error', category, topic, articles, token_counts]
     except RateLimitError as er:
         print(f"args: {er.args}\nparam: {er.code}, error: {er.error}, header: {er.headers}")
-        if er.error['type'] == 'insufficient_quota':
-            return [apikey, 'APIKey_Error', category, topic, articles]
-        elif er.error['code'] == 'rate_limit_exceeded':
-            return [er, 'Error', category, topic, articles]
+        if classify(er) == 'quota':
+            return [apikey, 'APIKey_Error', category, topic, articles, token_counts]
+        return [er, 'Error', category, topic, articles, token_counts]
     except AuthenticationError as er:
-        return [apikey, 'APIKey_Error', category, topic, articles]
+        return [apikey, 'APIKey_Error', category, topic, articles, token_counts]
     except Exception as er:
         error = str(traceback.print_exc())
         print(error)
-        return [er, 'UnexpectedError', category, topic, articles]
+        return [er, 'UnexpectedError', category, topic, articles, token_counts]
 
-def stage_4_thread_handler(
+async def stage_4_task_handler(
         apikey: str,
         category: str,
         topic: str,
@@ -896,17 +1099,16 @@ def stage_4_thread_handler(
         articles: list,
     ):
     try:
-        summary = deep_research(apikey, articles, background=research)
-        eval(summary[0])
-        return [category, topic, research, summary[0], articles,  summary[1]]
+        summary = await adeep_research(apikey, articles, background=research)
+        deep = parse_output(summary[0], 'deep-research')
+        return [{'category': category, 'topic': topic, 'background': research, 'deep_research': deep, 'articles': articles}, summary[1]]
     except InvalidRequestError as er:
         return [er, 'Error', category, topic, research, articles]
     except RateLimitError as er:
         print(f"args: {er.args}\nparam: {er.code}, error: {er.error}, header: {er.headers}")
-        if er.error['type'] == 'insufficient_quota':
+        if classify(er) == 'quota':
             return [apikey, 'APIKey_Error', category, topic, research, articles]
-        elif er.error['code'] == 'rate_limit_exceeded':
-            return [er, 'Error', category, topic, research, articles]
+        return [er, 'Error', category, topic, research, articles]
     except AuthenticationError as er:
         return [apikey, 'APIKey_Error', category, topic, research, articles]
     except Exception as er:
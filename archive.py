@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from time import monotonic, sleep, time
+from typing import Any, List, Optional
+
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from langchain.schema.messages import BaseMessage
+
+MODES = ('record', 'replay')
+
+
+class ReplayMiss(LookupError):
+    """A replayed run sent a request the archive has no answer for"""
+
+
+class LLMArchive:
+    """Compact on-disk archive of LLM exchanges, to rerun the pipeline without the API.
+
+    In `record` mode every chat request is sent and its response is stored
+    with the time it took, keyed by a hash of the model parameters and the
+    messages (not of the API key, which differs from run to run). In `replay`
+    mode the stored responses are returned instead, after waiting the recorded
+    latency times `latency_scale` (0 removes the waits); a request that was not
+    recorded raises `ReplayMiss`. Responses are stored zlib compressed.
+    """
+    path: str
+    mode: str
+    latency_scale: float
+    recorded: int
+    replayed: int
+    missed: int
+
+    def __init__(self, path: str, mode: str, latency_scale: float = 1.0) -> None:
+        if mode not in MODES:
+            raise ValueError(f"Unknown LLM archive mode {mode!r}, expected one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.recorded = 0
+        self.replayed = 0
+        self.missed = 0
+        self.lock = threading.Lock()
+        if mode == 'replay' and not os.path.exists(path):
+            raise FileNotFoundError(f"No LLM archive to replay at {path}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_archive ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, latency REAL NOT NULL, recorded REAL NOT NULL)"
+        )
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    @staticmethod
+    def key(params: dict, messages: List[BaseMessage]) -> str:
+        exchange = {'params': params, 'messages': [[message.type, message.content] for message in messages]}
+        return hashlib.sha256(json.dumps(exchange, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def record(self, key: str, result: ChatResult, latency: float):
+        value = {
+            'generations': [
+                {
+                    'content': generation.message.content,
+                    'additional_kwargs': generation.message.additional_kwargs,
+                    'generation_info': generation.generation_info,
+                }
+                for generation in result.generations
+            ],
+            'llm_output': result.llm_output,
+        }
+        blob = zlib.compress(json.dumps(value).encode('utf-8'))
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_archive (key, value, latency, recorded) VALUES (?, ?, ?, ?)",
+                (key, blob, latency, time()),
+            )
+            self.recorded += 1
+
+    def replay(self, key: str) -> tuple[ChatResult, float]:
+        """Recorded response of the request and the seconds to wait before returning it"""
+        with self.lock:
+            row = self.conn.execute("SELECT value, latency FROM llm_archive WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.missed += 1
+                raise ReplayMiss(f"No recorded response for request {key}")
+            self.replayed += 1
+        value = json.loads(zlib.decompress(row[0]))
+        generations = [
+            ChatGeneration(
+                message=AIMessage(content=generation['content'], additional_kwargs=generation['additional_kwargs']),
+                generation_info=generation['generation_info'],
+            )
+            for generation in value['generations']
+        ]
+        llm_output = {**(value['llm_output'] or {}), 'replayed': True}
+        return ChatResult(generations=generations, llm_output=llm_output), row[1] * self.latency_scale
+
+    def stats(self) -> str:
+        if self.replaying:
+            return f"{self.replayed} responses replayed, {self.missed} requests not recorded, latency x{self.latency_scale}"
+        return f"{self.recorded} responses recorded into {self.path}"
+
+
+class ArchivedChatOpenAI(ChatOpenAI):
+    """ChatOpenAI that records its exchanges into an `LLMArchive` or replays them from it"""
+    archive: Any = None
+
+    def _archive_key(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: dict) -> str:
+        params = {
+            'model': self.model_name,
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens,
+            'n': self.n,
+            'stop': stop,
+            **self.model_kwargs,
+            **kwargs,
+        }
+        return self.archive.key(params, messages)
+
+    def _generate(self, messages, stop=None, run_manager=None, stream=None, **kwargs):
+        key = self._archive_key(messages, stop, kwargs)
+        if self.archive.replaying:
+            result, latency = self.archive.replay(key)
+            sleep(latency)
+            return result
+        start = monotonic()
+        result = super()._generate(messages, stop=stop, run_manager=run_manager, stream=stream, **kwargs)
+        self.archive.record(key, result, monotonic() - start)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, stream=None, **kwargs):
+        key = self._archive_key(messages, stop, kwargs)
+        if self.archive.replaying:
+            result, latency = self.archive.replay(key)
+            await asyncio.sleep(latency)
+            return result
+        start = monotonic()
+        result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, stream=stream, **kwargs)
+        self.archive.record(key, result, monotonic() - start)
+        return result
+
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        combined = super()._combine_llm_outputs(llm_outputs)
+        # lets the callbacks tell replayed responses from sent requests
+        if any(output and output.get('replayed') for output in llm_outputs):
+            combined['replayed'] = True
+        return combined
@@ -0,0 +1,274 @@
+"""Offline throughput benchmark of the whole pipeline.
+
+Runs stages 1-6 end to end against a local fake OpenAI server and an
+in-memory MongoDB substitute, for synthetic corpora of the given sizes, and
+reports articles/s, per call latency, peak RSS and token spend:
+
+    python -m bench.benchmark --sizes 1000 10000 --output bench.json
+    python -m bench.benchmark --sizes 1000 --baseline bench.json
+
+With `--baseline`, the exit status is 1 when a size got slower than the
+baseline by more than `--tolerance`. Each size runs in its own process so
+its peak RSS is its own; with the in-memory substitute the RSS includes the
+corpus and the published collections. The tokenizer must be available
+offline (a populated TIKTOKEN_CACHE_DIR) when there is no network.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime
+from queue import Empty
+from time import time
+
+import openai
+import requests
+from pymongo import MongoClient
+
+from analyzer import Analyzer
+from bench import fake_openai
+from bench.memory_mongo import MemoryClient
+from metrics import metrics
+from pipeline import pipeline_jobs
+from scheduler import Scheduler
+from store import RecordStore
+
+ARTICLE_COLLECTIONS = [
+    "lawandcrime",
+    "web3",
+    "entertainment",
+    "sport",
+    "artandfashion",
+    "bizandfinance",
+    "politics",
+    "scienceandtech",
+    "lifestyleandhealth",
+    "gaming",
+]
+
+_WORDS = (
+    "market government court player film company election study season policy league crypto token artist "
+    "fashion health research team council bank investor game studio minister police trial coach album "
+    "climate energy network startup museum festival patient hospital launch deal report budget protest"
+).split()
+
+
+def seed_articles(db, curDate: str, size: int, words: int, seed: int = 0):
+    """Insert `size` synthetic articles of about `words` words into the category collections"""
+    rng = random.Random(seed)
+    batches = {name: [] for name in ARTICLE_COLLECTIONS}
+    for i in range(size):
+        collection = ARTICLE_COLLECTIONS[i % len(ARTICLE_COLLECTIONS)]
+        headline = " ".join(rng.choice(_WORDS) for _ in range(4)) + f" {i}"
+        length = max(int(rng.gauss(words, words / 3)), 20)
+        body = " ".join(rng.choice(_WORDS) for _ in range(length))
+        batches[collection].append({
+            'article': f"Headline: {headline}.\n{body}.",
+            'siteName': f"site{i % 50}",
+            'link': f"https://news.example/{collection}/{i}",
+        })
+        if len(batches[collection]) >= 1000:
+            db[collection][curDate].insert_many(batches[collection])
+            batches[collection] = []
+    for collection, documents in batches.items():
+        if documents:
+            db[collection][curDate].insert_many(documents)
+
+
+def run_size(size: int, args: argparse.Namespace, api_base: str) -> dict:
+    """Run the whole pipeline over a synthetic corpus of `size` articles and return its measurements"""
+    workdir = tempfile.mkdtemp(prefix=f'bench_{size}_', dir=args.workdir)
+    keys_dir = os.path.join(workdir, 'keys')
+    os.makedirs(keys_dir)
+    with open(os.path.join(keys_dir, 'keys.txt'), 'w', encoding='utf-8') as keys_file:
+        keys_file.write("\n".join(bench_keys(args.keys)) + "\n")
+
+    # nothing goes to Discord, the real API or the LLM cache of real runs
+    os.environ['MODE'] = 'bench'
+    os.environ.setdefault('DISCORD_TOKEN', 'bench')
+    os.environ.setdefault('DISCORD_CHANNEL_ID', '0')
+    os.environ['OPENAI_API_BASE'] = api_base
+    os.environ['LLM_CACHE_PATH'] = os.path.join(workdir, 'llm_cache.sqlite')
+    os.environ['LLM_CACHE_BYPASS'] = '1'
+    os.environ['DEAD_LETTER_PATH'] = os.path.join(workdir, 'dead_letters.sqlite')
+    os.environ['RATE_LIMIT_RPM'] = str(args.rpm)
+    os.environ['RATE_LIMIT_TPM'] = str(args.tpm)
+    openai.api_base = api_base
+
+    # exact latency quantiles
+    metrics.samples = 10000
+    curDate = datetime.utcnow().date().isoformat()
+    client = MongoClient(args.mongo_url) if args.mongo_url else MemoryClient()
+    seed_articles(client["test"], curDate, size, args.article_words, args.seed)
+    server_before = requests.get(api_base.removesuffix('/v1') + '/stats').json()
+
+    anal = Analyzer(mongo_client=client, keys_dir=keys_dir)
+    jobs = pipeline_jobs(anal, curDate, workdir=workdir)
+    durations = {}
+    for job in jobs:
+        job.func = _timed(job.name, job.func, durations)
+    start_t = time()
+    status = Scheduler(jobs, max_jobs=int(os.environ.get("PIPELINE_MAX_JOBS", 6)), logger=anal.logger).run()
+    elapsed = time() - start_t
+
+    server_after = requests.get(api_base.removesuffix('/v1') + '/stats').json()
+    stage_1 = RecordStore(os.path.join(workdir, 'stage_1.jsonl'), 'stage_1')
+    summarized = sum(1 for _ in stage_1) if stage_1.exists() else 0
+    stage_1_seconds = durations.get('Stage 1', elapsed)
+    result = {
+        'size': size,
+        'seconds': elapsed,
+        'articles_per_second': size / elapsed,
+        'stage_1_articles_per_second': size / stage_1_seconds if stage_1_seconds else 0,
+        'summarized': summarized,
+        'jobs': {name: {'status': state, 'seconds': durations.get(name)} for name, state in status.items()},
+        'llm_calls': metrics.total('llm_requests_total'),
+        'latency_p50': metrics.quantile('llm_request_latency_seconds', 0.5),
+        'latency_p99': metrics.quantile('llm_request_latency_seconds', 0.99),
+        'prompt_tokens': metrics.total('llm_prompt_tokens_total'),
+        'completion_tokens': metrics.total('llm_completion_tokens_total'),
+        'cost_usd': metrics.total('llm_cost_usd_total'),
+        'retries': metrics.total('retries_total'),
+        'dead_letters': metrics.total('dead_letters_total'),
+        'key_states': dict(Counter(key['state'] for key in anal.key_health.states().values())),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'server': {
+            'requests': server_after['requests'] - server_before['requests'],
+            'prompt_tokens': server_after['prompt_tokens'] - server_before['prompt_tokens'],
+            'completion_tokens': server_after['completion_tokens'] - server_before['completion_tokens'],
+            'errors': {
+                code: count - server_before['errors'].get(code, 0)
+                for code, count in server_after['errors'].items()
+            },
+        },
+    }
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def bench_keys(count: int) -> list[str]:
+    return [f"sk-bench{i:040d}" for i in range(count)]
+
+
+def _timed(name: str, func, durations: dict):
+    def run(*args, **kwargs):
+        start_t = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            durations[name] = time() - start_t
+    return run
+
+
+def _run_child(size: int, args: argparse.Namespace, api_base: str, results):
+    try:
+        results.put(run_size(size, args, api_base))
+    except BaseException as er:
+        results.put({'size': size, 'error': repr(er)})
+        raise
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Sizes whose throughput dropped below the baseline by more than `tolerance`"""
+    previous = {result['size']: result for result in baseline if 'error' not in result}
+    regressions = []
+    for result in results:
+        before = previous.get(result['size'])
+        if before is None or 'error' in result:
+            continue
+        if result['articles_per_second'] < before['articles_per_second'] * (1 - tolerance):
+            regressions.append(
+                f"{result['size']} articles: {result['articles_per_second']:.2f} articles/s, "
+                f"baseline {before['articles_per_second']:.2f}"
+            )
+    return regressions
+
+
+def report(result: dict) -> str:
+    if 'error' in result:
+        return f"{result['size']:>7} articles  failed: {result['error']}"
+    return (
+        f"{result['size']:>7} articles  {result['seconds']:9.1f} s  {result['articles_per_second']:8.2f} articles/s  "
+        f"p50 {result['latency_p50']:.3f} s  p99 {result['latency_p99']:.3f} s  "
+        f"peak RSS {result['peak_rss_mb']:8.1f} MB  "
+        f"tokens {int(result['prompt_tokens'] + result['completion_tokens'])}  ${result['cost_usd']:.2f}"
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark against a fake OpenAI server")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="corpus sizes in articles")
+    parser.add_argument('--article-words', type=int, default=600, help="mean article length in words")
+    parser.add_argument('--keys', type=int, default=8, help="number of fake API keys")
+    parser.add_argument('--latency', default='lognormal:0.2,0.5', help="fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+    parser.add_argument('--latency-per-token', type=float, default=0.0, help="extra seconds per completion token")
+    parser.add_argument('--rate-limit-errors', type=float, default=0.0, help="fraction of requests answered with 429 rate_limit_exceeded")
+    parser.add_argument('--quota-keys', type=int, default=0, help="keys that always answer 429 insufficient_quota")
+    parser.add_argument('--auth-keys', type=int, default=0, help="keys that always answer 401")
+    parser.add_argument('--rpm', type=int, default=10000, help="requests per minute of each fake key")
+    parser.add_argument('--tpm', type=int, default=2000000, help="tokens per minute of each fake key")
+    parser.add_argument('--port', type=int, default=0, help="port of the fake server, a free one by default")
+    parser.add_argument('--mongo-url', default=None, help="use this throwaway MongoDB instead of the in-memory substitute")
+    parser.add_argument('--workdir', default=None, help="directory of the stage files of each run")
+    parser.add_argument('--keep', action='store_true', help="keep the stage files of each run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="write the results as JSON to this file")
+    parser.add_argument('--baseline', default=None, help="results of an earlier run to compare throughput against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed throughput drop against the baseline")
+    args = parser.parse_args(argv)
+
+    keys = bench_keys(args.keys)
+    # the failing keys come last, so some keys always work
+    failing = keys[len(keys) - args.quota_keys - args.auth_keys:]
+    server, api_base = fake_openai.start(
+        args.port,
+        latency=fake_openai.Latency(args.latency, args.latency_per_token),
+        rate_limit_errors=args.rate_limit_errors,
+        quota_keys=tuple(failing[:args.quota_keys]),
+        auth_keys=tuple(failing[args.quota_keys:]),
+        rpm=args.rpm,
+        tpm=args.tpm,
+        seed=args.seed,
+    )
+    context = multiprocessing.get_context('fork')
+    results = []
+    try:
+        for size in args.sizes:
+            queue = context.Queue()
+            child = context.Process(target=_run_child, args=(size, args, api_base, queue))
+            child.start()
+            result = None
+            while result is None:
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    if not child.is_alive():
+                        result = {'size': size, 'error': f"exited with {child.exitcode}"}
+            child.join()
+            results.append(result)
+            print(report(result), flush=True)
+    finally:
+        server.kill()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"Throughput regression - {regression}")
+        if regressions:
+            return 1
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import json
+import math
+import multiprocessing
+import random
+import re
+import socket
+from time import monotonic, sleep, time
+from typing import Optional
+
+from aiohttp import web
+
+from registry import registry
+
+CATEGORIES = [
+    "Law and Crime",
+    "Crypto/Web3",
+    "Entertainment",
+    "Sports",
+    "Art and Fashion",
+    "Business and Finance",
+    "Politics",
+    "Science and Technology",
+    "Lifestyle and Health",
+    "Gaming",
+]
+
+
+class Latency:
+    """Response time of the fake server: a distribution plus a time per completion token.
+
+    `spec` is `fixed:SECONDS`, `uniform:LOW,HIGH` or `lognormal:MEDIAN,SIGMA`.
+    """
+    kind: str
+    params: tuple[float, ...]
+    per_token: float
+
+    def __init__(self, spec: str, per_token: float = 0.0) -> None:
+        kind, _, params = spec.partition(':')
+        self.kind = kind
+        self.params = tuple(float(param) for param in params.split(',') if param)
+        self.per_token = per_token
+        expected = {'fixed': 1, 'uniform': 2, 'lognormal': 2}
+        if expected.get(kind) != len(self.params):
+            raise ValueError(f"Invalid latency {spec!r}, expected fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+
+    def sample(self, rng: random.Random, completion_tokens: int = 0) -> float:
+        if self.kind == 'fixed':
+            base = self.params[0]
+        elif self.kind == 'uniform':
+            base = rng.uniform(*self.params)
+        else:
+            median, sigma = self.params
+            base = median * math.exp(sigma * rng.gauss(0, 1))
+        return base + self.per_token * completion_tokens
+
+
+class FakeOpenAI:
+    """OpenAI compatible `/v1/chat/completions` endpoint that answers every stage prompt without a model.
+
+    The answer is picked from the output format each prompt asks for, in the
+    shape the stage parses, so a whole run goes through. Tokens are counted
+    with the tokenizer the pipeline uses and reported in `usage` and in the
+    `x-ratelimit-*` headers of each key's per minute budget; going over the
+    budget is answered with 429 the way the API does. On top of that, a
+    fraction of requests fails with a 429 `rate_limit_exceeded`, and the keys
+    in `quota_keys` and `auth_keys` always fail with `insufficient_quota` and
+    401, also on `GET /v1/files`, the request the key preflight sends (a quota
+    key only fails when it asks for tokens). `GET /stats` returns the request, error and token totals.
+    """
+    latency: Latency
+    rate_limit_errors: float
+    quota_keys: set[str]
+    auth_keys: set[str]
+    rpm: int
+    tpm: int
+
+    def __init__(
+            self,
+            latency: Latency,
+            rate_limit_errors: float = 0.0,
+            quota_keys: tuple = (),
+            auth_keys: tuple = (),
+            rpm: int = 10000,
+            tpm: int = 2000000,
+            seed: int = 0,
+        ) -> None:
+        self.latency = latency
+        self.rate_limit_errors = rate_limit_errors
+        self.quota_keys = set(quota_keys)
+        self.auth_keys = set(auth_keys)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rng = random.Random(seed)
+        self.windows = {}
+        self.stats = {'requests': 0, 'ok': 0, 'errors': {}, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self.chat)
+        app.router.add_get('/v1/files', self.files)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def _window(self, apikey: str) -> dict:
+        now = monotonic()
+        window = self.windows.get(apikey)
+        if window is None or now - window['start'] >= 60:
+            window = self.windows[apikey] = {'start': now, 'requests': 0, 'tokens': 0}
+        return window
+
+    def _headers(self, window: dict) -> dict:
+        reset = f"{max(60 - (monotonic() - window['start']), 0):.3f}s"
+        return {
+            'x-ratelimit-limit-requests': str(self.rpm),
+            'x-ratelimit-limit-tokens': str(self.tpm),
+            'x-ratelimit-remaining-requests': str(max(self.rpm - window['requests'], 0)),
+            'x-ratelimit-remaining-tokens': str(max(self.tpm - window['tokens'], 0)),
+            'x-ratelimit-reset-requests': reset,
+            'x-ratelimit-reset-tokens': reset,
+        }
+
+    def _error(self, status: int, kind: str, code: Optional[str], message: str, headers: Optional[dict] = None) -> web.Response:
+        self.stats['errors'][code or kind] = self.stats['errors'].get(code or kind, 0) + 1
+        body = {'error': {'message': message, 'type': kind, 'param': None, 'code': code}}
+        return web.json_response(body, status=status, headers=headers)
+
+    async def files(self, request: web.Request) -> web.Response:
+        apikey = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if apikey in self.auth_keys:
+            return self._error(401, 'invalid_request_error', 'invalid_api_key', 'Incorrect API key provided')
+        return web.json_response({'object': 'list', 'data': []})
+
+    async def chat(self, request: web.Request) -> web.Response:
+        self.stats['requests'] += 1
+        apikey = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        body = await request.json()
+        if apikey in self.auth_keys:
+            return self._error(401, 'invalid_request_error', 'invalid_api_key', 'Incorrect API key provided')
+        if apikey in self.quota_keys:
+            return self._error(429, 'insufficient_quota', 'insufficient_quota', 'You exceeded your current quota')
+
+        encoding = registry.encoding('gpt-3.5-turbo')
+        prompt = "\n".join(message['content'] for message in body['messages'])
+        prompt_tokens = sum(len(encoding.encode(message['content'])) + 4 for message in body['messages']) + 3
+        window = self._window(apikey)
+        if window['requests'] + 1 > self.rpm:
+            return self._error(429, 'requests', 'rate_limit_exceeded', 'Rate limit reached for requests', self._headers(window))
+        if window['tokens'] + prompt_tokens > self.tpm:
+            return self._error(429, 'tokens', 'rate_limit_exceeded', 'Rate limit reached for tokens', self._headers(window))
+        if self.rng.random() < self.rate_limit_errors:
+            return self._error(429, 'requests', 'rate_limit_exceeded', 'Rate limit reached for requests', self._headers(window))
+
+        content = respond(prompt)
+        completion_tokens = len(encoding.encode(content))
+        window['requests'] += 1
+        window['tokens'] += prompt_tokens + completion_tokens
+        await asyncio.sleep(self.latency.sample(self.rng, completion_tokens))
+        self.stats['ok'] += 1
+        self.stats['prompt_tokens'] += prompt_tokens
+        self.stats['completion_tokens'] += completion_tokens
+        return web.json_response({
+            'id': f"chatcmpl-{self.stats['requests']}",
+            'object': 'chat.completion',
+            'created': int(time()),
+            'model': body.get('model', 'gpt-3.5-turbo'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }, headers=self._headers(window))
+
+
+def _digest(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# synthetic articles start with a headline, the reduce step of long articles only sees the mapped titles
+_HEADLINE = re.compile(r'Headline: ([^.\n]+)')
+_TITLE = re.compile(r'Title: ([^.\n]+)')
+_ARTICLE = re.compile(r'^### Article (\d+) ###$', re.MULTILINE)
+
+
+def respond(prompt: str) -> str:
+    """Answer of the stage the prompt belongs to, recognised by the output format it asks for"""
+    if '###20 Primary###' in prompt:
+        return _categorize(prompt)
+    if '"1 day timeframe"' in prompt:
+        timeframes = ("1 day timeframe", "1 week timeframe", "1 month timeframe")
+        likelihoods = ("Most likely", "Possible", "Unlikely")
+        return json.dumps({
+            timeframe: {
+                likelihood: {"Description": f"{likelihood} development", "Explanation": "Explanation of the development"}
+                for likelihood in likelihoods
+            }
+            for timeframe in timeframes
+        })
+    if '"Historical Comparisons"' in prompt:
+        sections = ("Introduction", "Historical Context", "Key Players", "Underlying Motivations", "Recent Developments",
+                    "Impact", "Future Challenges", "Historical Comparisons", "Conclusion")
+        return json.dumps({section: f"{section} of the researched topic." for section in sections})
+    if 'Title 1 is the most relevant' in prompt:
+        titles = re.findall(r'^Title: (.+)$', prompt, re.MULTILINE)[:30]
+        return json.dumps([{"title": title, "explanation": "Relevant for its impact."} for title in titles])
+    if 'Developing Trend 1' in prompt:
+        return json.dumps({
+            "Developing Trend 1": "A developing trend",
+            "Explanation": "How the trend came to be.",
+            "Opportunities that may arise": "Opportunities",
+            "Potential Pitfalls": "Pitfalls",
+        })
+    if _ARTICLE.search(prompt):
+        # packed summarize request, one block per article
+        parts = _ARTICLE.split(prompt)
+        return "\n".join(f"### Article {number} ###\n{_summary(text)}" for number, text in zip(parts[1::2], parts[2::2]))
+    return _summary(prompt)
+
+
+def _summary(prompt: str) -> str:
+    match = _HEADLINE.search(prompt) or _TITLE.search(prompt)
+    title = match.group(1).strip() if match else f"Article {_digest(prompt) % 1000000}"
+    seed = _digest(title)
+    category = CATEGORIES[seed % len(CATEGORIES)]
+    scores = [1 + (seed >> shift) % 10 for shift in (8, 16, 24)]
+    return "\n".join([
+        f"Title: {title}",
+        f"Category: {category}",
+        f"Summary: {title} is reported. The article explains what happened. It also covers the reactions.",
+        f"Importance 1 day: {scores[0]}",
+        "Reasoning for 1 day score: It matters today.",
+        f"Importance 1 week: {scores[1]}",
+        "Reasoning for 1 week score: It matters this week.",
+        f"Importance 1 month: {scores[2]}",
+        "Reasoning for 1 month score: It matters this month.",
+    ])
+
+
+def _categorize(prompt: str) -> str:
+    primary_part, _, secondary_part = prompt.partition('###20 Primary###')[2].partition('###Secondary###')
+    primaries = [line.split(' ', 1)[1].strip() for line in primary_part.splitlines() if line[:1].isdigit() and ' ' in line]
+    secondaries = [line[2:].strip() for line in secondary_part.splitlines() if line.startswith('- ')]
+    topics = []
+    for i, primary in enumerate(primaries):
+        words = set(primary.lower().split())
+        group = [title for title in secondaries if words & set(title.lower().split())][:5]
+        if len(group) < 2:
+            # no title shares a word: pair it with some secondaries anyway
+            group += secondaries[i * 2:i * 2 + 2 - len(group)]
+        topics.append({"Primary": primary, "Secondary": group or [primary], "Title": [primary]})
+    return json.dumps(topics)
+
+
+def _serve(port: int, options: dict):
+    # the tokenizer and the server run in their own process so they do not load the benchmarked one
+    server = FakeOpenAI(**options)
+    web.run_app(server.app(), host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(port: int = 0, **options) -> tuple[multiprocessing.Process, str]:
+    """Run a `FakeOpenAI(**options)` in a child process and return it with its API base URL"""
+    port = port or free_port()
+    process = multiprocessing.get_context('fork').Process(target=_serve, args=(port, options), daemon=True)
+    process.start()
+    deadline = monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if monotonic() > deadline or not process.is_alive():
+                process.kill()
+                raise RuntimeError(f"Fake OpenAI server did not start on port {port}")
+            sleep(0.05)
+    return process, f"http://127.0.0.1:{port}/v1"
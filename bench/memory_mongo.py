@@ -0,0 +1,192 @@
+import copy
+import threading
+from typing import Any, Iterable, Optional
+
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+
+class MemoryCollection:
+    """In-memory stand-in for the parts of a pymongo `Collection` the pipeline uses.
+
+    Covers `find` with the filters stage 1 sends (equality, `$in`, `$nin` and
+    `$expr` comparisons of `$strLenCP`/`$ifNull`), unordered or ordered
+    `bulk_write` of InsertOne/ReplaceOne/UpdateOne (`$set`, `$addToSet`) with
+    upsert, `rename`, `drop` and document counts. Sub-collections are named
+    like pymongo's, `db["a"]["b"]` is the collection `a.b`.
+    """
+    name: str
+
+    def __init__(self, database: "MemoryDatabase", name: str) -> None:
+        self.database = database
+        self.name = name
+
+    @property
+    def documents(self) -> dict:
+        return self.database.collections.setdefault(self.name, {})
+
+    def __getitem__(self, name: str) -> "MemoryCollection":
+        return self.database[f"{self.name}.{name}"]
+
+    def insert_many(self, documents: Iterable[dict]):
+        with self.database.lock:
+            target = self.documents
+            for document in documents:
+                document = dict(document)
+                document.setdefault('_id', len(target))
+                target[document['_id']] = document
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None, batch_size: int = 0):
+        with self.database.lock:
+            # a snapshot, the way a cursor does not see most concurrent writes
+            documents = list(self.documents.values())
+        for document in documents:
+            if _matches(document, query or {}):
+                yield _project(document, projection)
+
+    def bulk_write(self, operations: list, ordered: bool = True):
+        errors = []
+        with self.database.lock:
+            target = self.documents
+            for index, operation in enumerate(operations):
+                try:
+                    _apply(target, operation)
+                except OperationFailure as er:
+                    errors.append({'index': index, 'code': er.code, 'errmsg': str(er)})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+    def estimated_document_count(self) -> int:
+        with self.database.lock:
+            return len(self.documents)
+
+    def count_documents(self, query: dict) -> int:
+        return sum(1 for _ in self.find(query))
+
+    def rename(self, new_name: str, dropTarget: bool = False):
+        with self.database.lock:
+            collections = self.database.collections
+            if new_name in collections and not dropTarget:
+                raise OperationFailure(f"target namespace exists: {new_name}", code=48)
+            collections[new_name] = collections.pop(self.name, {})
+
+    def drop(self):
+        with self.database.lock:
+            self.database.collections.pop(self.name, None)
+
+
+class MemoryDatabase:
+    name: str
+    collections: dict[str, dict[Any, dict]]
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.collections = {}
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return MemoryCollection(self, name)
+
+
+class MemoryClient:
+    """In-memory stand-in for `MongoClient`, for benchmarks that must not need a server"""
+
+    def __init__(self) -> None:
+        self.databases = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        with self.lock:
+            if name not in self.databases:
+                self.databases[name] = MemoryDatabase(name)
+            return self.databases[name]
+
+
+def _project(document: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return copy.deepcopy(document)
+    included = [field for field, flag in projection.items() if flag and field != '_id']
+    result = {field: copy.deepcopy(document[field]) for field in included if field in document}
+    if projection.get('_id', 1) and '_id' in document:
+        result['_id'] = document['_id']
+    return result
+
+
+def _matches(document: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        if field == '$expr':
+            if not _evaluate(document, condition):
+                return False
+        elif isinstance(condition, dict) and any(key.startswith('$') for key in condition):
+            value = document.get(field)
+            for operator, operand in condition.items():
+                if operator == '$in' and value not in operand:
+                    return False
+                if operator == '$nin' and value in operand:
+                    return False
+                if operator == '$ne' and value == operand:
+                    return False
+                if operator not in ('$in', '$nin', '$ne'):
+                    raise OperationFailure(f"unsupported query operator {operator}", code=2)
+        elif document.get(field) != condition:
+            return False
+    return True
+
+
+_COMPARE = {
+    '$gte': lambda a, b: a >= b,
+    '$gt': lambda a, b: a > b,
+    '$lte': lambda a, b: a <= b,
+    '$lt': lambda a, b: a < b,
+    '$eq': lambda a, b: a == b,
+}
+
+
+def _evaluate(document: dict, expression):
+    if isinstance(expression, str) and expression.startswith('$'):
+        return document.get(expression[1:])
+    if not isinstance(expression, dict):
+        return expression
+    (operator, operand), = expression.items()
+    if operator in _COMPARE:
+        left, right = (_evaluate(document, value) for value in operand)
+        return _COMPARE[operator](left, right)
+    if operator == '$strLenCP':
+        return len(_evaluate(document, operand))
+    if operator == '$ifNull':
+        value = _evaluate(document, operand[0])
+        return _evaluate(document, operand[1]) if value is None else value
+    raise OperationFailure(f"unsupported expression operator {operator}", code=2)
+
+
+def _apply(target: dict, operation):
+    if isinstance(operation, InsertOne):
+        document = dict(operation._doc)
+        if document.get('_id') in target:
+            raise OperationFailure("duplicate key", code=11000)
+        target[document.setdefault('_id', len(target))] = document
+        return
+    if not isinstance(operation, (ReplaceOne, UpdateOne)):
+        raise OperationFailure(f"unsupported write operation {type(operation).__name__}", code=2)
+    key = operation._filter.get('_id')
+    if set(operation._filter) != {'_id'}:
+        raise OperationFailure("only writes by _id are supported", code=2)
+    document = target.get(key)
+    if document is None and not operation._upsert:
+        return
+    if isinstance(operation, ReplaceOne):
+        target[key] = {'_id': key, **copy.deepcopy(operation._doc)}
+        return
+    document = target.setdefault(key, {'_id': key})
+    for operator, fields in operation._doc.items():
+        for field, value in fields.items():
+            if operator == '$set':
+                document[field] = copy.deepcopy(value)
+            elif operator == '$addToSet':
+                values = document.setdefault(field, [])
+                if value not in values:
+                    values.append(copy.deepcopy(value))
+            else:
+                raise OperationFailure(f"unsupported update operator {operator}", code=2)
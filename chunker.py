@@ -0,0 +1,44 @@
+from typing import Optional
+
+from langchain.docstore.document import Document
+
+from registry import registry
+
+
+def encode(text: str, model: str = 'gpt-3.5-turbo') -> list[int]:
+    return registry.encoding(model).encode(text)
+
+
+def split_tokens(text: str, tokens: list[int], chunk_size: int, model: str = 'gpt-3.5-turbo') -> list[Document]:
+    """Split `text` into documents of at most `chunk_size` tokens.
+
+    `tokens` is the encoding of `text`, so the text is never tokenized again:
+    a text that fits is kept whole, a longer one is cut into consecutive token
+    windows like TokenTextSplitter does. The token count of every document is
+    kept in its `tokens` metadata for the rate limiter.
+    """
+    if not text.strip():
+        return []
+    if len(tokens) <= chunk_size:
+        return [Document(page_content=text.strip(), metadata={'tokens': len(tokens)})]
+    encoding = registry.encoding(model)
+    return [
+        Document(page_content=encoding.decode(tokens[start:start + chunk_size]), metadata={'tokens': len(tokens[start:start + chunk_size])})
+        for start in range(0, len(tokens), chunk_size)
+    ]
+
+
+def split_text(
+        text: str,
+        chunk_size: int,
+        model: str = 'gpt-3.5-turbo',
+        token_count: Optional[int] = None,
+    ) -> list[Document]:
+    """Split `text` into documents of at most `chunk_size` tokens, encoding it at most once.
+
+    `token_count` is an upper bound of the tokens of `text` known from an
+    earlier stage; when it fits into one chunk the text is not encoded at all.
+    """
+    if token_count is not None and token_count <= chunk_size:
+        return [Document(page_content=text.strip(), metadata={'tokens': token_count})] if text.strip() else []
+    return split_tokens(text, encode(text, model), chunk_size, model)
@@ -0,0 +1,119 @@
+import re
+import unicodedata
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Optional
+
+from chunker import encode
+from registry import registry
+
+# lines of scraped pages that are not part of the article; anchored so that news about
+# cookies or Twitter is kept, only the site furniture itself matches
+BOILERPLATE = re.compile(
+    r"\b(we|this (site|website)) uses? cookies\b|\baccept (all )?cookies\b|\bcookie (policy|settings|preferences)\b"
+    r"|\b(sign up|subscribe) (for|to) (our|the) (free )?(daily |weekly )?newsletters?\b|\balready a subscriber\b"
+    r"|\ball rights reserved\b|\benable javascript\b|\b(log|sign) in to (continue|read|comment)\b|\bdownload (the|our) app\b"
+    r"|^(©|copyright\b)|^(advertisement|sponsored( content)?|skip to (main )?content|click here\b)"
+    r"|^(read more|continue reading|related( articles| stories| coverage)?|recommended( for you)?|most (read|popular)|trending( now)?)\b"
+    r"|^(share (this|on)|follow us)\b|^(facebook|twitter|x|linkedin|whatsapp|pinterest|email|print|comments?)$",
+    re.IGNORECASE,
+)
+# boilerplate is only looked for in lines up to this long, paragraphs are kept whatever they say
+BOILERPLATE_MAX_LENGTH = 200
+# shorter sentences (quotes like "No.") may repeat on purpose
+MIN_DEDUPLICATED_WORDS = 3
+
+# whitespace after a sentence end, possibly closed by a quote or bracket, before a capital letter or digit
+_SENTENCE_END = re.compile(r'(?:(?<=[.!?])|(?<=[.!?]["\'”’)\]]))\s+(?=["\'“‘(\[]?[A-Z0-9])')
+_INVISIBLE = re.compile(r'[​‌‍⁠﻿]')
+_SPACES = re.compile(r'[ \t\f\v]+')
+_KEY = re.compile(r'\W+')
+
+
+class CompressedArticle:
+    """Article text cleaned for the LLM, with its tokens and the token count of the original"""
+    text: str
+    tokens: list[int]
+    original_tokens: int
+
+    def __init__(self, text: str, tokens: list[int], original_tokens: int) -> None:
+        self.text = text
+        self.tokens = tokens
+        self.original_tokens = original_tokens
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.original_tokens - len(self.tokens)
+
+
+def clean(text: str) -> str:
+    """Drop boilerplate lines, menus and repeated sentences of a scraped article"""
+    text = _INVISIBLE.sub('', unicodedata.normalize('NFKC', text))
+    lines = [_SPACES.sub(' ', line).strip() for line in text.splitlines()]
+    lines = [line for line in lines if line and not _is_boilerplate(line)]
+    lines = _drop_menus(lines)
+
+    seen = set()
+    paragraphs = []
+    for line in lines:
+        sentences = []
+        for sentence in _SENTENCE_END.split(line):
+            key = _KEY.sub(' ', sentence).strip().lower()
+            if not key:
+                continue
+            if len(key.split()) >= MIN_DEDUPLICATED_WORDS:
+                # bylines, captions and paragraphs repeated by the page layout are kept once
+                if key in seen:
+                    continue
+                seen.add(key)
+            sentences.append(sentence)
+        if sentences:
+            paragraphs.append(' '.join(sentences))
+    return '\n'.join(paragraphs)
+
+
+def _is_boilerplate(line: str) -> bool:
+    return len(line) <= BOILERPLATE_MAX_LENGTH and BOILERPLATE.search(line) is not None
+
+
+def _is_menu_item(line: str) -> bool:
+    return len(line.split()) <= 3 and line[-1] not in '.!?:"\'”'
+
+
+def _drop_menus(lines: list[str]) -> list[str]:
+    # runs of three or more short unpunctuated lines are navigation, a single one may be a heading
+    kept = []
+    run = []
+    for line in lines + ['.']:
+        if _is_menu_item(line):
+            run.append(line)
+            continue
+        if len(run) < 3:
+            kept.extend(run)
+        run = []
+        kept.append(line)
+    return kept[:-1]
+
+
+def compress_article(text: str, token_budget: Optional[int] = None, model: str = 'gpt-3.5-turbo') -> CompressedArticle:
+    """Clean an article and cut it to at most `token_budget` tokens, at a sentence end when possible.
+
+    The cleaned text is encoded once and cut by slicing its tokens, so the
+    tokens always decode to the text; the original is only encoded when
+    cleaning changed it.
+    """
+    cleaned = clean(text) or text.strip()
+    tokens = encode(cleaned, model)
+    original_tokens = len(tokens) if cleaned == text else len(encode(text, model))
+    if token_budget and len(tokens) > token_budget:
+        encoding = registry.encoding(model)
+        tokens = tokens[:token_budget]
+        cut = encoding.decode_bytes(tokens)
+        end = max(cut.rfind(mark) for mark in (b'. ', b'! ', b'? ', b'.\n', b'!\n', b'?\n'))
+        # a cut in the middle of the last sentence is better than losing a large part of the budget
+        if end >= len(cut) * 0.8:
+            # byte offset where each token ends, the tokens up to the sentence end are kept
+            ends = list(accumulate(len(encoding.decode_single_token_bytes(token)) for token in tokens))
+            tokens = tokens[:bisect_right(ends, end + 1)]
+        cleaned = encoding.decode(tokens)
+    return CompressedArticle(cleaned, tokens, original_tokens)
@@ -0,0 +1,76 @@
+import hashlib
+import re
+from typing import Hashable, Optional
+
+import numpy as np
+
+_WORD = re.compile(r'\w+')
+
+
+def _digest(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little')
+
+
+class NearDuplicateIndex:
+    """MinHash LSH index of texts that finds near-duplicates of each new one.
+
+    Texts are reduced to their word `shingle`-grams and a MinHash signature of
+    `num_perm` hashes. Signatures are split into `bands`; texts sharing a band
+    are candidates, and a candidate is a duplicate when the signatures agree
+    on at least `threshold` of their hashes (the estimated Jaccard similarity
+    of the shingle sets). `signature` is thread safe and releases the GIL for
+    most of its work, `find_or_add` is not. With 32 bands of 4 rows, a pair with a similarity of
+    0.8 shares a band with a probability of more than 99.99%, one of 0.3 with
+    about 23%; those candidates are then ruled out by their signatures.
+    The first text of a cluster is its representative, so clusters are
+    the same on every run that adds the texts in the same order. Texts are
+    only compared with texts of the same `scope`, e.g. their category.
+    """
+    threshold: float
+    num_perm: int
+    bands: int
+    shingle: int
+    signatures: dict[Hashable, np.ndarray]
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, bands: int = 32, shingle: int = 5, seed: int = 1) -> None:
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing: odd multipliers, arithmetic wraps around at 2**64, the high 32 bits are kept
+        self.a = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) << np.uint64(1) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64)
+        self.signatures = {}
+        self.buckets = [{} for _ in range(bands)]
+
+    def signature(self, text: str) -> np.ndarray:
+        words = _WORD.findall(text.lower())
+        size = min(self.shingle, max(len(words), 1))
+        # hash() is salted per process, the signatures must be the same on every run
+        shingles = {_digest(' '.join(words[i:i + size])) for i in range(max(len(words) - size + 1, 1))}
+        hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        return ((self.a * hashes + self.b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+    def find_or_add(self, key: Hashable, signature: np.ndarray, scope: Hashable = None) -> Optional[Hashable]:
+        """Key of an indexed near-duplicate in `scope` of the text with `signature`, or None after indexing it under `key`"""
+        bands = [(scope, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        checked = set()
+        for bucket, band in zip(self.buckets, bands):
+            for candidate in bucket.get(band, ()):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                if np.count_nonzero(self.signatures[candidate] == signature) >= self.threshold * self.num_perm:
+                    return candidate
+        # only texts without a duplicate are indexed, every cluster is found through its first text
+        self.signatures[key] = signature
+        for bucket, band in zip(self.buckets, bands):
+            bucket.setdefault(band, []).append(key)
+        return None
+
+    def __len__(self) -> int:
+        return len(self.signatures)
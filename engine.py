@@ -0,0 +1,200 @@
+import asyncio
+import threading
+import traceback
+from time import monotonic
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+import openai
+
+from keyhealth import KeyRegistry
+from metrics import WAIT_BUCKETS, key_label, metrics
+from ratelimit import RateLimiter
+from retry import Retry
+
+
+class LLMEngine:
+    """Asyncio dispatcher that keeps a fixed number of LLM requests in flight per API key.
+
+    All runs share one event loop in a background thread, so concurrent runs
+    from different threads (e.g. several pipeline jobs) share the per key
+    request slots instead of multiplying them.
+    """
+    apikeys: list[str]
+    per_key: int
+    max_pending: int
+    limiter: Optional[RateLimiter]
+    key_health: Optional[KeyRegistry]
+
+    def __init__(
+            self,
+            apikeys: list[str],
+            per_key: int = 2,
+            max_pending: int = 1000,
+            limiter: Optional[RateLimiter] = None,
+            key_health: Optional[KeyRegistry] = None,
+        ) -> None:
+        # the list is shared with the owner, so keys removed there stop their workers here
+        self.apikeys = apikeys
+        self.per_key = max(per_key, 1)
+        self.max_pending = max(max_pending, 1)
+        self.limiter = limiter
+        # keys back from probation or retired by other processes are picked up when a run starts
+        self.key_health = key_health
+        self.loop = None
+        self.loop_lock = threading.Lock()
+        # in flight requests per key, across all runs
+        self.key_slots = {}
+
+    def _loop(self) -> asyncio.AbstractEventLoop:
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='LLMEngine', daemon=True).start()
+            return self.loop
+
+    def _key_slot(self, apikey: str) -> asyncio.Semaphore:
+        # only called from the engine loop
+        if apikey not in self.key_slots:
+            self.key_slots[apikey] = asyncio.Semaphore(self.per_key)
+        return self.key_slots[apikey]
+
+    def run(
+            self,
+            items: Iterable[tuple],
+            handler: Callable[..., Awaitable[Any]],
+            on_result: Callable[[Any], Optional[tuple]],
+        ) -> bool:
+        """Run `handler(apikey, *item)` for every item.
+
+        `items` may be a lazy iterator, e.g. over a database cursor: it is
+        consumed in a background thread and blocks once `max_pending` items
+        are waiting or in flight. `on_result` is called as soon as each
+        result is available; if it returns an item, that item is re-queued
+        right away, a `retry.Retry` is re-queued after its delay without
+        holding a key slot. Blocks until every item is finished; may be called from
+        several threads at once. Returns False if items were left unprocessed
+        because no valid API key was left.
+        """
+        return asyncio.run_coroutine_threadsafe(self._run(items, handler, on_result), self._loop()).result()
+
+    def call(self, apikey: str, call: Callable[[str], Any]) -> Any:
+        """Result of the blocking `call(apikey)`, made while holding one of the key's request slots.
+
+        Synchronous stages call the LLM through here, so their requests count
+        against the same per key limit as those of the runs.
+        """
+        return asyncio.run_coroutine_threadsafe(self._call(apikey, call), self._loop()).result()
+
+    async def _call(self, apikey: str, call: Callable[[str], Any]) -> Any:
+        async with self._key_slot(apikey):
+            return await asyncio.get_running_loop().run_in_executor(None, call, apikey)
+
+    async def _run(self, items, handler, on_result):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        # one slot per item that was read but is not finished yet
+        slots = asyncio.Semaphore(self.max_pending)
+        stopped = threading.Event()
+
+        async def feed(item):
+            await slots.acquire()
+            queue.put_nowait((monotonic(), item))
+
+        def produce():
+            for item in items:
+                if stopped.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(feed(item), loop).result()
+
+        async def drain():
+            await loop.run_in_executor(None, produce)
+            await queue.join()
+
+        session = None
+        if self.limiter is not None:
+            # let the limiter see the rate limit headers of every response
+            session = self.limiter.aiosession()
+            openai.aiosession.set(session)
+
+        if self.key_health is not None:
+            self.key_health.sync(self.apikeys)
+        # retries waiting for their delay
+        timers = set()
+        workers = {
+            asyncio.create_task(self._worker(apikey, queue, slots, handler, on_result, timers))
+            for apikey in list(self.apikeys)
+            for _ in range(self.per_key)
+        }
+        done_task = asyncio.create_task(drain())
+        try:
+            while not done_task.done():
+                done, _ = await asyncio.wait(workers | {done_task}, return_when=asyncio.FIRST_COMPLETED)
+                workers -= done
+                if not workers and not done_task.done():
+                    # every key was retired while items were still waiting
+                    print(f"LLMEngine - no valid API keys left, {queue.qsize()} items were not processed")
+                    return False
+            # surface errors raised while reading the items
+            done_task.result()
+            return True
+        finally:
+            stopped.set()
+            done_task.cancel()
+            for task in workers | timers:
+                task.cancel()
+            await asyncio.gather(done_task, *workers, *timers, return_exceptions=True)
+            if session is not None:
+                openai.aiosession.set(None)
+                await session.close()
+
+    async def _worker(self, apikey, queue: asyncio.Queue, slots: asyncio.Semaphore, handler, on_result, timers: set):
+        while True:
+            queued_at, item = await queue.get()
+            finished = True
+            delayed = False
+            try:
+                if apikey not in self.apikeys:
+                    # key was retired, hand the item to another worker
+                    finished = False
+                    queue.put_nowait((queued_at, item))
+                    return
+                metrics.observe('queue_wait_seconds', monotonic() - queued_at, WAIT_BUCKETS)
+                async with self._key_slot(apikey):
+                    result = await handler(apikey, *item)
+                retry = on_result(result)
+                if retry is not None:
+                    finished = False
+                    if not isinstance(retry, Retry):
+                        # a Retrier counts the retries it decides
+                        metrics.inc('retries_total', key=key_label(apikey), error=_error_class(result))
+                    if isinstance(retry, Retry) and retry.delay > 0:
+                        delayed = True
+                        timer = asyncio.create_task(_requeue_later(queue, retry))
+                        timers.add(timer)
+                        timer.add_done_callback(timers.discard)
+                    else:
+                        queue.put_nowait((monotonic(), retry.item if isinstance(retry, Retry) else retry))
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if finished:
+                    slots.release()
+                if not delayed:
+                    queue.task_done()
+
+
+async def _requeue_later(queue: asyncio.Queue, retry: Retry):
+    await asyncio.sleep(retry.delay)
+    queue.put_nowait((monotonic(), retry.item))
+    # the item was never done, so the run does not end while it waits
+    queue.task_done()
+
+
+def _error_class(result) -> str:
+    # handlers report failures as [exception or key, marker, *item]
+    if isinstance(result, (list, tuple)) and result:
+        if isinstance(result[0], BaseException):
+            return type(result[0]).__name__
+        if len(result) > 1 and isinstance(result[1], str):
+            return result[1]
+    return 'unknown'
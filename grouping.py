@@ -0,0 +1,135 @@
+import re
+from typing import Optional
+
+import numpy as np
+
+from resolver import normalize_title
+
+_WORD = re.compile(r'\w+')
+# words that tie titles together without being about the same news
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have he her his how in into is it its new of on or over says she than that
+the their they this to up vs was what when who why will with after amid about more out not no
+""".split())
+
+
+class TopicGrouper:
+    """Groups secondary titles under primary titles without the LLM.
+
+    Titles are vectors of TF-IDF weighted words (and noun chunks, given a spaCy
+    pipeline as `nlp`), with document frequencies taken over the titles being
+    grouped. A secondary goes to the primary with the highest cosine
+    similarity when it reaches `threshold` and beats the runner-up by
+    `margin`; when two primaries are that close it is ambiguous and left to the
+    caller. A primary gets at most `max_secondaries` titles, the most similar
+    ones, the limit the categorize prompt gives the LLM. Titles below the
+    threshold and those over the limit are unmatched and also left to the
+    caller. The result only depends on the titles and their order.
+
+    The "Title" of a topic is its primary title: the LLM makes up a title
+    for the group, nothing downstream reads it, stage 3 researches the
+    "Primary".
+    """
+    threshold: float
+    margin: float
+    max_secondaries: int
+
+    def __init__(self, threshold: float = 0.3, margin: float = 0.05, max_secondaries: int = 5, nlp=None) -> None:
+        self.threshold = threshold
+        self.margin = margin
+        self.max_secondaries = max_secondaries
+        self.nlp = nlp
+
+    def _terms(self, titles: list[str]) -> list[list[str]]:
+        terms = [[word for word in _WORD.findall(title.lower()) if word not in STOPWORDS] for title in titles]
+        if self.nlp is not None:
+            for title_terms, doc in zip(terms, self.nlp.pipe(titles)):
+                # multiword chunks count on top of their words
+                title_terms.extend(chunk.lemma_.lower() for chunk in doc.noun_chunks if ' ' in chunk.text.strip())
+        return terms
+
+    def vectors(self, titles: list[str]) -> np.ndarray:
+        """L2 normalized TF-IDF vectors of `titles`, one row each"""
+        terms = self._terms(titles)
+        vocabulary = {term: i for i, term in enumerate(sorted({term for title_terms in terms for term in title_terms}))}
+        counts = np.zeros((len(titles), max(len(vocabulary), 1)), dtype=np.float32)
+        for row, title_terms in enumerate(terms):
+            for term in title_terms:
+                counts[row, vocabulary[term]] += 1
+        frequency = np.count_nonzero(counts, axis=0)
+        idf = np.log((1 + len(titles)) / (1 + frequency)) + 1
+        weights = counts * idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        return weights / np.where(norms == 0, 1, norms)
+
+    def group(self, primaries: list[str], secondaries: list[str]) -> tuple[list[dict], list[str], list[str]]:
+        """Topics in the format of the categorize answer, the ambiguous secondaries and the unmatched ones.
+
+        Every primary is a topic and the first title of its own "Secondary",
+        so stage 3 always researches its article. Secondaries with the same
+        normalized title as a primary or an earlier secondary are neither.
+        """
+        topics = [{"Primary": primary, "Secondary": [primary], "Title": primary} for primary in primaries]
+        if not primaries or not secondaries:
+            seen = {normalize_title(primary) for primary in primaries}
+            unmatched = []
+            for secondary in secondaries:
+                key = normalize_title(secondary)
+                if key not in seen:
+                    seen.add(key)
+                    unmatched.append(secondary)
+            return topics, [], unmatched
+        vectors = self.vectors(primaries + secondaries)
+        similarity = vectors[len(primaries):] @ vectors[:len(primaries)].T
+        # most similar primary first, ties broken by the primary order
+        order = np.argsort(-similarity, axis=1, kind='stable')
+        best = similarity[np.arange(len(secondaries)), order[:, 0]]
+        runner_up = similarity[np.arange(len(secondaries)), order[:, 1]] if len(primaries) > 1 else np.zeros(len(secondaries))
+
+        ambiguous = []
+        unmatched = []
+        assigned = [[] for _ in primaries]
+        seen = {normalize_title(primary) for primary in primaries}
+        for index, secondary in enumerate(secondaries):
+            key = normalize_title(secondary)
+            if key in seen:
+                continue
+            seen.add(key)
+            if best[index] < self.threshold:
+                unmatched.append(index)
+            elif best[index] - runner_up[index] < self.margin:
+                ambiguous.append(secondary)
+            else:
+                assigned[order[index, 0]].append((-best[index], index))
+        for topic, candidates in zip(topics, assigned):
+            candidates.sort()
+            topic["Secondary"].extend(secondaries[index] for _, index in candidates[:self.max_secondaries])
+            unmatched.extend(index for _, index in candidates[self.max_secondaries:])
+        return topics, ambiguous, [secondaries[index] for index in sorted(unmatched)]
+
+    def merge(self, topics: list[dict], grouped: list[dict], titles: list[str]) -> int:
+        """Add the `titles` the LLM grouped in `grouped` to `topics`, returns how many were added"""
+        by_primary = {normalize_title(topic["Primary"]): topic for topic in topics}
+        titles = {normalize_title(title): title for title in titles}
+        added = 0
+        for group in grouped:
+            if not isinstance(group, dict):
+                continue
+            topic: Optional[dict] = by_primary.get(normalize_title(str(group.get("Primary", ""))))
+            if topic is None:
+                continue
+            for title in group.get("Secondary") or []:
+                title = titles.pop(normalize_title(str(title)), None)
+                if title is None:
+                    continue
+                if len(topic["Secondary"]) > self.max_secondaries:
+                    break
+                topic["Secondary"].append(title)
+                added += 1
+        return added
+
+
+def noun_chunker(model: str):
+    """spaCy pipeline of `model` for the noun chunks of titles"""
+    import spacy
+    return spacy.load(model, disable=['ner'])
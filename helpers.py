@@ -1,11 +1,26 @@
+import hashlib
+import openai
 import requests
 import re
 
-def openai_apikey_info(apikey: str):
-    response = requests.get('https://api.openai.com/v1/files', headers={'Authorization': f"Bearer {apikey}"})
-    return response.headers['Openai-Ratelimit-Remaining']
-    # for header, value in response.headers.items():
-    #     print(header + ": " + value)
+def openai_apikey_info(apikey: str, api_base: str = None, timeout: float = 10):
+    """Status, headers and error of a request with `apikey` that costs no tokens"""
+    response = requests.get(
+        f"{api_base or openai.api_base}/files",
+        headers={'Authorization': f"Bearer {apikey}"},
+        timeout=timeout,
+    )
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    error = body.get('error') if isinstance(body, dict) else None
+    return response.status_code, response.headers, error if isinstance(error, dict) else {}
 
 def remove_non_numbers_regex(input_string):
-    return re.sub(r'\D', '', input_string)
\ No newline at end of file
+    return re.sub(r'\D', '', input_string)
+
+def article_fingerprint(link: str, content: str):
+    # an article is the same only if both its link and its content are unchanged
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{link}\n{content_hash}".encode('utf-8')).hexdigest()
@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Callable, Optional
+
+import requests
+
+from helpers import openai_apikey_info
+from metrics import key_label, metrics
+from ratelimit import reset_after
+
+HEALTHY = 'healthy'
+# rate limited, usable again once `until` has passed
+THROTTLED = 'throttled'
+# failed with a key error, on probation until `until` and then tried again
+QUARANTINED = 'quarantined'
+# rejected by the preflight probe, only a later successful probe brings it back
+DEAD = 'dead'
+STATES = (HEALTHY, THROTTLED, QUARANTINED, DEAD)
+
+
+class KeyRegistry:
+    """Health of the API keys, shared by every process that opens the same database file.
+
+    Every key is in one of `STATES`. A transition reads and updates the key's
+    row in one immediate transaction, so workers retiring the same key at the
+    same time agree on its state and count the failure once. Quarantined keys
+    are not deleted: they are on probation for `probation * 2**(failures - 1)`
+    seconds, at most `max_probation`, and usable again after that. A key
+    rate limited at runtime is throttled until its rate limit windows reset
+    and healthy again after its next successful call.
+    """
+    path: str
+    keys: list[str]
+    probation: float
+    max_probation: float
+
+    def __init__(self, path: str, keys: list[str], probation: float = 600, max_probation: float = 86400) -> None:
+        self.path = path
+        self.keys = list(keys)
+        self.probation = probation
+        self.max_probation = max_probation
+        self.lock = threading.Lock()
+        # keys this process throttled, released by their next successful call
+        self.throttled = set()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # other processes hold the write lock for a moment at most
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS api_keys ("
+            "key TEXT PRIMARY KEY, state TEXT NOT NULL, until REAL NOT NULL, "
+            "failures INTEGER NOT NULL, reason TEXT, updated REAL NOT NULL)"
+        )
+        with self.lock:
+            # known keys keep the state other runs left them in
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO api_keys (key, state, until, failures, updated) VALUES (?, ?, 0, 0, ?)",
+                [(key, HEALTHY, time()) for key in self.keys],
+            )
+
+    def _transition(self, key: str, change: Callable[[str, float, int, float], Optional[tuple[str, float, int]]], reason: Optional[str]) -> bool:
+        """Apply `change(state, until, failures, now)`, which returns the new (state, until, failures) or None to keep them"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time()
+                row = self.conn.execute("SELECT state, until, failures FROM api_keys WHERE key = ?", (key,)).fetchone()
+                new = change(*(row or (HEALTHY, 0, 0)), now)
+                if new is not None:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO api_keys (key, state, until, failures, reason, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, *new, reason, now),
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if new is not None:
+            metrics.inc('api_key_transitions_total', key=key_label(key), state=new[0])
+        return new is not None
+
+    def release(self, key: str) -> bool:
+        """Mark a key that works as healthy, unless it is still on probation"""
+        def change(state, until, failures, now):
+            if state == QUARANTINED and until > now:
+                return None
+            if state == HEALTHY and not failures:
+                return None
+            # a key that was only throttled or dead owes nothing, a quarantined one keeps its record
+            return HEALTHY, 0, failures if state == QUARANTINED else 0
+        return self._transition(key, change, None)
+
+    def throttle(self, key: str, seconds: float, reason: str = 'rate limited') -> bool:
+        """Take a key out of use for `seconds`"""
+        def change(state, until, failures, now):
+            if state in (QUARANTINED, DEAD) and until > now:
+                return None
+            return THROTTLED, max(until if state == THROTTLED else 0, now + seconds), failures
+        self.throttled.add(key)
+        return self._transition(key, change, reason)
+
+    def answered(self, key: str):
+        """Note a successful call with the key, which ends its throttling"""
+        # every call succeeds with some key, only those that were throttled cost a write
+        if key in self.throttled:
+            self.throttled.discard(key)
+            self.release(key)
+
+    def quarantine(self, key: str, reason: str = 'invalid key') -> bool:
+        """Put a key on probation, twice as long as the last time; False if it already is"""
+        def change(state, until, failures, now):
+            if state in (QUARANTINED, DEAD) and until > now:
+                # another worker got there first
+                return None
+            return QUARANTINED, now + min(self.probation * 2 ** failures, self.max_probation), failures + 1
+        return self._transition(key, change, reason)
+
+    def kill(self, key: str, reason: str = 'invalid key') -> bool:
+        """Take a key out of use until a probe finds it working"""
+        def change(state, until, failures, now):
+            return None if state == DEAD else (DEAD, float('inf'), failures + 1)
+        return self._transition(key, change, reason)
+
+    def states(self) -> dict[str, dict]:
+        """State, end of probation or throttling, failures and reason of every key"""
+        with self.lock:
+            rows = self.conn.execute("SELECT key, state, until, failures, reason FROM api_keys").fetchall()
+        return {row[0]: {'state': row[1], 'until': row[2], 'failures': row[3], 'reason': row[4]} for row in rows}
+
+    def usable(self) -> list[str]:
+        """Healthy keys and keys whose throttling or probation is over, in the order they were given"""
+        now = time()
+        states = self.states()
+        return [
+            key for key in self.keys
+            if key in states and (states[key]['state'] == HEALTHY or states[key]['until'] <= now)
+        ]
+
+    def sync(self, apikeys: list[str]) -> list[str]:
+        """Update the shared `apikeys` list in place to the usable keys, as other workers left them.
+
+        Keys already in the list stay while they are throttled: their
+        workers wait for the rate limiter instead of stopping for the run.
+        """
+        now = time()
+        states = self.states()
+        keys = [
+            key for key in self.keys
+            if key in states and (
+                states[key]['state'] == HEALTHY or states[key]['until'] <= now
+                or (states[key]['state'] == THROTTLED and key in apikeys)
+            )
+        ]
+        if keys != apikeys:
+            apikeys[:] = keys
+        return apikeys
+
+    def preflight(self, probe: Callable[[str], Optional[tuple[str, float, str]]] = None, max_workers: int = 16) -> dict[str, str]:
+        """Probe every key concurrently and record what was found, returns the state of each key.
+
+        `probe(key)` returns the (state, seconds, reason) it found, or None
+        when it could not tell, e.g. because the API was not reachable.
+        """
+        probe = probe or probe_key
+        with ThreadPoolExecutor(max_workers=max(min(max_workers, len(self.keys)), 1)) as executor:
+            found = list(executor.map(probe, self.keys))
+        for key, result in zip(self.keys, found):
+            if result is None:
+                continue
+            state, seconds, reason = result
+            if state == HEALTHY:
+                self.release(key)
+            elif state == THROTTLED:
+                self.throttle(key, seconds, reason)
+            elif state == QUARANTINED:
+                self.quarantine(key, reason)
+            else:
+                self.kill(key, reason)
+        states = self.states()
+        return {key: states[key]['state'] for key in self.keys}
+
+
+def probe_key(apikey: str) -> Optional[tuple[str, float, str]]:
+    """State of a key by a request that costs no tokens, None when the answer says nothing about the key"""
+    try:
+        status, headers, error = openai_apikey_info(apikey)
+    except requests.RequestException:
+        return None
+    if status == 200:
+        return HEALTHY, 0, None
+    reason = error.get('code') or error.get('type') or f"HTTP {status}"
+    if status == 401:
+        return DEAD, 0, reason
+    if status == 403 or (status == 429 and error.get('type') == 'insufficient_quota'):
+        return QUARANTINED, 0, reason
+    if status == 429:
+        return THROTTLED, reset_after(headers), reason
+    return None
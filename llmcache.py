@@ -0,0 +1,117 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from time import time
+from typing import Optional
+
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema import Generation
+from langchain.schema.cache import RETURN_VAL_TYPE, BaseCache
+
+
+class LLMCache(BaseCache):
+    """Content-addressed on-disk cache for LLM calls with size-bounded LRU eviction.
+
+    Entries are keyed by a hash of the LLM parameters (model name, temperature,
+    max_tokens, ...) and the fully rendered prompt. With `bypass` set, lookups
+    always miss but fresh results are still written, which refreshes the cache.
+    """
+    path: str
+    max_bytes: int
+    bypass: bool
+    hits: int
+    misses: int
+
+    def __init__(self, path: str, max_bytes: int, bypass: bool = False) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if self.bypass:
+            self.misses += 1
+            return None
+        key = self.key(prompt, llm_string)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (time(), key))
+            self.hits += 1
+        try:
+            return [loads(value) for value in _split(row[0])]
+        except Exception:
+            return [Generation(text=value) for value in _split(row[0])]
+
+    def contains(self, prompt: str, llm_string: str) -> bool:
+        """Whether a lookup would hit, without counting it or touching the entry"""
+        if self.bypass:
+            return False
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM llm_cache WHERE key = ?", (self.key(prompt, llm_string),)).fetchone() is not None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self.key(prompt, llm_string)
+        value = _join([dumps(generation) for generation in return_val])
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, size, time()),
+            )
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # drop the least recently used entries until the cache is back under 90% of its budget
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.conn.executemany("DELETE FROM llm_cache WHERE key = ?", evicted)
+
+    def clear(self, **kwargs) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache")
+            self.size = 0
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({ratio:.1f}% hit rate), {self.size / 1024 / 1024:.1f} MB on disk"
+
+
+# generations of one call are stored in a single row
+_SEPARATOR = "\x1e"
+
+def _join(values: list[str]) -> str:
+    return _SEPARATOR.join(values)
+
+def _split(value: str) -> list[str]:
+    return value.split(_SEPARATOR)
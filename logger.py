@@ -1,12 +1,29 @@
-import requests
+import atexit
 import os
+import queue
+import threading
+from time import monotonic, sleep
+
+import requests
 from dotenv import load_dotenv, find_dotenv
 
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+
 class Logger:
+    """Logs to stdout (dev mode) and a Discord channel without blocking the caller.
+
+    `log` only puts the message on a bounded queue. A background thread
+    coalesces queued messages into posts of up to MESSAGE_LIMIT characters,
+    sent through one pooled HTTP session, and waits as long as Discord asks
+    when it answers 429. Messages still queued are sent when the process exits.
+    """
     dscd_url: str
     dscd_headers: dict[str: str]
+    progress_interval: float
+    dropped: int
 
-    def __init__(self):
+    def __init__(self, max_queue: int = 10000, progress_interval: float = None):
         load_dotenv(find_dotenv())
         token = os.environ["DISCORD_TOKEN"]
         channel_id = os.environ["DISCORD_CHANNEL_ID"]
@@ -14,28 +31,115 @@ class Logger:
         self.dscd_headers = {
             "Authorization": f"Bot {token}",
             "Content-Type": "application/json"
-        }   
-    
+        }
+        if progress_interval is None:
+            progress_interval = float(os.environ.get("LOG_PROGRESS_INTERVAL", 10))
+        self.progress_interval = progress_interval
+        self.last_progress = {}
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.session = requests.Session()
+        self.session.headers.update(self.dscd_headers)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='Logger', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
     def log(self, content):
         mode = os.environ["MODE"]
+        if mode == "dev":
+            print(content)
+        if mode in ("dev", "prod") and not self.closed:
+            try:
+                self.queue.put_nowait(str(content))
+            except queue.Full:
+                # never block the pipeline on Discord
+                self.dropped += 1
+
+    def progress(self, content, key: str):
+        """Log a per item progress line; Discord gets at most one per `key` every `progress_interval` seconds"""
+        now = monotonic()
+        if now - self.last_progress.get(key, float('-inf')) >= self.progress_interval:
+            self.last_progress[key] = now
+            self.log(content)
+        elif os.environ["MODE"] == "dev":
+            print(content)
+
+    def flush(self):
+        """Wait until every queued message was sent"""
+        self.queue.join()
+
+    def close(self, timeout: float = 30):
+        if self.closed:
+            return
+        self.closed = True
         try:
-            if mode == "dev":
-                print(content)
-                data = {
-                    "content": content
-                }
-                response = requests.post(self.dscd_url, headers=self.dscd_headers, json=data)
-                if response.status_code != 200:
-                    print(f"Failed to send discord message. Status code: {response.status_code}")
-                    print(response.json())
-        
-            elif mode == "prod":
-                data = {
-                    "content": content
-                }
-                response = requests.post(self.dscd_url, headers=self.dscd_headers, json=data)
-                if response.status_code != 200:
-                    print(f"Failed to send discord message. Status code: {response.status_code}")
-                    print(response.json())
-        except Exception as er:
-            print(er)
\ No newline at end of file
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        if self.dropped:
+            print(f"Logger - {self.dropped} messages were dropped because the queue was full")
+
+    def _run(self):
+        while True:
+            message = self.queue.get()
+            stop = message is None
+            batch = [] if stop else [message]
+            # coalesce whatever else is waiting into as few posts as possible
+            while not stop:
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    stop = True
+                else:
+                    batch.append(message)
+            for content in _pack(batch):
+                self._post(content)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def _post(self, content: str, attempts: int = 5):
+        for _ in range(attempts):
+            try:
+                response = self.session.post(self.dscd_url, json={"content": content}, timeout=10)
+            except Exception as er:
+                print(er)
+                return
+            if response.status_code == 429:
+                sleep(_retry_after(response))
+                continue
+            if response.status_code != 200:
+                print(f"Failed to send discord message. Status code: {response.status_code}")
+                print(response.text)
+            return
+
+
+def _retry_after(response) -> float:
+    try:
+        return float(response.json()["retry_after"])
+    except Exception:
+        return float(response.headers.get("Retry-After", 1))
+
+
+def _pack(messages: list[str]) -> list[str]:
+    """Join messages with newlines into as few pieces of at most MESSAGE_LIMIT characters as possible"""
+    posts = []
+    current = ""
+    for message in messages:
+        # a single message above the limit is split
+        pieces = [message[i:i + MESSAGE_LIMIT] for i in range(0, len(message), MESSAGE_LIMIT)] or [""]
+        for piece in pieces:
+            if current and len(current) + 1 + len(piece) <= MESSAGE_LIMIT:
+                current += "\n" + piece
+            else:
+                if current:
+                    posts.append(current)
+                current = piece
+    if current:
+        posts.append(current)
+    return posts
@@ -0,0 +1,261 @@
+import contextvars
+import json
+import os
+import random
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Any, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.openai_info import get_openai_token_cost_for_model
+
+PREFIX = "article_analyzer_"
+
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# stage and timeframe of the job the current code runs for, see Metrics.scope
+_scope: contextvars.ContextVar[dict] = contextvars.ContextVar('metrics_scope', default={})
+
+
+def key_label(apikey: str) -> str:
+    """Last characters of an API key, enough to tell keys apart without exporting them"""
+    return f"...{apikey[-4:]}" if apikey else ""
+
+
+class Histogram:
+    """Bucket counts of observed values, plus a uniform sample of up to `samples` of them for exact quantiles"""
+    buckets: tuple
+    counts: list[int]
+    sum: float
+    count: int
+    samples: list[float]
+
+    def __init__(self, buckets: tuple, samples: int = 0) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.max_samples = samples
+        self.samples = []
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        elif self.max_samples:
+            # reservoir sampling keeps every value with the same probability
+            i = random.randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = value
+
+
+def quantile(histograms: list[Histogram], q: float) -> float:
+    """`q` quantile of the values observed by the histograms, interpolated within buckets if they keep no samples"""
+    samples = sorted(value for histogram in histograms for value in histogram.samples)
+    if samples:
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+    count = sum(histogram.count for histogram in histograms)
+    if not count:
+        return 0.0
+    buckets = histograms[0].buckets
+    counts = [sum(histogram.counts[i] for histogram in histograms) for i in range(len(buckets))]
+    rank = q * count
+    lower, below = 0.0, 0
+    for bound, cumulative in zip(buckets, counts):
+        if cumulative >= rank:
+            return lower + (bound - lower) * (rank - below) / max(cumulative - below, 1)
+        lower, below = bound, cumulative
+    # above the last bucket, the way Prometheus' histogram_quantile answers
+    return buckets[-1]
+
+
+class Metrics:
+    """Counters and histograms of one run, labelled by stage, timeframe, model and key.
+
+    Stage and timeframe come from the `scope` the code runs in, so the LLM
+    callbacks and the engine do not need to know which job they work for.
+    """
+    counters: dict[tuple, float]
+    histograms: dict[tuple, Histogram]
+    samples: int
+
+    def __init__(self, samples: int = 0) -> None:
+        self.counters = {}
+        self.histograms = {}
+        # values each histogram keeps for exact quantiles, see Histogram
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.started = datetime.now(timezone.utc)
+
+    @contextmanager
+    def scope(self, **labels: str):
+        """Add `labels` to every metric recorded inside the block, in this thread and the tasks it starts"""
+        token = _scope.set({**_scope.get(), **labels})
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+
+    def _labels(self, labels: dict) -> tuple:
+        scope = _scope.get()
+        merged = {'stage': scope.get('stage', ''), 'timeframe': scope.get('timeframe', ''), **labels}
+        return tuple(sorted(merged.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels: str):
+        key = (name, self._labels(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets, self.samples)
+            self.histograms[key].observe(value)
+
+    def total(self, name: str) -> float:
+        """Sum of a counter over all of its labels"""
+        with self.lock:
+            return sum(value for (metric, _), value in self.counters.items() if metric == name)
+
+    def quantile(self, name: str, q: float) -> float:
+        """`q` quantile of a histogram over all of its labels"""
+        with self.lock:
+            return quantile([histogram for (metric, _), histogram in self.histograms.items() if metric == name], q)
+
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """Run summary with the totals per stage and every labelled metric"""
+        by_stage = {}
+        counters = {}
+        histograms = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                labels = dict(labels)
+                counters.setdefault(name, []).append({'labels': labels, 'value': value})
+                stage = f"{labels['stage']} {labels['timeframe']}".strip() or 'other'
+                totals = by_stage.setdefault(stage, {})
+                totals[name] = totals.get(name, 0) + value
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                histograms.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'mean': histogram.sum / histogram.count if histogram.count else 0,
+                    'p50': quantile([histogram], 0.5),
+                    'p99': quantile([histogram], 0.99),
+                    'buckets': dict(zip(map(str, histogram.buckets), histogram.counts)),
+                })
+        return {
+            'started': self.started.isoformat(),
+            'finished': datetime.now(timezone.utc).isoformat(),
+            'stages': by_stage,
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    def export(self, textfile: Optional[str] = None, summary_file: Optional[str] = None):
+        """Write the Prometheus textfile and the JSON run summary, each replaced atomically"""
+        if textfile:
+            _write_atomic(textfile, self.prometheus())
+        if summary_file:
+            _write_atomic(summary_file, json.dumps(self.summary(), indent=2))
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _write_atomic(path: str, content: str):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        file.write(content)
+    os.replace(path + '.tmp', path)
+
+
+class MetricsCallback(BaseCallbackHandler):
+    """Records requests, tokens, cost, latency and errors of every chat request sent with a key.
+
+    Latency is measured from the start of the request as seen by the chain,
+    so it includes rate limiter waits; those are also recorded on their own.
+    """
+    run_inline = True
+
+    def __init__(self, metrics: Metrics, apikey: str) -> None:
+        self.metrics = metrics
+        self.key = key_label(apikey)
+        self.starts = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, invocation_params: Optional[dict] = None, **kwargs: Any):
+        params = invocation_params or {}
+        self.starts[run_id] = (monotonic(), params.get('model') or params.get('model_name') or '')
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        start, model = self.starts.pop(run_id, (monotonic(), ''))
+        output = response.llm_output or {}
+        model = output.get('model_name') or model
+        usage = output.get('token_usage')
+        if not usage:
+            # answered from the LLM cache
+            self.metrics.inc('llm_requests_total', model=model, key=self.key, status='cached')
+            return
+        # replayed from an LLMArchive: the tokens were paid for by the recorded run
+        replayed = output.get('replayed', False)
+        self.metrics.inc('llm_requests_total', model=model, key=self.key, status='replayed' if replayed else 'ok')
+        self.metrics.observe('llm_request_latency_seconds', monotonic() - start, model=model, key=self.key)
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        completion_tokens = usage.get('completion_tokens', 0)
+        self.metrics.inc('llm_prompt_tokens_total', prompt_tokens, model=model, key=self.key)
+        self.metrics.inc('llm_completion_tokens_total', completion_tokens, model=model, key=self.key)
+        if replayed:
+            return
+        try:
+            cost = get_openai_token_cost_for_model(model, prompt_tokens) + \
+                get_openai_token_cost_for_model(model, completion_tokens, is_completion=True)
+            self.metrics.inc('llm_cost_usd_total', cost, model=model, key=self.key)
+        except ValueError:
+            pass
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        start, model = self.starts.pop(run_id, (monotonic(), ''))
+        self.metrics.inc('llm_requests_total', model=model, key=self.key, status='error')
+        self.metrics.inc('llm_errors_total', model=model, key=self.key, error=type(error).__name__)
+        self.metrics.observe('llm_request_latency_seconds', monotonic() - start, model=model, key=self.key)
+
+
+metrics = Metrics()
@@ -0,0 +1,122 @@
+import queue
+import threading
+from typing import Any, Callable, Optional
+
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+
+# duplicate key error of two upserts of a new _id racing in one unordered batch
+_DUPLICATE_KEY = 11000
+
+
+class CollectionSink:
+    """Streams stage results into a dated MongoDB collection while the stage runs.
+
+    `to_operation` turns a stage record into a write operation keyed by a
+    stable `_id` (ReplaceOne/UpdateOne with upsert), so writing a record twice
+    is harmless. Operations are sent as unordered bulk writes of `batch_size`
+    into a staging collection, which `publish()` renames over the live one in
+    a single step: readers see the previous or the new results, never an
+    empty or half written collection.
+
+    `write` is called from the stage callbacks on the engine's event loop, so
+    the bulk writes run on a writer thread fed by a queue of at most
+    `max_batches` batches; a caller only waits when Mongo is that far behind.
+    `publish()` waits for every batch and raises the first write error.
+    """
+    target: Any
+    staging: Any
+    batch_size: int
+    written: int
+    error: Optional[BaseException]
+
+    def __init__(
+            self,
+            db: Database,
+            name: str,
+            curDate: str,
+            to_operation: Callable[[dict], Any],
+            batch_size: int = 500,
+            resume: bool = False,
+            max_batches: int = 4,
+        ) -> None:
+        self.db = db
+        self.target = db[name][curDate]
+        self.staging = db[name][f"{curDate}_staging"]
+        self.to_operation = to_operation
+        self.batch_size = max(batch_size, 1)
+        self.written = 0
+        self.error = None
+        self.pending = []
+        if not resume:
+            # left over by an interrupted run
+            self.staging.drop()
+        self.queue = queue.Queue(maxsize=max(max_batches, 1))
+        self.thread = threading.Thread(target=self._run, name='CollectionSink', daemon=True)
+        self.thread.start()
+
+    def write(self, record: dict):
+        self.pending.append(self.to_operation(record))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Hand the pending operations to the writer thread"""
+        if self.error is not None:
+            raise self.error
+        if not self.pending:
+            return
+        operations, self.pending = self.pending, []
+        self.queue.put(operations)
+
+    def join(self):
+        """Wait until every written record is in the staging collection"""
+        self.flush()
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Write what is pending and stop the writer thread"""
+        try:
+            self.join()
+        finally:
+            if self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join()
+
+    def _run(self):
+        while True:
+            operations = self.queue.get()
+            try:
+                if operations is None:
+                    return
+                # after an error the batches are dropped, the stage fails when it publishes
+                if self.error is None:
+                    self._bulk_write(operations)
+            except BaseException as er:
+                self.error = er
+            finally:
+                self.queue.task_done()
+
+    def _bulk_write(self, operations: list):
+        try:
+            self.staging.bulk_write(operations, ordered=False)
+        except BulkWriteError as er:
+            errors = er.details.get('writeErrors', [])
+            if any(error['code'] != _DUPLICATE_KEY for error in errors):
+                raise
+            # the document exists now, so the upserts become plain updates
+            self.staging.bulk_write([operations[error['index']] for error in errors], ordered=True)
+        self.written += len(operations)
+
+    def publish(self) -> int:
+        """Replace the live collection with the staging one and return its document count"""
+        self.close()
+        count = self.staging.estimated_document_count()
+        if count:
+            self.staging.rename(self.target.name, dropTarget=True)
+        else:
+            # nothing was staged: the stage produced no results
+            self.target.drop()
+        return count
@@ -0,0 +1,46 @@
+import os
+
+from analyzer import Analyzer
+from scheduler import Job
+from table import TIMEFRAMES
+
+
+def pipeline_jobs(anal: Analyzer, curDate: str, resume: bool = False, workdir: str = '') -> list[Job]:
+    """Every stage of a run with the files it reads and writes.
+
+    Each stage streams its results into its dated collection while it runs.
+    The stage files are kept in `workdir`, the current directory by default.
+    """
+    def path(name: str) -> str:
+        return os.path.join(workdir, name)
+
+    stage_1 = path('stage_1.jsonl')
+    jobs = [
+        Job('Stage 1', anal.stage_1, (stage_1, curDate), outputs=[stage_1],
+            kwargs={'resume': resume, 'collection': 'analyzed_articles'}, labels={'stage': 'stage_1'}),
+    ]
+    for timeframe in TIMEFRAMES:
+        stage_2 = path(f'stage_2_{timeframe}.jsonl')
+        stage_3 = path(f'stage_3_{timeframe}.jsonl')
+        stage_4 = path(f'stage_4_{timeframe}.jsonl')
+        stage_5 = path(f'stage_5_{timeframe}.jsonl')
+        stage_6 = path(f'stage_6_{timeframe}.jsonl')
+        jobs += [
+            Job(f'Stage 2 {timeframe}', anal.stage_2, (stage_1, stage_2, timeframe), inputs=[stage_1], outputs=[stage_2],
+                kwargs={'resume': resume, 'collection': f'category_{timeframe}', 'curDate': curDate},
+                labels={'stage': 'stage_2', 'timeframe': timeframe}),
+            Job(f'Stage 3 {timeframe}', anal.stage_3, (stage_2, stage_1, stage_3), inputs=[stage_2, stage_1], outputs=[stage_3],
+                kwargs={'resume': resume, 'collection': f'extra_research_{timeframe}', 'curDate': curDate},
+                labels={'stage': 'stage_3', 'timeframe': timeframe}),
+            Job(f'Stage 4 {timeframe}', anal.stage_4, (stage_3, stage_4), inputs=[stage_3], outputs=[stage_4],
+                kwargs={'resume': resume, 'collection': f'deep_research_{timeframe}', 'curDate': curDate},
+                labels={'stage': 'stage_4', 'timeframe': timeframe}),
+            # stage 5 only reads stage 1
+            Job(f'Stage 5 {timeframe}', anal.stage_5, (stage_1, stage_5, timeframe), inputs=[stage_1], outputs=[stage_5],
+                kwargs={'collection': f'impactful-new-{timeframe}', 'curDate': curDate},
+                labels={'stage': 'stage_5', 'timeframe': timeframe}),
+            Job(f'Stage 6 {timeframe}', anal.stage_6, (stage_4, stage_6, timeframe), inputs=[stage_4], outputs=[stage_6],
+                kwargs={'resume': resume, 'collection': f'prediction-{timeframe}', 'curDate': curDate},
+                labels={'stage': 'stage_6', 'timeframe': timeframe}),
+        ]
+    return jobs
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import re
+import threading
+from functools import lru_cache
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Any, Optional
+
+import aiohttp
+import langchain
+import requests
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.load.dump import dumps
+from openai.error import RateLimitError
+
+from metrics import WAIT_BUCKETS, key_label, metrics
+from registry import registry
+
+if TYPE_CHECKING:
+    from keyhealth import KeyRegistry
+
+# context size used to estimate the completion when a chain does not set max_tokens
+MODEL_CONTEXT = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+}
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_reset(value: str) -> float:
+    """Parse OpenAI reset durations like `1s`, `6m0s` or `20ms` into seconds"""
+    return sum(float(amount) * _UNITS[unit] for amount, unit in _DURATION.findall(value or ''))
+
+
+def reset_after(headers, default: float = 20) -> float:
+    """Seconds until both rate limit windows of a 429 response have room again"""
+    resets = [parse_reset(headers.get(f'x-ratelimit-reset-{kind}')) for kind in ('requests', 'tokens')] if headers else []
+    return max(resets, default=0) or default
+
+
+class Bucket:
+    """Token bucket that may go into debt; callers wait until the debt is refilled"""
+    capacity: float
+    level: float
+    rate: float
+    updated: float
+
+    def __init__(self, capacity: float, period: float = 60) -> None:
+        self.capacity = capacity
+        self.level = capacity
+        self.rate = capacity / period
+        self.updated = monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, amount: float, now: float) -> float:
+        """Take `amount` from the bucket and return the seconds to wait before using it"""
+        self.refill(now)
+        # a single request bigger than the bucket must still be able to go through
+        amount = min(amount, self.capacity)
+        self.level -= amount
+        return 0 if self.level >= 0 else -self.level / self.rate
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], reset: Optional[float], in_flight: float, now: float):
+        """Align the bucket with the limit, remaining and reset values reported by the API"""
+        self.refill(now)
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            # the server has not seen the calls that are still in flight
+            self.level = min(remaining, self.capacity) - in_flight
+            if reset and remaining < self.capacity:
+                # the bucket is back to full `reset` seconds from now
+                self.rate = (self.capacity - remaining) / reset
+
+
+class RateLimiter:
+    """Per API key request and token buckets fed by OpenAI `x-ratelimit-*` headers"""
+    rpm: int
+    tpm: int
+    buckets: dict[str, tuple[Bucket, Bucket]]
+    in_flight: dict[str, list[float]]
+    responses: dict[str, list]
+    key_health: Optional['KeyRegistry']
+
+    def __init__(self, apikeys: list[str], rpm: int = 3500, tpm: int = 90000, key_health: Optional['KeyRegistry'] = None) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        # told about rate limited keys and the calls that succeed, so other workers and processes see them
+        self.key_health = key_health
+        self.buckets = {}
+        self.in_flight = {}
+        # latest response headers of each key and how many answered calls are still to be released
+        self.responses = {}
+        self.lock = threading.Lock()
+        for apikey in apikeys:
+            self._buckets(apikey)
+
+    def _buckets(self, apikey: str) -> tuple[Bucket, Bucket]:
+        if apikey not in self.buckets:
+            self.buckets[apikey] = (Bucket(self.rpm), Bucket(self.tpm))
+            self.in_flight[apikey] = [0, 0]
+        return self.buckets[apikey]
+
+    def reserve(self, apikey: str, tokens: int, requests: int = 1) -> float:
+        """Charge a call to the key and return how long to wait before sending it"""
+        with self.lock:
+            now = monotonic()
+            request_bucket, token_bucket = self._buckets(apikey)
+            self.in_flight[apikey][0] += requests
+            self.in_flight[apikey][1] += tokens
+            return max(request_bucket.charge(requests, now), token_bucket.charge(tokens, now))
+
+    def release(self, apikey: str, tokens: int, requests: int = 1):
+        """Mark a reserved call as answered by the API, and sync the key from the headers of its response"""
+        with self.lock:
+            in_flight = self.in_flight.get(apikey)
+            if in_flight:
+                in_flight[0] = max(in_flight[0] - requests, 0)
+                in_flight[1] = max(in_flight[1] - tokens, 0)
+            response = self.responses.get(apikey)
+            if response is not None:
+                # the server's remaining values already count this call, so it is no longer in flight
+                self._sync(apikey, response[0], monotonic())
+                response[1] -= 1
+                if response[1] <= 0:
+                    del self.responses[apikey]
+
+    async def acquire(self, apikey: str, tokens: int, requests: int = 1):
+        wait = self.reserve(apikey, tokens, requests)
+        if wait > 0:
+            metrics.observe('rate_limit_wait_seconds', wait, WAIT_BUCKETS, key=key_label(apikey))
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, apikey: str, tokens: int, requests: int = 1):
+        wait = self.reserve(apikey, tokens, requests)
+        if wait > 0:
+            metrics.observe('rate_limit_wait_seconds', wait, WAIT_BUCKETS, key=key_label(apikey))
+            sleep(wait)
+
+    def update(self, apikey: str, headers):
+        """Refill the key's buckets from the rate limit headers of an API response whose call is released"""
+        if not headers or 'x-ratelimit-remaining-requests' not in headers:
+            return
+        with self.lock:
+            self._sync(apikey, headers, monotonic())
+
+    def report(self, apikey: str, headers):
+        """Keep the rate limit headers of a response until the call it answers is released"""
+        if not headers or 'x-ratelimit-remaining-requests' not in headers:
+            return
+        with self.lock:
+            # the latest headers count every call answered before, each release syncs from them
+            count = self.responses[apikey][1] if apikey in self.responses else 0
+            self.responses[apikey] = [headers, count + 1]
+
+    def _sync(self, apikey: str, headers, now: float):
+        request_bucket, token_bucket = self._buckets(apikey)
+        in_flight = self.in_flight[apikey]
+        for bucket, kind, pending in ((request_bucket, 'requests', in_flight[0]), (token_bucket, 'tokens', in_flight[1])):
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            reset = headers.get(f'x-ratelimit-reset-{kind}')
+            bucket.sync(
+                float(limit) if limit else None,
+                float(remaining) if remaining else None,
+                parse_reset(reset) if reset else None,
+                pending,
+                now,
+            )
+
+    def answered(self, apikey: str):
+        """Note a successful call with the key"""
+        if self.key_health is not None:
+            self.key_health.answered(apikey)
+
+    def failed(self, apikey: str, error: BaseException):
+        """Refill the key's buckets from the headers of a failed call, and throttle it on a 429"""
+        headers = getattr(error, 'headers', None)
+        self.update(apikey, headers)
+        if self.key_health is not None and isinstance(error, RateLimitError) and getattr(error, 'code', None) == 'rate_limit_exceeded':
+            self.key_health.throttle(apikey, reset_after(headers))
+
+    def update_from_response(self, request_headers, response_headers):
+        # the response hooks run before the callbacks release the call
+        authorization = request_headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            self.report(authorization[len('Bearer '):], response_headers)
+
+    def session(self) -> requests.Session:
+        """requests session for `openai.requestssession` that reports headers back to the limiter"""
+        session = requests.Session()
+
+        def hook(response, *args, **kwargs):
+            self.update_from_response(response.request.headers, response.headers)
+        session.hooks['response'].append(hook)
+        return session
+
+    def aiosession(self) -> aiohttp.ClientSession:
+        """aiohttp session for `openai.aiosession` that reports headers back to the limiter"""
+        async def on_request_end(session, context, params):
+            self.update_from_response(params.headers, params.response.headers)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return aiohttp.ClientSession(trace_configs=[trace_config])
+
+
+def _estimate(messages, invocation_params: dict, token_counts: Optional[dict[str, int]] = None) -> int:
+    """Prompt tokens of the messages plus the completion tokens the request may use.
+
+    `token_counts` are the known token counts of texts in the prompt, like the
+    documents of a chain; only the rest of the prompt is counted here.
+    """
+    model = invocation_params.get('model') or invocation_params.get('model_name') or 'gpt-3.5-turbo'
+    # every message carries a few tokens of chat formatting
+    prompt_tokens = sum(_message_tokens(message.content, token_counts) + 4 for batch in messages for message in batch)
+    max_tokens = invocation_params.get('max_tokens')
+    if max_tokens is None:
+        max_tokens = max(MODEL_CONTEXT.get(model, 4096) - prompt_tokens, 0)
+    return prompt_tokens + max_tokens
+
+
+def _message_tokens(content: str, token_counts: Optional[dict[str, int]]) -> int:
+    tokens = 0
+    for text, count in (token_counts or {}).items():
+        if text and text in content:
+            content = content.replace(text, '', 1)
+            tokens += count
+    return tokens + _text_tokens(content)
+
+
+@lru_cache(maxsize=1024)
+def _text_tokens(text: str) -> int:
+    # what is left is mostly the static part of a prompt, the same on every call of a stage
+    return len(registry.encoding('gpt-3.5-turbo').encode(text))
+
+
+def _cached(serialized: dict, messages, options: Optional[dict]) -> bool:
+    """Whether langchain answers the request from `langchain.llm_cache` without sending it.
+
+    The callbacks run before langchain looks the request up; the cache key is
+    rebuilt the way `BaseChatModel._get_llm_string` builds it for chat models.
+    """
+    cache = langchain.llm_cache
+    if cache is None or not hasattr(cache, 'contains') or len(messages) != 1:
+        return False
+    params = {'stop': None, **(options or {})}
+    llm_string = json.dumps(serialized) + "---" + str(sorted(params.items()))
+    return cache.contains(dumps(messages[0]), llm_string)
+
+
+class RateLimitCallback(BaseCallbackHandler):
+    """Blocks each chat request of a chain until its key has request and token budget"""
+    raise_error = True
+
+    def __init__(self, limiter: RateLimiter, apikey: str, token_counts: Optional[dict[str, int]] = None) -> None:
+        self.limiter = limiter
+        self.apikey = apikey
+        # known token counts of texts in the prompts, see _estimate
+        self.token_counts = token_counts
+        self.charges = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, invocation_params: Optional[dict] = None, **kwargs: Any):
+        if _cached(serialized, messages, kwargs.get('options')):
+            # nothing is sent, nothing is charged
+            return
+        self.charges[run_id] = _estimate(messages, invocation_params or {}, self.token_counts)
+        self.limiter.acquire_sync(self.apikey, self.charges[run_id])
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any):
+        if run_id in self.charges:
+            self.limiter.release(self.apikey, self.charges.pop(run_id))
+            self.limiter.answered(self.apikey)
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs: Any):
+        if run_id in self.charges:
+            self.limiter.release(self.apikey, self.charges.pop(run_id))
+        # 429 responses carry the same headers as successful ones
+        self.limiter.failed(self.apikey, error)
+
+
+class AsyncRateLimitCallback(AsyncCallbackHandler):
+    """Async twin of `RateLimitCallback`, waits without blocking the event loop"""
+    raise_error = True
+
+    def __init__(self, limiter: RateLimiter, apikey: str, token_counts: Optional[dict[str, int]] = None) -> None:
+        self.limiter = limiter
+        self.apikey = apikey
+        # known token counts of texts in the prompts, see _estimate
+        self.token_counts = token_counts
+        self.charges = {}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, invocation_params: Optional[dict] = None, **kwargs: Any):
+        if _cached(serialized, messages, kwargs.get('options')):
+            return
+        self.charges[run_id] = _estimate(messages, invocation_params or {}, self.token_counts)
+        await self.limiter.acquire(self.apikey, self.charges[run_id])
+
+    async def on_llm_end(self, response, *, run_id, **kwargs: Any):
+        if run_id in self.charges:
+            self.limiter.release(self.apikey, self.charges.pop(run_id))
+            self.limiter.answered(self.apikey)
+
+    async def on_llm_error(self, error: BaseException, *, run_id, **kwargs: Any):
+        if run_id in self.charges:
+            self.limiter.release(self.apikey, self.charges.pop(run_id))
+        self.limiter.failed(self.apikey, error)
@@ -0,0 +1,49 @@
+import threading
+from typing import Any, Callable, Hashable
+
+import tiktoken
+from langchain.prompts import load_prompt
+from langchain.schema.prompt_template import BasePromptTemplate
+
+PROMPT_DIR = "./prompts"
+
+
+class StageRegistry:
+    """Per-process cache of everything the stage functions build before calling the LLM.
+
+    Prompts are loaded and compiled once, tiktoken encodings and the token
+    counts of the static part of every prompt are computed once, and chains are
+    built once per API key, model and `max_tokens` and then reused: they hold
+    no state between runs, callbacks are passed to every run instead.
+    """
+    prompt_dir: str
+
+    def __init__(self, prompt_dir: str = PROMPT_DIR) -> None:
+        self.prompt_dir = prompt_dir
+        self.entries = {}
+        self.lock = threading.RLock()
+
+    def get(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        """Cached value for `key`, built with `build()` on first use"""
+        try:
+            return self.entries[key]
+        except KeyError:
+            pass
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = build()
+            return self.entries[key]
+
+    def prompt(self, name: str) -> BasePromptTemplate:
+        """Prompt loaded from `<prompt_dir>/<name>.yaml`"""
+        return self.get(('prompt', name), lambda: load_prompt(f"{self.prompt_dir}/{name}.yaml"))
+
+    def encoding(self, model: str = 'gpt-3.5-turbo') -> tiktoken.Encoding:
+        return self.get(('encoding', model), lambda: tiktoken.encoding_for_model(model))
+
+    def token_count(self, key: Hashable, text: Callable[[], str], model: str = 'gpt-3.5-turbo') -> int:
+        """Cached token count of a static text such as a prompt rendered without its documents"""
+        return self.get(('tokens', model, key), lambda: len(self.encoding(model).encode(text())))
+
+
+registry = StageRegistry()
@@ -0,0 +1,83 @@
+import math
+import re
+from collections import Counter
+from typing import Optional
+
+_NON_WORD = re.compile(r'[^\w\s]')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_title(title: str) -> str:
+    return _SPACES.sub(' ', _NON_WORD.sub('', title.lower())).strip()
+
+
+class TitleResolver:
+    """Maps titles returned by the LLM back to stage 1 rows.
+
+    Titles are first looked up exactly after normalization (case, punctuation
+    and spacing). Otherwise the title with the highest Jaccard similarity of
+    character n-grams above `threshold` wins; candidates come from an inverted
+    n-gram index with prefix filtering, so only a few titles are compared.
+    """
+    threshold: float
+    n: int
+    exact: int
+    fuzzy: int
+    missed: int
+
+    def __init__(self, titles: list[str], threshold: float = 0.6, n: int = 3) -> None:
+        self.threshold = threshold
+        self.n = n
+        self.exact = 0
+        self.fuzzy = 0
+        self.missed = 0
+        # first row of every normalized title
+        self.rows = {}
+        for row, title in enumerate(titles):
+            if title:
+                self.rows.setdefault(normalize_title(title), row)
+        self.keys = list(self.rows)
+        self.grams = [self._grams(key) for key in self.keys]
+        self.frequency = Counter(gram for grams in self.grams for gram in grams)
+        self.postings = {}
+        for position, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+
+    def _grams(self, text: str) -> frozenset:
+        padded = f" {text} "
+        return frozenset(padded[i:i + self.n] for i in range(max(len(padded) - self.n + 1, 1)))
+
+    def resolve(self, title: str) -> Optional[int]:
+        """Row of the stage 1 title matching `title`, or None"""
+        key = normalize_title(title or '')
+        row = self.rows.get(key)
+        if row is not None:
+            self.exact += 1
+            return row
+        position = self._closest(key) if key else None
+        if position is None:
+            self.missed += 1
+            return None
+        self.fuzzy += 1
+        return self.rows[self.keys[position]]
+
+    def _closest(self, key: str) -> Optional[int]:
+        grams = self._grams(key)
+        # any title with Jaccard >= threshold shares one of the rarest `prefix` grams of the query
+        prefix = len(grams) - math.ceil(self.threshold * len(grams)) + 1
+        rarest = sorted(grams, key=lambda gram: (self.frequency.get(gram, 0), gram))[:prefix]
+        candidates = {position for gram in rarest for position in self.postings.get(gram, ())}
+        best, best_score = None, self.threshold
+        for position in candidates:
+            other = self.grams[position]
+            if not self.threshold * len(grams) <= len(other) <= len(grams) / self.threshold:
+                continue
+            shared = len(grams & other)
+            score = shared / (len(grams) + len(other) - shared)
+            if score > best_score or (score == best_score and (best is None or position < best)):
+                best, best_score = position, score
+        return best
+
+    def stats(self) -> str:
+        return f"{self.exact} exact, {self.fuzzy} fuzzy, {self.missed} unresolved titles"
@@ -0,0 +1,229 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+from time import sleep, time
+from typing import Any, Callable, Hashable, NamedTuple, Optional
+
+from openai.error import (APIConnectionError, APIError, AuthenticationError,
+                          InvalidRequestError, PermissionError, RateLimitError,
+                          ServiceUnavailableError, Timeout, TryAgain)
+
+from archive import ReplayMiss
+from metrics import metrics
+from structured import OutputError
+
+
+class RetryPolicy:
+    """How often an error class is retried and how long to wait before each retry.
+
+    Waits are drawn uniformly between 0 and `base * 2**attempt` seconds, at most
+    `cap` (full jitter). `retire_key` errors are the key's fault, not the
+    item's; `budgeted` ones count against the retry budget of the run.
+    """
+    attempts: int
+    base: float
+    cap: float
+    retire_key: bool
+    budgeted: bool
+
+    def __init__(self, attempts: int, base: float = 0.0, cap: float = 60.0, retire_key: bool = False, budgeted: bool = True) -> None:
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.retire_key = retire_key
+        self.budgeted = budgeted
+
+    def delay(self, attempt: int, rng: random.Random) -> float:
+        return rng.uniform(0, min(self.cap, self.base * 2 ** attempt)) if self.base else 0.0
+
+
+POLICIES = {
+    # the limiter paces the keys, the item is not at fault
+    'rate_limit': RetryPolicy(attempts=8, base=2, cap=60, budgeted=False),
+    # another key takes the item, there are at most 50
+    'quota': RetryPolicy(attempts=50, retire_key=True, budgeted=False),
+    'auth': RetryPolicy(attempts=50, retire_key=True, budgeted=False),
+    # the same prompt does not get shorter
+    'context_length': RetryPolicy(attempts=0),
+    'invalid_request': RetryPolicy(attempts=1, base=1),
+    'parse': RetryPolicy(attempts=2),
+    'transient': RetryPolicy(attempts=5, base=2, cap=60),
+    'replay_miss': RetryPolicy(attempts=0),
+    'unexpected': RetryPolicy(attempts=1, base=1),
+}
+
+# error markers of the task handlers
+_MARKERS = {'APIKey_Error': 'auth', 'Error': 'transient', 'UnexpectedError': 'unexpected'}
+
+
+def classify(error: Any) -> str:
+    """Error class of an exception, or of a task handler marker"""
+    if isinstance(error, str):
+        return _MARKERS.get(error, 'unexpected')
+    if isinstance(error, RateLimitError):
+        if isinstance(error.error, dict) and error.error.get('type') == 'insufficient_quota':
+            return 'quota'
+        return 'rate_limit'
+    if isinstance(error, (AuthenticationError, PermissionError)):
+        return 'auth'
+    if isinstance(error, InvalidRequestError):
+        if error.code == 'context_length_exceeded' or 'maximum context length' in str(error):
+            return 'context_length'
+        return 'invalid_request'
+    if isinstance(error, OutputError):
+        return 'parse'
+    if isinstance(error, ReplayMiss):
+        return 'replay_miss'
+    if isinstance(error, (APIError, APIConnectionError, ServiceUnavailableError, Timeout, TryAgain, TimeoutError)):
+        return 'transient'
+    return 'unexpected'
+
+
+def handler_error(result: list) -> Any:
+    """Error to classify of a failed task handler result, [error or key, marker, *item]"""
+    return result[1] if result[1] == 'APIKey_Error' or not isinstance(result[0], BaseException) else result[0]
+
+
+class Retry(NamedTuple):
+    """Item an `LLMEngine` queues again after `delay` seconds"""
+    item: tuple
+    delay: float
+
+
+class DeadLetters:
+    """Persistent store of the items that used up their retries, for inspection and a later rerun"""
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters ("
+            "id INTEGER PRIMARY KEY, stage TEXT NOT NULL, key TEXT NOT NULL, item TEXT NOT NULL, "
+            "error_class TEXT NOT NULL, error TEXT NOT NULL, attempts INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+
+    def add(self, stage: str, key: Hashable, item: Any, error_class: str, error: Any, attempts: int):
+        # objects that are derived from the item, like cleaned articles, are not kept
+        value = json.dumps(item, default=lambda _: None)
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO dead_letters (stage, key, item, error_class, error, attempts, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (stage, json.dumps(key, default=str), value, error_class, str(error), attempts, time()),
+            )
+        metrics.inc('dead_letters_total', stage=stage, error=error_class)
+
+    def entries(self, stage: Optional[str] = None) -> list[dict]:
+        query = "SELECT stage, key, item, error_class, error, attempts, created FROM dead_letters"
+        with self.lock:
+            rows = self.conn.execute(query + " WHERE stage = ?", (stage,)) if stage else self.conn.execute(query)
+            rows = rows.fetchall()
+        return [
+            {'stage': row[0], 'key': json.loads(row[1]), 'item': json.loads(row[2]), 'error_class': row[3],
+             'error': row[4], 'attempts': row[5], 'created': row[6]}
+            for row in rows
+        ]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+
+
+class Retrier:
+    """Retry decisions of one stage run.
+
+    Every item gets the attempts of the policy of each error class it hits;
+    on top of that, retries of `budgeted` classes are limited to
+    `budget_ratio` of the attempts made plus `budget_min` for the whole run,
+    so a run full of failing items ends instead of retrying all of them. Items
+    that are given up on go to `dead_letters`.
+    """
+    stage: str
+    policies: dict[str, RetryPolicy]
+    dead_letters: Optional[DeadLetters]
+    budget_ratio: float
+    budget_min: int
+    given_up: int
+
+    def __init__(
+            self,
+            stage: str,
+            dead_letters: Optional[DeadLetters] = None,
+            key: Callable[[Any], Hashable] = None,
+            policies: dict[str, RetryPolicy] = None,
+            budget_ratio: float = 0.2,
+            budget_min: int = 10,
+            seed: Optional[int] = None,
+        ) -> None:
+        self.stage = stage
+        self.dead_letters = dead_letters
+        self.key = key or (lambda item: item)
+        self.policies = policies or POLICIES
+        self.budget_ratio = budget_ratio
+        self.budget_min = budget_min
+        self.given_up = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # attempts of every item per error class
+        self.failures = {}
+        self.attempts = 0
+        self.retries = 0
+
+    def policy(self, error: Any) -> RetryPolicy:
+        return self.policies[classify(error)]
+
+    def attempted(self, count: int = 1):
+        """Count attempts that did not fail, the retry budget grows with them"""
+        with self.lock:
+            self.attempts += count
+
+    def decide(self, item: Any, error: Any) -> Optional[float]:
+        """Seconds to wait before retrying `item` after `error`, or None when it was given up"""
+        error_class = classify(error)
+        policy = self.policies[error_class]
+        key = self.key(item)
+        with self.lock:
+            self.attempts += 1
+            failures = self.failures.setdefault(key, {})
+            attempt = failures.get(error_class, 0)
+            over_budget = policy.budgeted and self.retries >= self.budget_min + self.budget_ratio * self.attempts
+            if attempt < policy.attempts and not over_budget:
+                failures[error_class] = attempt + 1
+                if policy.budgeted:
+                    self.retries += 1
+                # the engine and the synchronous stages both retry through here
+                metrics.inc('retries_total', stage=self.stage, error=error_class)
+                return policy.delay(attempt, self.rng)
+            self.failures.pop(key, None)
+            self.given_up += 1
+        reason = 'retry budget' if over_budget and attempt < policy.attempts else f"{attempt} {error_class} retries"
+        print(f"{self.stage} - gave up on {key} after {reason}: {error}")
+        if self.dead_letters is not None:
+            self.dead_letters.add(self.stage, key, item, error_class, error, sum(failures.values()) + 1)
+        return None
+
+    def retry(self, item: tuple, error: Any) -> Optional[Retry]:
+        """`Retry` of `item` for an `LLMEngine`, or None when it was given up"""
+        delay = self.decide(item, error)
+        return None if delay is None else Retry(item, delay)
+
+    def call(self, item: Any, attempt: Callable[[], Any], on_error: Callable[[BaseException], None] = None) -> Any:
+        """Result of `attempt()`, retried after errors as the policies allow, or None when given up"""
+        while True:
+            try:
+                result = attempt()
+                self.attempted()
+                return result
+            except Exception as er:
+                if on_error is not None:
+                    on_error(er)
+                delay = self.decide(item, er)
+                if delay is None:
+                    return None
+                sleep(delay)
@@ -0,0 +1,128 @@
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import time
+from typing import Any, Callable, Iterable, Optional
+
+from logger import Logger
+from metrics import metrics
+from store import is_complete
+
+
+class Job:
+    """A pipeline step: `func(*args, **kwargs)` reads the `inputs` files and writes the `outputs` files"""
+    name: str
+    func: Callable[..., Any]
+    args: tuple
+    kwargs: dict
+    labels: dict[str, str]
+    inputs: list[str]
+    outputs: list[str]
+
+    def __init__(
+            self,
+            name: str,
+            func: Callable[..., Any],
+            args: tuple = (),
+            inputs: Iterable[str] = (),
+            outputs: Iterable[str] = (),
+            kwargs: Optional[dict] = None,
+            labels: Optional[dict[str, str]] = None,
+        ) -> None:
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        # metric labels of everything the job records, e.g. stage and timeframe
+        self.labels = labels or {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+
+class Scheduler:
+    """Runs a DAG of jobs, each one as soon as the files it reads are written.
+
+    A file is ready once every job writing it has finished. A job whose
+    inputs do not exist at that point (their writer failed before creating
+    them) is skipped. At most `max_jobs` jobs run at a time; the LLM requests
+    of concurrent jobs share the per key slots of the `LLMEngine`.
+
+    With `resume`, a job whose outputs were all completed by an earlier run is
+    reused instead of run again, unless one of its inputs is rewritten now.
+    """
+    jobs: list[Job]
+    max_jobs: int
+    resume: bool
+
+    def __init__(self, jobs: list[Job], max_jobs: int = 6, logger: Optional[Logger] = None, resume: bool = False) -> None:
+        self.jobs = jobs
+        self.max_jobs = max(max_jobs, 1)
+        self.logger = logger
+        self.resume = resume
+        self.writers = {}
+        for job in jobs:
+            for output in job.outputs:
+                self.writers.setdefault(output, []).append(job.name)
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        depends = {job.name: {writer for path in job.inputs for writer in self.writers.get(path, [])} for job in self.jobs}
+        done = set()
+        while len(done) < len(depends):
+            ready = [name for name, writers in depends.items() if name not in done and writers <= done]
+            if not ready:
+                raise ValueError(f"Jobs depend on each other: {sorted(set(depends) - done)}")
+            done.update(ready)
+
+    def _log(self, content: str):
+        if self.logger is not None:
+            self.logger.log(content)
+        else:
+            print(content)
+
+    def run(self) -> dict[str, str]:
+        """Run every job and return the status of each: done, reused, failed or skipped"""
+        status = {}
+        pending = list(self.jobs)
+        running = {}
+        start_t = time()
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            while pending or running:
+                for job in list(pending):
+                    if any(writer not in status for path in job.inputs for writer in self.writers.get(path, [])):
+                        continue
+                    pending.remove(job)
+                    if self._reusable(job, status):
+                        status[job.name] = 'reused'
+                        self._log(f'{job.name} - Completed by an earlier run')
+                        continue
+                    missing = [path for path in job.inputs if not os.path.exists(path)]
+                    if missing:
+                        status[job.name] = 'skipped'
+                        self._log(f'{job.name} - Skipped, missing {", ".join(missing)}')
+                        continue
+                    running[executor.submit(self._run_job, job)] = job
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    status[running.pop(future).name] = future.result()
+        self._log(f'Pipeline - {len(status)} jobs finished in {time() - start_t} seconds')
+        return status
+
+    def _reusable(self, job: Job, status: dict[str, str]) -> bool:
+        if not self.resume or not job.outputs or not all(is_complete(path) for path in job.outputs):
+            return False
+        return all(status[writer] == 'reused' for path in job.inputs for writer in self.writers.get(path, []))
+
+    def _run_job(self, job: Job) -> str:
+        try:
+            self._log(f'{job.name} - Started...')
+            with metrics.scope(**job.labels):
+                job.func(*job.args, **job.kwargs)
+            self._log(f'{job.name} - Successfully completed')
+            return 'done'
+        except Exception as e:
+            error = traceback.format_exc()
+            self._log(f'{job.name} - Error: {e},\n Error logs: {error}')
+            return 'failed'
@@ -1,118 +1,21 @@
-from langchain.text_splitter import CharacterTextSplitter, TokenTextSplitter
-from langchain.docstore.document import Document
+import re
+
 from langchain.chat_models import ChatOpenAI
-from langchain.prompts import load_prompt, PipelinePromptTemplate, PromptTemplate
+from langchain.prompts import PipelinePromptTemplate, PromptTemplate
 from langchain.chains.llm import LLMChain
 from langchain.chains import MapReduceDocumentsChain
 from langchain.chains.combine_documents.stuff import StuffDocumentsChain
 from langchain.chains.combine_documents.reduce import ReduceDocumentsChain
 from langchain.callbacks import get_openai_callback
 from openai.error import InvalidRequestError, RateLimitError
-import tiktoken
-
-# Summarize articles and get the result from OpenAI using Map-Reduce method
-def summarize_article(apikey: str, content: str, ):
-    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
-    token_count = len(encoding.encode(content))
-
-    llm = ChatOpenAI(temperature=0, openai_api_key=apikey, model = 'gpt-3.5-turbo', max_tokens=1248)
-
-    if token_count < 1248:
-        # chunk size of template was calculated (3072-1600)
-        text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-            chunk_size=1248, chunk_overlap=0, model_name='gpt-3.5-turbo'
-        )
-        # Create Document object for the text
-        docs = [Document(page_content=content)]
-        split_docs = text_splitter.split_documents(docs)
-    else:
-        text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-            chunk_size=11088, chunk_overlap=0, model_name='gpt-3.5-turbo-16k',
-        )
-        if token_count >= 11088:
-            text_splitter = TokenTextSplitter.from_tiktoken_encoder(
-                chunk_size=11088, chunk_overlap=0, model_name='gpt-3.5-turbo-16k',
-            )
-        # Create Document object for the text
-        docs = [Document(page_content=content)]
-        split_docs = text_splitter.split_documents(docs)
-        llm = ChatOpenAI(temperature=0, openai_api_key=apikey, model = 'gpt-3.5-turbo-16k', max_tokens=3696)
-
-    # Map
-    map_prompt = load_prompt("./prompts/summarize-map.yaml")
-    map_chain = LLMChain(llm=llm, prompt=map_prompt)
-
-    # Run chain
-    reduce_prompt = load_prompt("./prompts/summarize-reduce.yaml")
-    reduce_chain = LLMChain(llm=llm, prompt=reduce_prompt)
-
-    # Takes a list of documents, combines them into a single string, and passes this to an LLMChain
-    combine_documents_chain = StuffDocumentsChain(
-        llm_chain=reduce_chain, document_variable_name="doc_summaries", 
-        # reduce_k_below_max_tokens=True,
-    )
-    # Combines and iteravely reduces the mapped documents
-    reduce_documents_chain = ReduceDocumentsChain(
-        # This is final chain that is called.
-        combine_documents_chain=combine_documents_chain,
-        # If documents exceed context for `StuffDocumentsChain`
-        collapse_documents_chain=combine_documents_chain,
-        # The maximum number of tokens to group documents into.
-        token_max=13333,
-    )
-
-    # Combining documents by mapping a chain over them, then combining results
-    map_reduce_chain = MapReduceDocumentsChain(
-        # Map chain
-        llm_chain=map_chain,
-        # Reduce chain
-        reduce_documents_chain=reduce_documents_chain,
-        # The variable name in the llm_chain to put the documents in
-        document_variable_name="docs",
-        # Return the results of the map steps in the output
-        return_intermediate_steps=False,
-    )
 
-    try:
-        with get_openai_callback() as cb:
-            if len(split_docs) == 1:
-                summary = combine_documents_chain.run(split_docs)
-                return [summary, cb]
-            else:
-                summary = map_reduce_chain.run(split_docs)
-                return [summary, cb]
-    except InvalidRequestError as er:
-        raise InvalidRequestError(f"model: {llm.model_name}\ntoken_count: {token_count}", er.param)
+from archive import ArchivedChatOpenAI, LLMArchive
+from chunker import encode, split_text, split_tokens
+from metrics import MetricsCallback, metrics
+from ratelimit import AsyncRateLimitCallback, RateLimitCallback, RateLimiter
+from registry import registry
 
-def categorize(apikey: str, primaries: list[str], secondaries: list[str]):
-    primary = ""
-    for i, title in enumerate(primaries):
-        primary += f"{i+1} {title}\n"
-    
-    secondary = ""
-    for title in secondaries:
-        secondary += f"- {title}\n"
-    
-    prompt = load_prompt("./prompts/categorize.yaml")
-    # print(prompt.format(primary_titles=primary, secondary_titles=secondary))
-    llm = ChatOpenAI(temperature=0, openai_api_key=apikey, model = 'gpt-3.5-turbo-16k')
-    chain = LLMChain(llm=llm, prompt=prompt)
-    example = """[{"Primary": "Trump Indicted for Espionage", "Secondary": ["Trump Indicted for Espionage", "Trump faces criminal charges", "Trump Arrested on Classified Documents Charges"], "Title": [Trump under investigation]}, ...]"""
-    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
-    token_count = len(encoding.encode(primary+secondary))
-    print(primary)
-    print(secondary)
-    print(token_count)
-    with get_openai_callback() as cb:
-        result: str = chain.run(primary_titles=primary, secondary_titles=secondary, example=example)
-        result = result.split(']}]')[0] + ']}]'
-        return [result, cb]
-
-def extra_research(apikey: str, articles: list[str]):
-    content = "\n".join(articles)
-
-    original_prompt = load_prompt("./prompts/extra-research.yaml")
-    full_template="""{{rules}}
+EXTRA_RESEARCH_TEMPLATE = """{{rules}}
     Please adhere to the following structure for your examination
     Output must be in this format. This must be valid python dictinoary or json object
     Don't include " in the middle of result sentences in the output
@@ -122,75 +25,9 @@ def extra_research(apikey: str, articles: list[str]):
     {"Introduction": "Summarize the articles' topic and content briefly. Highlight the key issues or events to be analyzed.", "Historical Context": "Discuss the events' history. Identify crucial factors, background details, and significant precedents relevant to the situation.", "Key Players": "Identify the primary individuals or organizations involved in the events. Explore their roles and their effects on the events.", "Underlying Motivations": "Examine the driving forces behind the actions in the articles. Dig into the goals, interests, or ideologies of the engaged parties, supporting your analysis with solid evidence or credible theories.", "Recent Developments": "Address any fresh updates or happenings related to the events.", "Impact": "Evaluate the immediate and long-term consequences of the events.", "Future Challenges": "Identify potential challenges that may arise from these events. Discuss potential implications and strategies to tackle them.", "Historical Comparisons": "Provide three instances from recent history that resonate with the events in the articles. Analyze each example, emphasizing similarities, differences, and lessons gleaned.", "Conclusion": "Wrap up your analysis by encapsulating the key findings or insights. Propose areas for further research, if applicable."}
 
     """
-    final_prompt = PromptTemplate.from_template(full_template, template_format="jinja2")
-    input_prompts = [
-        ("rules", original_prompt),
-    ]
-
-    prompt = PipelinePromptTemplate(final_prompt=final_prompt, pipeline_prompts=input_prompts)
-
-    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
-    token_count = len(encoding.encode(prompt.format(articles='')))
-    chunk_size = int((16000 - token_count) * 0.75)
-    max_token = int((16000 - token_count) * 0.25)
 
-    text_splitter = TokenTextSplitter.from_tiktoken_encoder(
-        chunk_size=chunk_size, chunk_overlap=0, model_name='gpt-3.5-turbo-16k',
-    )
-    # Create Document object for the text
-    docs = [Document(page_content=content)]
-    split_docs = text_splitter.split_documents(docs)
-    llm = ChatOpenAI(temperature=0, openai_api_key=apikey, model = 'gpt-3.5-turbo-16k', max_tokens=max_token)
-
-
-    # Map
-    map_chain = LLMChain(llm=llm, prompt=prompt)
-
-    # Run chain
-    reduce_chain = LLMChain(llm=llm, prompt=prompt)
-
-    # Takes a list of documents, combines them into a single string, and passes this to an LLMChain
-    combine_documents_chain = StuffDocumentsChain(
-        llm_chain=reduce_chain, document_variable_name="articles", 
-        # reduce_k_below_max_tokens=True,
-    )
-    # Combines and iteravely reduces the mapped documents
-    reduce_documents_chain = ReduceDocumentsChain(
-        # This is final chain that is called.
-        combine_documents_chain=combine_documents_chain,
-        # If documents exceed context for `StuffDocumentsChain`
-        collapse_documents_chain=combine_documents_chain,
-        # The maximum number of tokens to group documents into.
-        token_max=13333,
-    )
-
-    # Combining documents by mapping a chain over them, then combining results
-    map_reduce_chain = MapReduceDocumentsChain(
-        # Map chain
-        llm_chain=map_chain,
-        # Reduce chain
-        reduce_documents_chain=reduce_documents_chain,
-        # The variable name in the llm_chain to put the documents in
-        document_variable_name="articles",
-        # Return the results of the map steps in the output
-        return_intermediate_steps=False,
-    )
-
-    with get_openai_callback() as cb:
-        if len(split_docs) == 1:
-            summary = combine_documents_chain.run(split_docs)
-            return [summary, cb]
-        else:
-            summary = map_reduce_chain.run(split_docs)
-            return [summary, cb]
-
-def deep_research(apikey: str, articles: list[dict[str:str]], background: dict):
-    content = "\n".join([f"Title: {article['title']}\nContent: {article['content']}" for article in articles])
-    background = "\n".join([f"{p}: {v}\n" for p, v in background.items()])
-
-
-    original_prompt = load_prompt("./prompts/deep-research.yaml")
-    full_template="""{{rules}}
+# background is an input of the prompt rather than part of the template, so the prompt is compiled once
+DEEP_RESEARCH_TEMPLATE = """{{rules}}
     Output must follow this format
     Output must be in this format.
     Don't include " in the middle of result sentences in output
@@ -205,150 +42,16 @@ def deep_research(apikey: str, articles: list[dict[str:str]], background: dict):
     ###additional background, context, and examples###
     {{background}}
     """
-    final_prompt = PromptTemplate.from_template(full_template, template_format="jinja2")
-    background_prompt = PromptTemplate.from_template(background, template_format="jinja2")
-    input_prompts = [
-        ("rules", original_prompt),
-        ("background", background_prompt),
-    ]
-    prompt = PipelinePromptTemplate(final_prompt=final_prompt, pipeline_prompts=input_prompts)
-
-    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
-    token_count = len(encoding.encode(prompt.format(articles='')))
-    chunk_size = int((16000 - token_count) * 0.75)
-    max_token = int((16000 - token_count) * 0.25)
-    text_splitter = TokenTextSplitter.from_tiktoken_encoder(
-        chunk_size=chunk_size, chunk_overlap=0, model_name='gpt-3.5-turbo-16k',
-    )
-    # Create Document object for the text
-    docs = [Document(page_content=content)]
-    split_docs = text_splitter.split_documents(docs)
-    llm = ChatOpenAI(temperature=0, openai_api_key=apikey, model = 'gpt-3.5-turbo-16k', max_tokens=max_token)
-
-    # Map
-    map_chain = LLMChain(llm=llm, prompt=prompt)
 
-    # Run chain
-    reduce_chain = LLMChain(llm=llm, prompt=prompt)
-
-    # Takes a list of documents, combines them into a single string, and passes this to an LLMChain
-    combine_documents_chain = StuffDocumentsChain(
-        llm_chain=reduce_chain, document_variable_name="articles", 
-        # reduce_k_below_max_tokens=True,
-    )
-    # Combines and iteravely reduces the mapped documents
-    reduce_documents_chain = ReduceDocumentsChain(
-        # This is final chain that is called.
-        combine_documents_chain=combine_documents_chain,
-        # If documents exceed context for `StuffDocumentsChain`
-        collapse_documents_chain=combine_documents_chain,
-        # The maximum number of tokens to group documents into.
-        token_max=13333,
-    )
-
-    # Combining documents by mapping a chain over them, then combining results
-    map_reduce_chain = MapReduceDocumentsChain(
-        # Map chain
-        llm_chain=map_chain,
-        # Reduce chain
-        reduce_documents_chain=reduce_documents_chain,
-        # The variable name in the llm_chain to put the documents in
-        document_variable_name="articles",
-        # Return the results of the map steps in the output
-        return_intermediate_steps=False,
-    )
-
-    with get_openai_callback() as cb:
-        if len(split_docs) == 1:
-            summary = combine_documents_chain.run(split_docs)
-            return [summary, cb]
-        else:
-            summary = map_reduce_chain.run(split_docs)
-            return [summary, cb]
-
-def impactul_news(apikey: str, articles: list[dict]):
-    content = "\n".join([f"Title: {article['title']}\nSummary: {article['summary']}" for article in articles])
-
-    original_prompt = load_prompt("./prompts/impactful-news.yaml")
-    full_template="""{{rules}}
+IMPACTFUL_NEWS_TEMPLATE = """{{rules}}
     Output must follow this format
     Output must be in this format. This must be python dictinoary or json object
     Don't include " in the middle of result sentences
     ###Output Format###
     [{"title": title, "explanation": Explanation}, {"title": title, "explanation": Explanation}, ... {"title": title, "explanation": Explanation}]
     """
-    final_prompt = PromptTemplate.from_template(full_template, template_format="jinja2")
-    input_prompts = [
-        ("rules", original_prompt),
-    ]
-    prompt = PipelinePromptTemplate(final_prompt=final_prompt, pipeline_prompts=input_prompts)
-
-    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
-    token_count = len(encoding.encode(prompt.format(articles='')))
-    chunk_size = int((16000 - token_count) * 0.75)
-    max_token = int((16000 - token_count) * 0.25)
-    text_splitter = TokenTextSplitter.from_tiktoken_encoder(
-        chunk_size=chunk_size, chunk_overlap=0, model_name='gpt-3.5-turbo-16k',
-    )
-    # Create Document object for the text
-    docs = [Document(page_content=content)]
-    split_docs = text_splitter.split_documents(docs)
-    llm = ChatOpenAI(temperature=0, openai_api_key=apikey, model = 'gpt-3.5-turbo-16k', max_tokens=max_token)
-
-    # Map
-    map_chain = LLMChain(llm=llm, prompt=prompt)
-
-    # Run chain
-    reduce_chain = LLMChain(llm=llm, prompt=prompt)
-
-    # Takes a list of documents, combines them into a single string, and passes this to an LLMChain
-    combine_documents_chain = StuffDocumentsChain(
-        llm_chain=reduce_chain, document_variable_name="articles", 
-        # reduce_k_below_max_tokens=True,
-    )
-    # Combines and iteravely reduces the mapped documents
-    reduce_documents_chain = ReduceDocumentsChain(
-        # This is final chain that is called.
-        combine_documents_chain=combine_documents_chain,
-        # If documents exceed context for `StuffDocumentsChain`
-        collapse_documents_chain=combine_documents_chain,
-        # The maximum number of tokens to group documents into.
-        token_max=13333,
-    )
 
-    # Combining documents by mapping a chain over them, then combining results
-    map_reduce_chain = MapReduceDocumentsChain(
-        # Map chain
-        llm_chain=map_chain,
-        # Reduce chain
-        reduce_documents_chain=reduce_documents_chain,
-        # The variable name in the llm_chain to put the documents in
-        document_variable_name="articles",
-        # Return the results of the map steps in the output
-        return_intermediate_steps=False,
-    )
-
-    with get_openai_callback() as cb:
-        if len(split_docs) == 1:
-            summary = combine_documents_chain.run(split_docs)
-            return [summary, cb]
-        else:
-            summary = map_reduce_chain.run(split_docs)
-            return [summary, cb]
-
-def prediction(apikey: str, topics: list[dict], category: str, timeframe: str):
-    content = "\n".join([f"topic: {topic['topic']}\nprediction: {topic['prediction']}" for topic in topics])
-
-    main_prompt = load_prompt("./prompts/prediction.yaml")
-    category_prompt = PromptTemplate.from_template(category, template_format="jinja2")
-    timeframe_prompt = PromptTemplate.from_template(timeframe, template_format="jinja2")
-    time = "on a 1-day time frame"    
-    if timeframe == 'week':
-        time = 'on a 1-week time frame'
-    if timeframe == 'month':
-        time = 'on a 1-month time frame'
-
-    full_template="""
+PREDICTION_TEMPLATE = """
     Imagine you are a professional news analyst and journalist
 
     ###Task###
@@ -365,63 +68,305 @@ def prediction(apikey: str, topics: list[dict], category: str, timeframe: str):
     ###Output Format###
     {"Developing Trend 1": Developing_Trend_1, "Explanation": Explanation, "Opportunities that may arise": Opportunities_that_may_arise, "Potential Pitfalls": Potential_Pitfalls}}
     """
-    final_prompt = PromptTemplate.from_template(full_template, template_format="jinja2")
-    input_prompts = [
-        ("main", main_prompt),
-        ("category", category_prompt),
-        ("timeframe", timeframe_prompt),
-    ]
-    prompt = PipelinePromptTemplate(final_prompt=final_prompt, pipeline_prompts=input_prompts)
-
-    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
-    token_count = len(encoding.encode(prompt.format(topics='', category=category, timeframe=time)))
-    chunk_size = int((16000 - token_count) * 0.75)
-    max_token = int((16000 - token_count) * 0.25)
-    text_splitter = TokenTextSplitter.from_tiktoken_encoder(
-        chunk_size=chunk_size, chunk_overlap=0, model_name='gpt-3.5-turbo-16k',
-    )
-    # Create Document object for the text
-    docs = [Document(page_content=content)]
-    split_docs = text_splitter.split_documents(docs)
-    llm = ChatOpenAI(temperature=0, openai_api_key=apikey, model = 'gpt-3.5-turbo-16k', max_tokens=max_token)
 
-    # Map
-    map_chain = LLMChain(llm=llm, prompt=prompt)
+# articles shorter than this are summarized by gpt-3.5-turbo in one chunk, and may be packed
+SHORT_ARTICLE_TOKENS = 1248
 
-    # Run chain
-    reduce_chain = LLMChain(llm=llm, prompt=prompt)
+# answer sizes are rounded down to this step, the chains of a key are built for a few sizes only
+MAX_TOKENS_STEP = 256
 
-    # Takes a list of documents, combines them into a single string, and passes this to an LLMChain
-    combine_documents_chain = StuffDocumentsChain(
-        llm_chain=reduce_chain, document_variable_name="topics", 
-        # reduce_k_below_max_tokens=True,
+# line that starts each article of a packed summarize request and its result
+_ARTICLE_MARKER = re.compile(r'^\W*Article\s+(\d+)\W*$', re.MULTILINE | re.IGNORECASE)
+
+# Rate limiter shared by every chain of this process, see set_rate_limiter
+rate_limiter: RateLimiter = None
+
+def set_rate_limiter(limiter: RateLimiter):
+    global rate_limiter
+    rate_limiter = limiter
+
+# Archive every chat model of this process records into or replays from, see set_llm_archive
+llm_archive: LLMArchive = None
+
+def set_llm_archive(archive: LLMArchive):
+    global llm_archive
+    llm_archive = archive
+
+def _chat_model(apikey: str, model: str, max_tokens: int = None) -> ChatOpenAI:
+    # max_retries counts attempts: the error goes straight to the retry policies, which may pick another key
+    if llm_archive is not None:
+        return ArchivedChatOpenAI(
+            temperature=0, openai_api_key=apikey, model=model, max_tokens=max_tokens, max_retries=1, archive=llm_archive,
+        )
+    return ChatOpenAI(temperature=0, openai_api_key=apikey, model=model, max_tokens=max_tokens, max_retries=1)
+
+# `token_counts` are the known token counts of texts in the prompts, the rate limiter does not encode them again
+def _callbacks(apikey: str, token_counts: dict[str, int] = None):
+    callbacks = [MetricsCallback(metrics, apikey)]
+    if rate_limiter:
+        callbacks.append(RateLimitCallback(rate_limiter, apikey, token_counts))
+    return callbacks
+
+def _acallbacks(apikey: str, token_counts: dict[str, int] = None):
+    callbacks = [MetricsCallback(metrics, apikey)]
+    if rate_limiter:
+        callbacks.append(AsyncRateLimitCallback(rate_limiter, apikey, token_counts))
+    return callbacks
+
+def _document_tokens(split_docs, token_counts: dict[str, int] = None) -> dict[str, int]:
+    """Token counts the chunker kept in the metadata of the documents, with `token_counts`"""
+    counts = {doc.page_content: doc.metadata['tokens'] for doc in split_docs if doc.metadata.get('tokens') is not None}
+    return {**counts, **(token_counts or {})}
+
+# Run the stuff chain for a single document, otherwise map-reduce over the chunks.
+# `inputs` are the prompt variables other than the documents, `token_counts` known counts of other texts in them.
+def _run_chain(apikey: str, combine_documents_chain, map_reduce_chain, split_docs, token_counts: dict[str, int] = None, **inputs):
+    with get_openai_callback() as cb:
+        chain = combine_documents_chain if len(split_docs) == 1 else map_reduce_chain
+        callbacks = _callbacks(apikey, _document_tokens(split_docs, token_counts))
+        summary = chain.run(input_documents=split_docs, callbacks=callbacks, **inputs)
+        return [summary, cb]
+
+async def _arun_chain(apikey: str, combine_documents_chain, map_reduce_chain, split_docs, token_counts: dict[str, int] = None, **inputs):
+    with get_openai_callback() as cb:
+        chain = combine_documents_chain if len(split_docs) == 1 else map_reduce_chain
+        callbacks = _acallbacks(apikey, _document_tokens(split_docs, token_counts))
+        summary = await chain.arun(input_documents=split_docs, callbacks=callbacks, **inputs)
+        return [summary, cb]
+
+def _pipeline_prompt(name: str, template: str, rules: str = "rules"):
+    """`template` with the prompt of prompts/<name>.yaml rendered into `rules`, compiled once"""
+    def build():
+        final_prompt = PromptTemplate.from_template(template, template_format="jinja2")
+        input_prompts = [
+            (rules, registry.prompt(name)),
+        ]
+        prompt = PipelinePromptTemplate(final_prompt=final_prompt, pipeline_prompts=input_prompts)
+        # only the inputs of the pipeline prompts are picked up, the chains must also pass those of the final prompt
+        prompt.input_variables = sorted(set(prompt.input_variables) | set(final_prompt.input_variables) - {rules})
+        return prompt
+    return registry.get(('pipeline', name), build)
+
+def _chains(name: str, apikey: str, model: str, max_tokens: int, map_prompt, reduce_prompt, map_variable: str, reduce_variable: str):
+    """Stuff and map-reduce chains of a stage, shared by every call with the same key, model and max_tokens"""
+    def build():
+        llm = _chat_model(apikey, model, max_tokens)
+
+        # Map
+        map_chain = LLMChain(llm=llm, prompt=map_prompt)
+
+        # Run chain
+        reduce_chain = LLMChain(llm=llm, prompt=reduce_prompt)
+
+        # Takes a list of documents, combines them into a single string, and passes this to an LLMChain
+        combine_documents_chain = StuffDocumentsChain(
+            llm_chain=reduce_chain, document_variable_name=reduce_variable, 
+            # reduce_k_below_max_tokens=True,
+        )
+        # Combines and iteravely reduces the mapped documents
+        reduce_documents_chain = ReduceDocumentsChain(
+            # This is final chain that is called.
+            combine_documents_chain=combine_documents_chain,
+            # If documents exceed context for `StuffDocumentsChain`
+            collapse_documents_chain=combine_documents_chain,
+            # The maximum number of tokens to group documents into.
+            token_max=13333,
+        )
+
+        # Combining documents by mapping a chain over them, then combining results
+        map_reduce_chain = MapReduceDocumentsChain(
+            # Map chain
+            llm_chain=map_chain,
+            # Reduce chain
+            reduce_documents_chain=reduce_documents_chain,
+            # The variable name in the llm_chain to put the documents in
+            document_variable_name=map_variable,
+            # Return the results of the map steps in the output
+            return_intermediate_steps=False,
+        )
+        return combine_documents_chain, map_reduce_chain
+    return registry.get(('chains', name, apikey, model, max_tokens), build)
+
+# Split the documents of a 16k stage so that the prompt, the chunk and the answer fit the context
+# `content_tokens` is an upper bound of the tokens of the content when an earlier stage already counted them
+def _prepare_research(name: str, apikey: str, prompt, content: str, static_tokens: int, variable: str, content_tokens: int = None):
+    chunk_size = int((16000 - static_tokens) * 0.75)
+    max_token = int((16000 - static_tokens) * 0.25)
+    # deep research counts its background in the static tokens, which differ on every call
+    max_token = max_token - max_token % MAX_TOKENS_STEP or max_token
+    split_docs = split_text(content, chunk_size, 'gpt-3.5-turbo-16k', content_tokens)
+    combine_documents_chain, map_reduce_chain = _chains(
+        name, apikey, 'gpt-3.5-turbo-16k', max_token, prompt, prompt, variable, variable,
     )
-    # Combines and iteravely reduces the mapped documents
-    reduce_documents_chain = ReduceDocumentsChain(
-        # This is final chain that is called.
-        combine_documents_chain=combine_documents_chain,
-        # If documents exceed context for `StuffDocumentsChain`
-        collapse_documents_chain=combine_documents_chain,
-        # The maximum number of tokens to group documents into.
-        token_max=13333,
+    return combine_documents_chain, map_reduce_chain, split_docs
+
+def _prepare_summarize(apikey: str, content: str, tokens: list[int] = None):
+    # the article is encoded once, the model and the chunks are chosen from these tokens
+    if tokens is None:
+        tokens = encode(content)
+    token_count = len(tokens)
+
+    model, max_tokens = 'gpt-3.5-turbo', SHORT_ARTICLE_TOKENS
+    # chunk size of template was calculated (3072-1600)
+    chunk_size = SHORT_ARTICLE_TOKENS
+    if token_count >= SHORT_ARTICLE_TOKENS:
+        model, max_tokens = 'gpt-3.5-turbo-16k', 3696
+        chunk_size = 11088
+    split_docs = split_tokens(content, tokens, chunk_size)
+
+    combine_documents_chain, map_reduce_chain = _chains(
+        'summarize', apikey, model, max_tokens,
+        registry.prompt('summarize-map'), registry.prompt('summarize-reduce'), "docs", "doc_summaries",
     )
+    return combine_documents_chain, map_reduce_chain, split_docs, model, token_count
 
-    # Combining documents by mapping a chain over them, then combining results
-    map_reduce_chain = MapReduceDocumentsChain(
-        # Map chain
-        llm_chain=map_chain,
-        # Reduce chain
-        reduce_documents_chain=reduce_documents_chain,
-        # The variable name in the llm_chain to put the documents in
-        document_variable_name="topics",
-        # Return the results of the map steps in the output
-        return_intermediate_steps=False,
+# Summarize articles and get the result from OpenAI using Map-Reduce method.
+# `tokens` is the encoding of `content` if the caller has it.
+# Returns [summary, cb, token count of the article].
+def summarize_article(apikey: str, content: str, tokens: list[int] = None):
+    combine_documents_chain, map_reduce_chain, split_docs, model, token_count = _prepare_summarize(apikey, content, tokens)
+    try:
+        return _run_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs) + [token_count]
+    except InvalidRequestError as er:
+        raise InvalidRequestError(f"{er.user_message}\nmodel: {model}\ntoken_count: {token_count}", er.param, code=er.code) from er
+
+async def asummarize_article(apikey: str, content: str, tokens: list[int] = None):
+    combine_documents_chain, map_reduce_chain, split_docs, model, token_count = _prepare_summarize(apikey, content, tokens)
+    try:
+        return await _arun_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs) + [token_count]
+    except InvalidRequestError as er:
+        raise InvalidRequestError(f"{er.user_message}\nmodel: {model}\ntoken_count: {token_count}", er.param, code=er.code) from er
+
+# `tokens` are the encodings of the short `contents`, `completion_tokens` the answer allowed per article
+def _prepare_summarize_packed(apikey: str, contents: list[str], tokens: list[list[int]], completion_tokens: int):
+    prompt = registry.prompt('summarize-packed')
+    articles = "\n".join(f"### Article {i + 1} ###\n{content.strip()}" for i, content in enumerate(contents))
+    static_tokens = registry.token_count('summarize-packed', lambda: prompt.format(articles='', count=0))
+    # every marker line takes a few tokens besides the articles
+    article_tokens = sum(len(tokens_of_article) + 8 for tokens_of_article in tokens)
+    prompt_tokens = static_tokens + article_tokens
+    max_tokens = completion_tokens * len(contents)
+    model = 'gpt-3.5-turbo' if prompt_tokens + max_tokens <= 4096 else 'gpt-3.5-turbo-16k'
+    chain = registry.get(
+        ('chains', 'summarize-packed', apikey, model, max_tokens),
+        lambda: LLMChain(llm=_chat_model(apikey, model, max_tokens), prompt=prompt),
     )
+    return chain, articles, model, prompt_tokens, {articles: article_tokens}
+
+def _split_packed(result: str, count: int) -> list[str]:
+    """Result of every article of a packed summarize answer, None for the ones it left out"""
+    results = [None] * count
+    markers = list(_ARTICLE_MARKER.finditer(result))
+    for marker, following in zip(markers, markers[1:] + [None]):
+        index = int(marker.group(1)) - 1
+        if 0 <= index < count and results[index] is None:
+            results[index] = result[marker.end():following.start() if following else len(result)].strip()
+    return results
+
+# Summarize several short articles with one request, each in its own block of the answer.
+# Returns [results of the articles in order (None when left out), cb].
+def summarize_articles(apikey: str, contents: list[str], tokens: list[list[int]], completion_tokens: int = 600):
+    chain, articles, model, prompt_tokens, token_counts = _prepare_summarize_packed(apikey, contents, tokens, completion_tokens)
+    try:
+        with get_openai_callback() as cb:
+            result = chain.run(articles=articles, count=len(contents), callbacks=_callbacks(apikey, token_counts))
+            return [_split_packed(result, len(contents)), cb]
+    except InvalidRequestError as er:
+        raise InvalidRequestError(f"{er.user_message}\nmodel: {model}\ntoken_count: {prompt_tokens}", er.param, code=er.code) from er
+
+async def asummarize_articles(apikey: str, contents: list[str], tokens: list[list[int]], completion_tokens: int = 600):
+    chain, articles, model, prompt_tokens, token_counts = _prepare_summarize_packed(apikey, contents, tokens, completion_tokens)
+    try:
+        with get_openai_callback() as cb:
+            result = await chain.arun(articles=articles, count=len(contents), callbacks=_acallbacks(apikey, token_counts))
+            return [_split_packed(result, len(contents)), cb]
+    except InvalidRequestError as er:
+        raise InvalidRequestError(f"{er.user_message}\nmodel: {model}\ntoken_count: {prompt_tokens}", er.param, code=er.code) from er
 
+def categorize(apikey: str, primaries: list[str], secondaries: list[str]):
+    primary = ""
+    for i, title in enumerate(primaries):
+        primary += f"{i+1} {title}\n"
+    
+    secondary = ""
+    for title in secondaries:
+        secondary += f"- {title}\n"
+    
+    prompt = registry.prompt('categorize')
+    # print(prompt.format(primary_titles=primary, secondary_titles=secondary))
+    chain = registry.get(
+        ('chains', 'categorize', apikey),
+        lambda: LLMChain(llm=_chat_model(apikey, 'gpt-3.5-turbo-16k'), prompt=prompt),
+    )
+    example = """[{"Primary": "Trump Indicted for Espionage", "Secondary": ["Trump Indicted for Espionage", "Trump faces criminal charges", "Trump Arrested on Classified Documents Charges"], "Title": [Trump under investigation]}, ...]"""
+    encoding = registry.encoding('gpt-3.5-turbo')
+    token_count = len(encoding.encode(primary+secondary))
+    print(primary)
+    print(secondary)
+    print(token_count)
     with get_openai_callback() as cb:
-        if len(split_docs) == 1:
-            summary = combine_documents_chain.run(split_docs)
-            return [summary, cb]
-        else:
-            summary = map_reduce_chain.run(split_docs)
-            return [summary, cb]
\ No newline at end of file
+        # the answer is repaired and validated by structured.parse_output
+        result: str = chain.run(primary_titles=primary, secondary_titles=secondary, example=example, callbacks=_callbacks(apikey))
+        return [result, cb]
+
+# `token_counts` are the stage 1 token counts of the articles, if known
+def _prepare_extra_research(apikey: str, articles: list[str], token_counts: list[int] = None):
+    content = "\n".join(articles)
+    content_tokens = None
+    if token_counts and None not in token_counts:
+        # the joined articles take at most one more token per separator
+        content_tokens = sum(token_counts) + len(articles)
+    prompt = _pipeline_prompt('extra-research', EXTRA_RESEARCH_TEMPLATE)
+    token_count = registry.token_count('extra-research', lambda: prompt.format(articles=''))
+    return _prepare_research('extra-research', apikey, prompt, content, token_count, "articles", content_tokens)
+
+def extra_research(apikey: str, articles: list[str], token_counts: list[int] = None):
+    combine_documents_chain, map_reduce_chain, split_docs = _prepare_extra_research(apikey, articles, token_counts)
+    return _run_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs)
+
+async def aextra_research(apikey: str, articles: list[str], token_counts: list[int] = None):
+    combine_documents_chain, map_reduce_chain, split_docs = _prepare_extra_research(apikey, articles, token_counts)
+    return await _arun_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs)
+
+def _prepare_deep_research(apikey: str, articles: list[dict[str:str]], background: dict):
+    content = "\n".join([f"Title: {article['title']}\nContent: {article['content']}" for article in articles])
+    # jinja drops the last newline of a template, keep rendering the background the way it used to be
+    background = "\n".join([f"{p}: {v}\n" for p, v in background.items()]).removesuffix("\n")
+
+    prompt = _pipeline_prompt('deep-research', DEEP_RESEARCH_TEMPLATE)
+    token_count = registry.token_count('deep-research', lambda: prompt.format(articles='', background=''))
+    background_tokens = len(registry.encoding('gpt-3.5-turbo').encode(background))
+    combine_documents_chain, map_reduce_chain, split_docs = _prepare_research(
+        'deep-research', apikey, prompt, content, token_count + background_tokens, "articles",
+    )
+    return combine_documents_chain, map_reduce_chain, split_docs, background, {background: background_tokens}
+
+def deep_research(apikey: str, articles: list[dict[str:str]], background: dict):
+    combine_documents_chain, map_reduce_chain, split_docs, background, token_counts = _prepare_deep_research(apikey, articles, background)
+    return _run_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs, token_counts, background=background)
+
+async def adeep_research(apikey: str, articles: list[dict[str:str]], background: dict):
+    combine_documents_chain, map_reduce_chain, split_docs, background, token_counts = _prepare_deep_research(apikey, articles, background)
+    return await _arun_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs, token_counts, background=background)
+
+def impactul_news(apikey: str, articles: list[dict]):
+    content = "\n".join([f"Title: {article['title']}\nSummary: {article['summary']}" for article in articles])
+
+    prompt = _pipeline_prompt('impactful-news', IMPACTFUL_NEWS_TEMPLATE)
+    token_count = registry.token_count('impactful-news', lambda: prompt.format(articles=''))
+    combine_documents_chain, map_reduce_chain, split_docs = _prepare_research(
+        'impactful-news', apikey, prompt, content, token_count, "articles",
+    )
+    return _run_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs)
+
+def prediction(apikey: str, topics: list[dict], category: str, timeframe: str):
+    content = "\n".join([f"topic: {topic['topic']}\nprediction: {topic['prediction']}" for topic in topics])
+
+    prompt = _pipeline_prompt('prediction', PREDICTION_TEMPLATE, rules="main")
+    token_count = registry.token_count(
+        ('prediction', category, timeframe), lambda: prompt.format(topics='', category=category, timeframe=timeframe),
+    )
+    combine_documents_chain, map_reduce_chain, split_docs = _prepare_research(
+        'prediction', apikey, prompt, content, token_count, "topics",
+    )
+    return _run_chain(apikey, combine_documents_chain, map_reduce_chain, split_docs, category=category, timeframe=timeframe)
@@ -0,0 +1,215 @@
+import json
+import os
+import struct
+from typing import Any, Callable, Hashable, Iterator, Optional
+
+# Field types of the records every stage writes. None is accepted for any field
+# because the LLM does not always return every item of the requested format.
+SCHEMAS = {
+    'stage_1': {
+        'article': str,
+        'result': str,
+        'title': str,
+        'category': str,
+        'summary': str,
+        'day_score': str,
+        'day_reason': str,
+        'week_score': str,
+        'week_reason': str,
+        'month_score': str,
+        'month_reason': str,
+        'site_name': str,
+        'link': str,
+        'token_count': int,
+        'compressed_token_count': int,
+        # link of the article whose summary a near-duplicate got
+        'duplicate_of': str,
+    },
+    'stage_2': {
+        'category': str,
+        'primaries': list,
+        'secondaries': list,
+        'data': list,
+    },
+    'stage_3': {
+        'category': str,
+        'topic': str,
+        'research': dict,
+        'articles': list,
+    },
+    'stage_4': {
+        'category': str,
+        'topic': str,
+        'background': dict,
+        'deep_research': dict,
+        'articles': list,
+    },
+    'stage_5': {
+        'no': int,
+        'title': str,
+        'explanation': str,
+    },
+    'stage_6': {
+        'category': str,
+        'prediction': dict,
+    },
+}
+
+_OFFSET = struct.Struct('<Q')
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def is_complete(path: str) -> bool:
+    """Whether the stage writing the store at `path` finished every item"""
+    return os.path.exists(path) and os.path.exists(path + '.done')
+
+
+class RecordStore:
+    """Append-only file of typed stage records.
+
+    Records are stored one compact JSON document per line after a header line
+    naming the schema. A sidecar `.idx` file keeps the byte offset of every
+    record so single records can be read without scanning the file.
+    """
+    path: str
+    schema_name: str
+    schema: dict[str, type]
+
+    def __init__(self, path: str, schema_name: str) -> None:
+        self.path = path
+        self.schema_name = schema_name
+        self.schema = SCHEMAS[schema_name]
+        self.index_path = path + '.idx'
+        self.complete_path = path + '.done'
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def validate(self, record: dict):
+        missing = self.schema.keys() - record.keys()
+        if missing:
+            raise SchemaError(f"{self.schema_name} record is missing {sorted(missing)}")
+        for field, kind in self.schema.items():
+            value = record[field]
+            if value is not None and not isinstance(value, kind):
+                raise SchemaError(f"{self.schema_name}.{field} must be {kind.__name__}, got {type(value).__name__}")
+
+    def writer(self, truncate: bool = False, on_write: Optional[Callable[[dict], None]] = None) -> 'RecordWriter':
+        """Open the store for appending, or start it over with `truncate`.
+
+        `on_write` is called with every record after it is written.
+        """
+        # the stage writing the records is not finished anymore
+        if os.path.exists(self.complete_path):
+            os.remove(self.complete_path)
+        if truncate or not self.exists():
+            with open(self.path, 'w', encoding='utf-8') as file:
+                file.write(json.dumps({'schema': self.schema_name}) + '\n')
+            with open(self.index_path, 'wb'):
+                pass
+        else:
+            self._check_header()
+            # a crash may have left a partial record or an index behind the records
+            end = self._rebuild_index()
+            with open(self.path, 'r+b') as file:
+                file.truncate(end)
+        return RecordWriter(self, on_write)
+
+    def mark_complete(self):
+        """Record that the stage writing this store finished every item"""
+        with open(self.complete_path, 'w', encoding='utf-8') as file:
+            file.write(str(len(self)))
+
+    def is_complete(self) -> bool:
+        return is_complete(self.path)
+
+    def completed(self, key: Callable[[dict], Hashable]) -> set:
+        """Keys of the items already written, which a resumed stage skips"""
+        return {key(record) for record in self} if self.exists() else set()
+
+    def _check_header(self):
+        with open(self.path, 'r', encoding='utf-8') as file:
+            header = json.loads(file.readline() or '{}')
+        if header.get('schema') != self.schema_name:
+            raise SchemaError(f"{self.path} holds {header.get('schema')} records, expected {self.schema_name}")
+
+    def __iter__(self) -> Iterator[dict]:
+        if not self.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as file:
+            header = json.loads(file.readline() or '{}')
+            if header.get('schema') != self.schema_name:
+                raise SchemaError(f"{self.path} holds {header.get('schema')} records, expected {self.schema_name}")
+            for line in file:
+                if not line.endswith('\n'):
+                    # a record cut short by a crash
+                    break
+                yield json.loads(line)
+
+    def offsets(self) -> list[int]:
+        if not os.path.exists(self.index_path):
+            self._rebuild_index()
+        with open(self.index_path, 'rb') as file:
+            data = file.read()
+        return [offset for (offset,) in _OFFSET.iter_unpack(data[:len(data) - len(data) % _OFFSET.size])]
+
+    def _rebuild_index(self) -> int:
+        """Write the offsets of all complete records and return where they end"""
+        with open(self.path, 'rb') as file, open(self.index_path, 'wb') as index:
+            file.readline()
+            offset = file.tell()
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                index.write(_OFFSET.pack(offset))
+                offset += len(line)
+        return offset
+
+    def __len__(self) -> int:
+        return len(self.offsets()) if self.exists() else 0
+
+    def __getitem__(self, position: int) -> dict:
+        offset = self.offsets()[position]
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            return json.loads(file.readline())
+
+
+class RecordWriter:
+    """Validates and appends records to a `RecordStore`"""
+    store: RecordStore
+
+    def __init__(self, store: RecordStore, on_write: Optional[Callable[[dict], None]] = None) -> None:
+        self.store = store
+        self.on_write = on_write
+        self.file = open(store.path, 'ab')
+        self.index = open(store.index_path, 'ab')
+
+    def write(self, record: dict[str, Any]):
+        self.store.validate(record)
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        self.index.write(_OFFSET.pack(self.file.tell()))
+        self.file.write(line)
+        if self.on_write is not None:
+            self.on_write(record)
+
+    def writerows(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    def __enter__(self) -> 'RecordWriter':
+        return self
+
+    def __exit__(self, *exc_info: Optional[Any]):
+        self.close()
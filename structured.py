@@ -0,0 +1,208 @@
+import ast
+import json
+import re
+from typing import Any, Optional
+
+from metrics import metrics
+
+# Shapes of the answers every stage parses: a type, a dict of required keys, or
+# a one item list for a list of such items. Extra keys are allowed.
+_TIMEFRAME = {
+    'Most likely': {'Description': str, 'Explanation': str},
+    'Possible': dict,
+    'Unlikely': dict,
+}
+OUTPUT_SCHEMAS = {
+    'categorize': [{'Primary': str, 'Secondary': list}],
+    'extra-research': dict,
+    'deep-research': {'1 day timeframe': _TIMEFRAME, '1 week timeframe': _TIMEFRAME, '1 month timeframe': _TIMEFRAME},
+    'impactful-news': [{'title': str, 'explanation': str}],
+    'prediction': dict,
+}
+
+_FENCE = re.compile(r'```(?:json|python)?\s*(.*?)(?:```|$)', re.DOTALL)
+_SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '„': '"', '‘': "'", '’': "'"})
+# characters that may follow the closing quote of a JSON string
+_AFTER_STRING = frozenset(',:}]')
+
+
+class OutputError(ValueError):
+    """An LLM answer that could not be parsed or does not have the shape its stage expects"""
+
+
+def parse_output(text: str, stage: str) -> Any:
+    """Parse the JSON (or Python literal) answer of `stage` and check it against its schema.
+
+    Answers are repaired on the way when they are wrapped in code fences or
+    prose, use typographic or unescaped inner quotes, have trailing commas or
+    were cut off by the token limit; every repair is counted in the
+    llm_output_repairs_total metric so prompts that need them stand out.
+    Raises OutputError when nothing parses or the shape is wrong.
+    """
+    value, repairs = loads(text)
+    for repair in repairs:
+        metrics.inc('llm_output_repairs_total', stage=stage, repair=repair)
+    if value is None:
+        metrics.inc('llm_output_failures_total', stage=stage, reason='parse')
+        raise OutputError(f"{stage} answer is not JSON: {text[:200]!r}")
+    schema = OUTPUT_SCHEMAS[stage]
+    try:
+        validate(value, schema, stage)
+    except OutputError:
+        if not ('truncated' in repairs and isinstance(value, list) and len(value) > 1):
+            metrics.inc('llm_output_failures_total', stage=stage, reason='schema')
+            raise
+        # the last item was cut off in the middle, the complete ones are kept
+        value = value[:-1]
+        validate(value, schema, stage)
+    return value
+
+
+def loads(text: str) -> tuple[Any, list[str]]:
+    """Value of a possibly broken JSON text and the repairs it took, or None"""
+    try:
+        return json.loads(text), []
+    except (json.decoder.JSONDecodeError, TypeError):
+        pass
+    repairs = []
+    text = text or ''
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+        repairs.append('fence')
+    translated = text.translate(_SMART_QUOTES)
+    if translated != text:
+        text = translated
+        repairs.append('smart_quotes')
+    start = min((index for index in (text.find('{'), text.find('[')) if index >= 0), default=-1)
+    if start < 0:
+        return None, repairs
+    if text[:start].strip():
+        repairs.append('leading_text')
+    candidate, scan_repairs = _scan(text, start)
+    repairs.extend(scan_repairs)
+    try:
+        value = json.loads(candidate, strict=False)
+    except json.decoder.JSONDecodeError:
+        pass
+    else:
+        # otherwise only raw line breaks inside strings were in the way
+        return value, repairs or ['control_characters']
+    try:
+        # single quotes, True and None
+        value = ast.literal_eval(candidate)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None, repairs
+    repairs.append('python_literal')
+    return value, repairs
+
+
+def _scan(text: str, start: int) -> tuple[str, list[str]]:
+    """The balanced value starting at `start`, with trailing commas and inner quotes fixed and truncation closed"""
+    out = []
+    stack = []
+    repairs = []
+    in_string = False
+    escaped = False
+    # output length and open brackets at the last comma outside strings, to drop a cut off last element
+    last_comma: Optional[tuple[int, list]] = None
+    index = start
+    while index < len(text):
+        char = text[index]
+        index += 1
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                following = text[index:].lstrip()[:1]
+                if following and following not in _AFTER_STRING:
+                    # a quote inside the string the model did not escape
+                    out.append('\\"')
+                    repairs.append('inner_quote')
+                    continue
+                in_string = False
+            out.append(char)
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ',':
+                out.pop()
+                repairs.append('trailing_comma')
+            if stack:
+                stack.pop()
+            out.append(char)
+            if not stack:
+                if text[index:].strip():
+                    repairs.append('trailing_text')
+                return ''.join(out), repairs
+            continue
+        elif char == ',':
+            last_comma = (len(out), list(stack))
+        out.append(char)
+
+    repairs.append('truncated')
+    if in_string or (out and ''.join(out).rstrip()[-1:] in ':,'):
+        if last_comma is not None:
+            # the last element was cut off, keep the ones before it
+            del out[last_comma[0]:]
+            stack = last_comma[1]
+        else:
+            if in_string:
+                out.append('"')
+            if ''.join(out).rstrip().endswith(':'):
+                out.append(' null')
+    while out and (out[-1].isspace() or out[-1] == ','):
+        out.pop()
+    return ''.join(out) + ''.join(reversed(stack)), repairs
+
+
+def validate(value: Any, schema: Any, path: str):
+    """Raise OutputError where `value` does not have the shape of `schema`"""
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            raise OutputError(f"{path} must be an object, got {type(value).__name__}")
+        for key, item_schema in schema.items():
+            if key not in value:
+                raise OutputError(f"{path} is missing {key!r}")
+            validate(value[key], item_schema, f"{path}.{key}")
+    elif isinstance(schema, list):
+        if not isinstance(value, list):
+            raise OutputError(f"{path} must be a list, got {type(value).__name__}")
+        for i, item in enumerate(value):
+            validate(item, schema[0], f"{path}[{i}]")
+    elif not isinstance(value, schema):
+        raise OutputError(f"{path} must be {schema.__name__}, got {type(value).__name__}")
+
+
+def parse_fields(text: str, fields: list[str]) -> dict[str, Optional[str]]:
+    """Values of `Field: value` lines of a line based answer, first occurrence of each, in one pass.
+
+    Markdown emphasis, bullets and the case of the field names are tolerated.
+    """
+    pattern = _field_pattern(tuple(fields))
+    names = {field.lower(): field for field in fields}
+    values = dict.fromkeys(fields)
+    for match in pattern.finditer(text):
+        field = names[match.group(1).lower()]
+        if values[field] is None:
+            values[field] = match.group(2).strip().strip('*').strip()
+    return values
+
+
+_FIELD_PATTERNS = {}
+
+def _field_pattern(fields: tuple[str, ...]) -> re.Pattern:
+    pattern = _FIELD_PATTERNS.get(fields)
+    if pattern is None:
+        names = '|'.join(re.escape(field) for field in sorted(fields, key=len, reverse=True))
+        pattern = _FIELD_PATTERNS[fields] = re.compile(
+            rf'^[ \t]*(?:[-*#]+[ \t]*)?\**({names})\**:\**[ \t]*(.*)$', re.MULTILINE | re.IGNORECASE,
+        )
+    return pattern
@@ -0,0 +1,118 @@
+import os
+import threading
+
+import numpy as np
+
+from helpers import remove_non_numbers_regex
+from store import RecordStore
+
+TIMEFRAMES = ('day', 'week', 'month')
+
+
+def _score(value):
+    digits = remove_non_numbers_regex(value) if value else ''
+    return float(digits) if digits else np.nan
+
+
+class Stage1Table:
+    """Column-oriented, indexed view of a stage 1 output.
+
+    Stage 1 records are parsed once; scores are turned into float arrays (NaN
+    when the LLM gave none) and rows are indexed by category and title so the
+    per-category top-k queries of stages 2 and 5 do not rescan the records.
+    """
+    titles: list[str]
+    categories: list[str]
+    summaries: list[str]
+    articles: list[str]
+    token_counts: list[int]
+    scores: dict[str, np.ndarray]
+    category_index: dict[str, np.ndarray]
+    title_index: dict[str, int]
+
+    def __init__(self, records) -> None:
+        self.titles = []
+        self.categories = []
+        self.summaries = []
+        self.articles = []
+        self.token_counts = []
+        raw_scores = {timeframe: [] for timeframe in TIMEFRAMES}
+        category_rows = {}
+        # first row of every title
+        self.title_index = {}
+        for row, record in enumerate(records):
+            title = record['title'] or ''
+            self.titles.append(title)
+            self.categories.append(record['category'])
+            self.summaries.append(record['summary'])
+            self.articles.append(record['article'])
+            # None for records written before token counts were recorded
+            self.token_counts.append(record.get('token_count'))
+            for timeframe in TIMEFRAMES:
+                raw_scores[timeframe].append(_score(record[f'{timeframe}_score']))
+            category_rows.setdefault(record['category'], []).append(row)
+            self.title_index.setdefault(title, row)
+        self.scores = {timeframe: np.array(values, dtype=np.float64) for timeframe, values in raw_scores.items()}
+        self.category_index = {category: np.array(rows, dtype=np.int64) for category, rows in category_rows.items()}
+        self._unique = {}
+
+    @classmethod
+    def load(cls, filename: str) -> 'Stage1Table':
+        return cls(RecordStore(filename, 'stage_1'))
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def unique(self, timeframe: str) -> np.ndarray:
+        """Mask of the first row of each non-empty title that has a score for the timeframe"""
+        if timeframe not in self._unique:
+            scores = self.scores[timeframe]
+            mask = np.zeros(len(self.titles), dtype=bool)
+            seen = set()
+            for row in np.flatnonzero(~np.isnan(scores)):
+                title = self.titles[row]
+                if title and title not in seen:
+                    seen.add(title)
+                    mask[row] = True
+            self._unique[timeframe] = mask
+        return self._unique[timeframe]
+
+    def timeframe_categories(self, timeframe: str) -> list[str]:
+        """Categories that have at least one scored article for the timeframe"""
+        unique = self.unique(timeframe)
+        return [category for category, rows in self.category_index.items() if unique[rows].any()]
+
+    def top_k(self, category: str, timeframe: str, k: int) -> np.ndarray:
+        """Rows of the `k` best scored unique titles of a category, best first.
+
+        Ties keep stage 1 order, like a stable sort of the whole category would.
+        """
+        rows = self.category_index.get(category, np.empty(0, dtype=np.int64))
+        rows = rows[self.unique(timeframe)[rows]]
+        scores = self.scores[timeframe][rows]
+        if len(rows) > k:
+            # partial sort: keep everything above the k-th best score, then fill up with ties in row order
+            kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+            above = np.flatnonzero(scores > kth)
+            ties = np.flatnonzero(scores == kth)[:k - len(above)]
+            selected = np.sort(np.concatenate([above, ties]))
+            rows, scores = rows[selected], scores[selected]
+        return rows[np.argsort(-scores, kind='stable')]
+
+
+class Stage1Tables:
+    """Per-process cache of loaded stage 1 tables, reloaded when the file changes"""
+
+    def __init__(self) -> None:
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def get(self, filename: str) -> Stage1Table:
+        stat = os.stat(filename)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.tables.get(filename)
+            if cached is None or cached[0] != version:
+                cached = (version, Stage1Table.load(filename))
+                self.tables[filename] = cached
+            return cached[1]
@@ -0,0 +1,61 @@
+import pytest
+import tiktoken
+
+from compress import clean, compress_article
+from registry import registry
+
+# one token per byte, tiktoken cannot download the real encodings in the tests
+BYTES = tiktoken.Encoding(
+    name='bytes', pat_str=r"""\s?\w+|\s?[^\s\w]+|\s+""", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={},
+)
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    monkeypatch.setitem(registry.entries, ('encoding', 'gpt-3.5-turbo'), BYTES)
+
+
+def test_clean_drops_boilerplate_menus_and_repeated_sentences():
+    text = "\n".join([
+        "Home", "World", "Business", "Sports",
+        "Fed raises interest rates again.",
+        "The central bank raised rates by a quarter point. Markets were calm.",
+        "We use cookies to improve your experience.",
+        "The central bank raised rates by a quarter point.",
+        "No.", "No.",
+        "Sign up for our daily newsletter",
+    ])
+    assert clean(text) == "\n".join([
+        "Fed raises interest rates again.",
+        "The central bank raised rates by a quarter point. Markets were calm.",
+        "No.",
+        "No.",
+    ])
+
+
+def test_tokens_decode_to_the_text_and_the_original_is_counted():
+    text = "Home\nWorld\nSports\nFed raises rates.  Markets were calm.\nAll rights reserved."
+    compressed = compress_article(text)
+    assert compressed.text == "Fed raises rates. Markets were calm."
+    assert BYTES.decode(compressed.tokens) == compressed.text
+    assert compressed.original_tokens == len(text.encode())
+    assert compressed.saved_tokens == len(text.encode()) - len(compressed.text)
+    # a clean article is not encoded twice
+    assert compress_article("Fed raises rates.").saved_tokens == 0
+
+
+def test_budget_cuts_at_the_last_sentence_end():
+    text = " ".join(f"Sentence number {i} is here." for i in range(100))
+    compressed = compress_article(text, token_budget=300)
+    assert len(compressed.tokens) <= 300
+    assert compressed.text.endswith("is here.")
+    assert len(compressed.text) > 300 * 0.8
+    assert BYTES.decode(compressed.tokens) == compressed.text
+    assert compressed.original_tokens == len(text)
+
+
+def test_budget_cuts_inside_a_sentence_that_would_lose_too_much():
+    text = "Short one. " + "word " * 200
+    compressed = compress_article(text, token_budget=100)
+    assert len(compressed.tokens) == 100
+    assert compressed.text == text[:100]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from dedup import NearDuplicateIndex
+
+STORY = (
+    "The central bank raised its benchmark interest rate by a quarter point on Wednesday, "
+    "citing persistent inflation in services and a labour market that remains tight despite "
+    "months of slowing growth, and signalled that further increases are possible this year."
+)
+
+
+def test_signatures_are_the_same_for_every_index_with_the_same_seed():
+    first, second = NearDuplicateIndex(), NearDuplicateIndex()
+    assert np.array_equal(first.signature(STORY), second.signature(STORY))
+    # case and punctuation are not part of the shingles
+    assert np.array_equal(first.signature(STORY), first.signature(STORY.upper().replace(',', '')))
+    assert not np.array_equal(first.signature(STORY), NearDuplicateIndex(seed=2).signature(STORY))
+
+
+def test_a_near_duplicate_is_found_through_the_first_text_of_its_cluster():
+    index = NearDuplicateIndex()
+    assert index.find_or_add('a', index.signature(STORY)) is None
+    republished = STORY + " Markets barely moved."
+    assert index.find_or_add('b', index.signature(republished)) == 'a'
+    assert index.find_or_add('c', index.signature(republished + " Analysts agreed.")) == 'a'
+    # duplicates are not indexed
+    assert len(index) == 1
+
+
+def test_texts_are_only_duplicates_within_their_scope():
+    index = NearDuplicateIndex()
+    signature = index.signature(STORY)
+    assert index.find_or_add(('a', 'Politics'), signature, scope='Politics') is None
+    assert index.find_or_add(('a', 'Business and Finance'), signature, scope='Business and Finance') is None
+    assert index.find_or_add(('b', 'Politics'), signature, scope='Politics') == ('a', 'Politics')
+    assert len(index) == 2
+
+
+def test_distinct_texts_are_indexed_separately():
+    index = NearDuplicateIndex()
+    texts = [
+        STORY,
+        "The home team won the championship final after extra time in front of a sold out stadium.",
+        "A new battery design doubles the range of electric cars according to a study published today.",
+    ]
+    assert [index.find_or_add(i, index.signature(text)) for i, text in enumerate(texts)] == [None, None, None]
+    assert len(index) == 3
+
+
+def test_short_texts_are_one_shingle():
+    index = NearDuplicateIndex()
+    assert index.find_or_add('a', index.signature("Breaking news")) is None
+    assert index.find_or_add('b', index.signature("breaking news!")) == 'a'
+    assert index.find_or_add('c', index.signature("")) is None
+
+
+def test_num_perm_must_be_split_evenly_into_bands():
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(num_perm=100, bands=32)
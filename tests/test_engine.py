@@ -0,0 +1,94 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+import pytest
+
+from engine import LLMEngine
+from retry import Retry
+
+
+def test_blocking_calls_share_the_key_slots():
+    engine = LLMEngine(['sk-a'], per_key=2)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def call(apikey):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return apikey
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: engine.call('sk-a', call), range(8)))
+    assert results == ['sk-a'] * 8
+    assert in_flight[1] == 2
+
+
+def test_errors_of_blocking_calls_are_raised_to_the_caller():
+    engine = LLMEngine(['sk-a'])
+
+    def call(apikey):
+        raise TimeoutError(apikey)
+
+    with pytest.raises(TimeoutError):
+        engine.call('sk-a', call)
+
+
+def test_items_of_a_retired_key_are_requeued_to_the_other_keys():
+    apikeys = ['sk-bad', 'sk-good']
+    engine = LLMEngine(apikeys, per_key=2)
+    handled = []
+
+    async def handler(apikey, item):
+        if apikey == 'sk-bad':
+            return [apikey, 'APIKey_Error', item]
+        handled.append(item)
+        return [item, 'Success']
+
+    def on_result(result):
+        if result[1] == 'APIKey_Error':
+            if result[0] in apikeys:
+                apikeys.remove(result[0])
+            # the failed item goes back to the queue
+            return (result[2],)
+        return None
+
+    assert engine.run([(i,) for i in range(20)], handler, on_result)
+    assert sorted(handled) == list(range(20))
+    assert apikeys == ['sk-good']
+
+
+def test_retries_wait_for_their_delay_without_a_key_slot():
+    engine = LLMEngine(['sk-a'], per_key=1)
+    attempts = {}
+
+    async def handler(apikey, item):
+        attempts[item] = attempts.get(item, 0) + 1
+        return [item, 'Success' if attempts[item] > 1 else 'Error']
+
+    def on_result(result):
+        return Retry((result[0],), 0.05) if result[1] == 'Error' else None
+
+    start = monotonic()
+    assert engine.run([(i,) for i in range(5)], handler, on_result)
+    assert attempts == {i: 2 for i in range(5)}
+    # the delays overlap, they do not hold the single slot
+    assert monotonic() - start < 0.2
+
+
+def test_run_ends_when_every_key_was_retired():
+    apikeys = ['sk-a']
+    engine = LLMEngine(apikeys, per_key=1)
+
+    async def handler(apikey, item):
+        return [apikey, 'APIKey_Error', item]
+
+    def on_result(result):
+        apikeys.clear()
+        return (result[2],)
+
+    assert engine.run([(i,) for i in range(3)], handler, on_result) is False
@@ -0,0 +1,42 @@
+from grouping import TopicGrouper
+
+PRIMARIES = ["Fed raises interest rates", "Hurricane hits Florida coast"]
+
+
+def test_secondaries_go_to_the_most_similar_primary():
+    topics, ambiguous, unmatched = TopicGrouper().group(PRIMARIES, [
+        "Hurricane makes landfall on Florida coast",
+        "Fed raises interest rates by a quarter point",
+        "Champions league final ends in penalties",
+        "fed raises interest rates!",
+    ])
+    assert [topic["Secondary"] for topic in topics] == [
+        ["Fed raises interest rates", "Fed raises interest rates by a quarter point"],
+        ["Hurricane hits Florida coast", "Hurricane makes landfall on Florida coast"],
+    ]
+    assert ambiguous == []
+    # below the threshold; the copy of a primary is dropped
+    assert unmatched == ["Champions league final ends in penalties"]
+
+
+def test_secondaries_over_the_limit_are_unmatched_in_their_order():
+    secondaries = [f"Fed raises interest rates {word}" for word in ("again", "sharply", "today", "quietly")]
+    topics, _, unmatched = TopicGrouper(max_secondaries=2).group(PRIMARIES, secondaries)
+    assert len(topics[0]["Secondary"]) == 3
+    assert unmatched == [title for title in secondaries if title not in topics[0]["Secondary"]]
+
+
+def test_without_primaries_every_distinct_secondary_is_unmatched():
+    topics, ambiguous, unmatched = TopicGrouper().group([], ["A storm", "a storm.", "Rates"])
+    assert (topics, ambiguous, unmatched) == ([], [], ["A storm", "Rates"])
+
+
+def test_merge_only_adds_the_offered_titles_to_known_primaries():
+    topics, _, unmatched = TopicGrouper().group(PRIMARIES, ["Central bank lifts borrowing costs"])
+    added = TopicGrouper().merge(topics, [
+        {"Primary": "fed raises interest rates", "Secondary": ["Central bank lifts borrowing costs", "Made up title"]},
+        {"Primary": "Unknown primary", "Secondary": ["Central bank lifts borrowing costs"]},
+        "not a group",
+    ], unmatched)
+    assert added == 1
+    assert topics[0]["Secondary"] == ["Fed raises interest rates", "Central bank lifts borrowing costs"]
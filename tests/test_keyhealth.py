@@ -0,0 +1,97 @@
+import pytest
+from openai.error import RateLimitError
+
+import keyhealth
+from keyhealth import DEAD, HEALTHY, QUARANTINED, THROTTLED, KeyRegistry
+from ratelimit import RateLimiter
+
+KEYS = ['sk-a', 'sk-b', 'sk-c']
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(keyhealth, 'time', clock)
+    return clock
+
+
+def test_probation_doubles_and_ends(tmp_path, clock):
+    registry = KeyRegistry(str(tmp_path / 'keys.db'), KEYS, probation=10, max_probation=25)
+    assert registry.quarantine('sk-a', 'insufficient_quota')
+    # another worker retiring the same key does not count it again
+    assert not registry.quarantine('sk-a')
+    assert registry.states()['sk-a'] == {'state': QUARANTINED, 'until': 1010, 'failures': 1, 'reason': 'insufficient_quota'}
+    assert registry.usable() == ['sk-b', 'sk-c']
+    # a successful call does not end the probation early
+    assert not registry.release('sk-a')
+    clock.now = 1010
+    assert registry.usable() == KEYS
+    assert registry.quarantine('sk-a')
+    assert registry.states()['sk-a']['until'] == 1030
+    clock.now = 1030
+    assert registry.quarantine('sk-a')
+    assert registry.states()['sk-a']['until'] == 1055
+    clock.now = 1055
+    assert registry.release('sk-a')
+    # the record of a quarantined key is kept
+    assert registry.states()['sk-a'] == {'state': HEALTHY, 'until': 0, 'failures': 3, 'reason': None}
+
+
+def test_throttled_keys_stay_with_their_workers_until_a_call_succeeds(tmp_path, clock):
+    registry = KeyRegistry(str(tmp_path / 'keys.db'), KEYS)
+    apikeys = list(KEYS)
+    assert registry.throttle('sk-b', 30)
+    assert registry.usable() == ['sk-a', 'sk-c']
+    assert registry.sync(apikeys) == KEYS
+    # a key that is not in use yet is not handed out while throttled
+    assert registry.sync(['sk-a']) == ['sk-a', 'sk-c']
+    registry.answered('sk-b')
+    assert registry.states()['sk-b']['state'] == HEALTHY
+    assert registry.throttled == set()
+
+
+def test_states_are_shared_through_the_database(tmp_path, clock):
+    first = KeyRegistry(str(tmp_path / 'keys.db'), KEYS)
+    assert first.kill('sk-c', 'invalid_api_key')
+    second = KeyRegistry(str(tmp_path / 'keys.db'), KEYS)
+    apikeys = list(KEYS)
+    assert second.sync(apikeys) == ['sk-a', 'sk-b']
+    assert apikeys == ['sk-a', 'sk-b']
+    assert not second.kill('sk-c')
+    # only a probe that finds the key working brings it back
+    clock.now += 10 ** 9
+    assert second.usable() == ['sk-a', 'sk-b']
+
+
+def test_preflight_records_what_the_probes_found(tmp_path, clock):
+    registry = KeyRegistry(str(tmp_path / 'keys.db'), KEYS)
+    registry.kill('sk-a')
+    found = {
+        'sk-a': (HEALTHY, 0, None),
+        'sk-b': (THROTTLED, 20, 'rate_limit_exceeded'),
+        'sk-c': None,
+    }
+    assert registry.preflight(found.get) == {'sk-a': HEALTHY, 'sk-b': THROTTLED, 'sk-c': HEALTHY}
+    assert registry.states()['sk-b']['until'] == 1020
+    found['sk-c'] = (DEAD, 0, 'invalid_api_key')
+    assert registry.preflight(found.get)['sk-c'] == DEAD
+
+
+def test_the_rate_limiter_throttles_keys_on_429(tmp_path, clock):
+    registry = KeyRegistry(str(tmp_path / 'keys.db'), KEYS)
+    limiter = RateLimiter(KEYS, key_health=registry)
+    headers = {'x-ratelimit-reset-requests': '1s', 'x-ratelimit-reset-tokens': '40s'}
+    limiter.failed('sk-a', RateLimitError("Rate limited", headers=headers, code='rate_limit_exceeded'))
+    limiter.failed('sk-b', RateLimitError("Quota", code='insufficient_quota'))
+    assert registry.states()['sk-a'] == {'state': THROTTLED, 'until': 1040, 'failures': 0, 'reason': 'rate limited'}
+    assert registry.states()['sk-b']['state'] == HEALTHY
+    limiter.answered('sk-a')
+    assert registry.states()['sk-a']['state'] == HEALTHY
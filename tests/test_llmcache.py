@@ -0,0 +1,72 @@
+from itertools import count
+
+import langchain
+import pytest
+from langchain.chat_models import ChatOpenAI
+from langchain.load.dump import dumpd, dumps
+from langchain.schema import AIMessage, ChatGeneration, Generation, HumanMessage
+
+import llmcache
+from llmcache import LLMCache
+from ratelimit import RateLimitCallback, RateLimiter, _cached
+
+LLM = "gpt-3.5-turbo---[('stop', None)]"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # entries written in the same instant would have no order
+    ticks = count(1)
+    monkeypatch.setattr(llmcache, 'time', lambda: next(ticks))
+
+
+def test_lookups_hit_what_was_written_for_the_same_llm(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.db'), max_bytes=1 << 20)
+    cache.update("prompt", LLM, [Generation(text="answer"), Generation(text="other")])
+    assert [generation.text for generation in cache.lookup("prompt", LLM)] == ["answer", "other"]
+    assert cache.lookup("prompt", LLM.replace('3.5', '4')) is None
+    assert cache.contains("prompt", LLM) and not cache.contains("other prompt", LLM)
+    # contains() does not count
+    assert (cache.hits, cache.misses) == (1, 1)
+    # the cache outlives the process
+    assert LLMCache(str(tmp_path / 'cache.db'), max_bytes=1 << 20).lookup("prompt", LLM)[0].text == "answer"
+
+
+def test_bypass_misses_but_writes(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.db'), max_bytes=1 << 20, bypass=True)
+    cache.update("prompt", LLM, [Generation(text="answer")])
+    assert cache.lookup("prompt", LLM) is None and not cache.contains("prompt", LLM)
+    assert LLMCache(str(tmp_path / 'cache.db'), max_bytes=1 << 20).contains("prompt", LLM)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    sizer = LLMCache(str(tmp_path / 'size.db'), max_bytes=1 << 20)
+    sizer.update("a", LLM, [Generation(text="a" * 200)])
+    # room for three and a half entries, eviction goes down to 90% of it
+    cache = LLMCache(str(tmp_path / 'cache.db'), max_bytes=int(sizer.size * 3.5))
+    for prompt in ("a", "b", "c"):
+        cache.update(prompt, LLM, [Generation(text=prompt * 200)])
+    cache.lookup("a", LLM)
+    cache.update("d", LLM, [Generation(text="d" * 200)])
+    # "b" was used least recently, "a" was looked up since it was written
+    assert [cache.contains(prompt, LLM) for prompt in "abcd"] == [True, False, True, True]
+    assert cache.size <= cache.max_bytes * 0.9
+
+
+def test_the_rate_limiter_sees_the_cache_key_langchain_looks_up(tmp_path, monkeypatch):
+    cache = LLMCache(str(tmp_path / 'cache.db'), max_bytes=1 << 20)
+    monkeypatch.setattr(langchain, 'llm_cache', cache)
+    llm = ChatOpenAI(openai_api_key='sk-test', model='gpt-3.5-turbo', max_tokens=256, max_retries=1)
+    messages = [HumanMessage(content="Summarize this")]
+    cache.update(dumps(messages), llm._get_llm_string(stop=None), [ChatGeneration(message=AIMessage(content="cached"))])
+
+    limiter = RateLimiter(['sk-test'], rpm=100, tpm=1000)
+    assert llm(messages, callbacks=[RateLimitCallback(limiter, 'sk-test')]).content == "cached"
+    assert cache.hits == 1
+    # nothing was sent, so nothing was charged
+    assert limiter.in_flight['sk-test'] == [0, 0]
+    assert limiter.buckets['sk-test'][1].level == pytest.approx(1000)
+
+    assert _cached(dumpd(llm), [messages], {'stop': None})
+    assert not _cached(dumpd(llm), [[HumanMessage(content="Something else")]], {'stop': None})
+    assert not _cached(dumpd(llm), [messages], {'stop': ['###']})
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+from pymongo import ReplaceOne
+
+from bench.memory_mongo import MemoryDatabase
+from persist import CollectionSink
+
+
+def operation(record: dict) -> ReplaceOne:
+    return ReplaceOne({'_id': record['link']}, record, upsert=True)
+
+
+def records(count: int) -> list[dict]:
+    return [{'link': f"https://example.com/{i}", 'title': f"Title {i}"} for i in range(count)]
+
+
+def test_records_are_published_in_one_step():
+    db = MemoryDatabase('test')
+    db['stage_1']['2023-10-01'].insert_many([{'_id': 'old'}])
+    sink = CollectionSink(db, 'stage_1', '2023-10-01', operation, batch_size=3)
+    for record in records(7) + records(2):
+        sink.write(record)
+    # the live collection keeps the previous results until the stage publishes
+    assert db['stage_1']['2023-10-01'].estimated_document_count() == 1
+    assert sink.publish() == 7
+    assert sorted(db['stage_1']['2023-10-01'].documents) == sorted(record['link'] for record in records(7))
+    assert sink.written == 9
+    assert not sink.thread.is_alive()
+
+
+def test_bulk_writes_run_on_the_writer_thread():
+    db = MemoryDatabase('test')
+    sink = CollectionSink(db, 'stage_3', '2023-10-01', operation, batch_size=2)
+    threads = set()
+    bulk_write = sink.staging.bulk_write
+    release = threading.Event()
+
+    def slow_bulk_write(operations, ordered=True):
+        threads.add(threading.current_thread().name)
+        release.wait(5)
+        return bulk_write(operations, ordered)
+
+    sink.staging.bulk_write = slow_bulk_write
+    # the caller does not wait for the writes while the queue has room
+    for record in records(6):
+        sink.write(record)
+    assert sink.written == 0
+    release.set()
+    assert sink.publish() == 6
+    assert threads == {'CollectionSink'}
+
+
+def test_write_errors_are_raised_when_publishing():
+    db = MemoryDatabase('test')
+    sink = CollectionSink(db, 'stage_4', '2023-10-01', operation, batch_size=1)
+
+    def failing_bulk_write(operations, ordered=True):
+        raise ConnectionError("Mongo is gone")
+
+    sink.staging.bulk_write = failing_bulk_write
+    sink.write(records(1)[0])
+    with pytest.raises(ConnectionError):
+        sink.publish()
+    # nothing was published over the previous results
+    assert db['stage_4']['2023-10-01'].estimated_document_count() == 0
+    assert not sink.thread.is_alive()
@@ -0,0 +1,78 @@
+import pytest
+
+from ratelimit import Bucket, RateLimiter, parse_reset, reset_after
+
+KEY = 'sk-test'
+
+
+def headers(remaining_requests: int, remaining_tokens: int) -> dict:
+    return {
+        'x-ratelimit-limit-requests': '100',
+        'x-ratelimit-limit-tokens': '1000',
+        'x-ratelimit-remaining-requests': str(remaining_requests),
+        'x-ratelimit-remaining-tokens': str(remaining_tokens),
+        'x-ratelimit-reset-requests': '600ms',
+        'x-ratelimit-reset-tokens': '6s',
+    }
+
+
+def levels(limiter: RateLimiter) -> tuple[float, float]:
+    request_bucket, token_bucket = limiter.buckets[KEY]
+    return request_bucket.level, token_bucket.level
+
+
+def test_parse_reset():
+    assert parse_reset('6m0s') == 360
+    assert parse_reset('1.5s') == 1.5
+    assert parse_reset('20ms') == pytest.approx(0.02)
+    assert parse_reset(None) == 0
+    assert reset_after({'x-ratelimit-reset-requests': '1s', 'x-ratelimit-reset-tokens': '30s'}) == 30
+    assert reset_after({}) == 20
+
+
+def test_bucket_goes_into_debt_and_waits_for_the_refill():
+    bucket = Bucket(60, period=60)
+    now = bucket.updated
+    assert bucket.charge(50, now) == 0
+    assert bucket.charge(20, now) == pytest.approx(10)
+    # a charge bigger than the bucket is cut to its capacity
+    assert bucket.charge(1000, now + 10) == pytest.approx(60)
+
+
+def test_a_released_call_is_not_counted_twice():
+    limiter = RateLimiter([KEY], rpm=100, tpm=1000)
+    assert limiter.reserve(KEY, 300) == 0
+    assert levels(limiter) == pytest.approx((99, 700), abs=0.1)
+    # the response hook runs before the callback releases the call, the server has counted it
+    limiter.update_from_response({'Authorization': f'Bearer {KEY}'}, headers(99, 700))
+    limiter.release(KEY, 300)
+    assert levels(limiter) == pytest.approx((99, 700), abs=0.1)
+    assert limiter.responses == {}
+
+
+def test_calls_still_in_flight_are_taken_from_the_remaining_values():
+    limiter = RateLimiter([KEY], rpm=100, tpm=1000)
+    limiter.reserve(KEY, 300)
+    limiter.reserve(KEY, 200)
+    # both were answered before either was released, as in a batch of map calls
+    limiter.report(KEY, headers(99, 700))
+    limiter.report(KEY, headers(98, 500))
+    limiter.release(KEY, 300)
+    assert levels(limiter) == pytest.approx((97, 300), abs=0.1)
+    limiter.release(KEY, 200)
+    assert levels(limiter) == pytest.approx((98, 500), abs=0.1)
+    assert limiter.in_flight[KEY] == [0, 0]
+    # the headers are not used again by later calls
+    limiter.reserve(KEY, 100)
+    limiter.release(KEY, 100)
+    assert levels(limiter) == pytest.approx((97, 400), abs=0.1)
+
+
+def test_headers_of_failed_calls_are_used_after_the_release():
+    limiter = RateLimiter([KEY], rpm=100, tpm=1000)
+    limiter.reserve(KEY, 300)
+    limiter.release(KEY, 300)
+    limiter.update(KEY, headers(50, 100))
+    assert levels(limiter) == pytest.approx((50, 100), abs=0.1)
+    # the bucket is full again when the window resets, 6 seconds for 900 tokens
+    assert limiter.reserve(KEY, 200) == pytest.approx(100 / 150, abs=0.05)
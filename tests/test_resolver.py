@@ -0,0 +1,33 @@
+from resolver import TitleResolver, normalize_title
+
+
+def test_normalize_title_ignores_case_punctuation_and_spacing():
+    assert normalize_title("  Trump's  Trial:\tDay ONE! ") == "trumps trial day one"
+
+
+def test_exact_titles_resolve_to_their_first_row():
+    resolver = TitleResolver(["Fed raises rates", "", "Storm hits Florida", "fed raises rates!"])
+    assert resolver.resolve("FED raises rates.") == 0
+    assert resolver.resolve("Storm hits Florida") == 2
+    assert resolver.exact == 2
+
+
+def test_close_titles_resolve_fuzzily():
+    resolver = TitleResolver(["Fed raises interest rates again", "Storm hits Florida coast"])
+    assert resolver.resolve("Fed raises interest rate again") == 0
+    assert resolver.resolve("Storm hit Florida coast") == 1
+    assert resolver.fuzzy == 2
+
+
+def test_unrelated_and_empty_titles_are_not_resolved():
+    resolver = TitleResolver(["Fed raises interest rates again"])
+    assert resolver.resolve("Local bakery wins award") is None
+    assert resolver.resolve("") is None
+    assert resolver.resolve(None) is None
+    assert resolver.stats() == "0 exact, 0 fuzzy, 3 unresolved titles"
+
+
+def test_the_threshold_bounds_fuzzy_matches():
+    titles = ["Fed raises interest rates again"]
+    assert TitleResolver(titles, threshold=0.6).resolve("Fed raises rates again") == 0
+    assert TitleResolver(titles, threshold=0.7).resolve("Fed raises rates again") is None
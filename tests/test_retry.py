@@ -0,0 +1,118 @@
+import random
+
+import pytest
+from openai.error import (APIConnectionError, AuthenticationError,
+                          InvalidRequestError, RateLimitError)
+
+from archive import ReplayMiss
+from metrics import metrics
+from retry import DeadLetters, Retrier, RetryPolicy, classify, handler_error
+from structured import OutputError
+
+
+def rate_limit_error(error_type: str, code: str) -> RateLimitError:
+    return RateLimitError(
+        "Rate limited", json_body={'error': {'message': "Rate limited", 'type': error_type, 'code': code}}, code=code,
+    )
+
+
+@pytest.mark.parametrize('error, error_class', [
+    (rate_limit_error('insufficient_quota', 'insufficient_quota'), 'quota'),
+    (rate_limit_error('requests', 'rate_limit_exceeded'), 'rate_limit'),
+    (RateLimitError("Rate limited"), 'rate_limit'),
+    (AuthenticationError("Incorrect API key"), 'auth'),
+    (InvalidRequestError("Too long", None, code='context_length_exceeded'), 'context_length'),
+    (InvalidRequestError("This model's maximum context length is 4097 tokens", None), 'context_length'),
+    (InvalidRequestError("Bad request", None), 'invalid_request'),
+    (OutputError("not JSON"), 'parse'),
+    (ReplayMiss("no recording"), 'replay_miss'),
+    (APIConnectionError("Connection reset"), 'transient'),
+    (TimeoutError(), 'transient'),
+    (KeyError('x'), 'unexpected'),
+    ('APIKey_Error', 'auth'),
+    ('Error', 'transient'),
+    ('Something else', 'unexpected'),
+])
+def test_classify(error, error_class):
+    assert classify(error) == error_class
+
+
+def test_handler_error():
+    error = TimeoutError()
+    assert handler_error([error, 'Error', 'item']) is error
+    assert handler_error(['sk-key', 'APIKey_Error', 'item']) == 'APIKey_Error'
+    assert handler_error([None, 'UnexpectedError', 'item']) == 'UnexpectedError'
+
+
+def test_delay_is_full_jitter_up_to_the_cap():
+    policy = RetryPolicy(attempts=5, base=2, cap=10)
+    rng = random.Random(0)
+    for attempt in range(6):
+        delays = [policy.delay(attempt, rng) for _ in range(200)]
+        assert 0 <= min(delays) and max(delays) <= min(10, 2 * 2 ** attempt)
+    assert RetryPolicy(attempts=5).delay(3, rng) == 0.0
+
+
+def test_an_item_gets_the_attempts_of_its_policy():
+    retries = metrics.total('retries_total')
+    retrier = Retrier('stage', policies={'transient': RetryPolicy(attempts=2)}, budget_min=100)
+    assert retrier.decide('a', 'Error') == 0.0
+    assert retrier.decide('a', 'Error') == 0.0
+    assert retrier.decide('a', 'Error') is None
+    assert retrier.given_up == 1
+    assert metrics.total('retries_total') == retries + 2
+    # another item starts over
+    assert retrier.decide('b', 'Error') == 0.0
+
+
+def test_budgeted_retries_are_limited_for_the_run():
+    retrier = Retrier('stage', policies={
+        'transient': RetryPolicy(attempts=5),
+        'auth': RetryPolicy(attempts=5, budgeted=False),
+    }, budget_ratio=0.5, budget_min=0)
+    assert retrier.decide('a', 'Error') == 0.0
+    # half of 2 attempts is a single retry
+    assert retrier.decide('b', 'Error') is None
+    # unbudgeted classes are not limited
+    assert retrier.decide('c', 'APIKey_Error') == 0.0
+    retrier.attempted(10)
+    assert retrier.decide('d', 'Error') == 0.0
+
+
+def test_given_up_items_go_to_the_dead_letters(tmp_path):
+    dead_letters = DeadLetters(str(tmp_path / 'dead_letters.db'))
+    retrier = Retrier('stage 1', dead_letters, key=lambda item: item[0], policies={'parse': RetryPolicy(attempts=1)})
+    item = ('https://example.com/a', 'Politics', object())
+    assert retrier.decide(item, OutputError("not JSON")) == 0.0
+    assert retrier.decide(item, OutputError("not JSON")) is None
+    [entry] = dead_letters.entries('stage 1')
+    assert entry['key'] == 'https://example.com/a'
+    assert entry['item'] == ['https://example.com/a', 'Politics', None]
+    assert (entry['error_class'], entry['error'], entry['attempts']) == ('parse', 'not JSON', 2)
+    assert dead_letters.entries('stage 3') == []
+    # the store outlives the run
+    assert len(DeadLetters(str(tmp_path / 'dead_letters.db'))) == 1
+
+
+def test_call_retries_until_it_succeeds_or_gives_up():
+    retrier = Retrier('stage', policies={'transient': RetryPolicy(attempts=2)})
+    results = iter([TimeoutError(), TimeoutError(), 'done'])
+
+    def attempt():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    errors = []
+    retries = metrics.total('retries_total')
+    assert retrier.call('a', attempt, errors.append) == 'done'
+    assert len(errors) == 2
+    # synchronous calls report their retries like the engine does
+    assert metrics.total('retries_total') == retries + 2
+
+    def fail():
+        raise TimeoutError()
+
+    assert retrier.call('b', fail) is None
+    assert retrier.given_up == 1
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from store import RecordStore, SchemaError, is_complete
+
+
+def stage_5_record(no: int) -> dict:
+    return {'no': no, 'title': f"Title {no}", 'explanation': f"Explanation {no}"}
+
+
+def test_records_are_read_back_in_order(tmp_path):
+    store = RecordStore(str(tmp_path / 'stage_5.jsonl'), 'stage_5')
+    with store.writer(truncate=True) as writer:
+        writer.writerows(stage_5_record(no) for no in range(3))
+    assert list(store) == [stage_5_record(no) for no in range(3)]
+    assert len(store) == 3
+    assert store[1] == stage_5_record(1)
+
+
+def test_invalid_records_are_rejected(tmp_path):
+    store = RecordStore(str(tmp_path / 'stage_5.jsonl'), 'stage_5')
+    with store.writer(truncate=True) as writer:
+        with pytest.raises(SchemaError):
+            writer.write({'no': 1, 'title': 'Title'})
+        with pytest.raises(SchemaError):
+            writer.write({'no': '1', 'title': 'Title', 'explanation': 'Explanation'})
+        # None stands for a field the LLM did not return
+        writer.write({'no': 1, 'title': None, 'explanation': 'Explanation'})
+    assert len(store) == 1
+
+
+def test_resume_drops_a_record_cut_short_by_a_crash(tmp_path):
+    path = str(tmp_path / 'stage_5.jsonl')
+    store = RecordStore(path, 'stage_5')
+    with store.writer(truncate=True) as writer:
+        writer.writerows(stage_5_record(no) for no in range(2))
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(stage_5_record(2))[:10])
+
+    with store.writer() as writer:
+        writer.write(stage_5_record(3))
+    assert [record['no'] for record in store] == [0, 1, 3]
+    assert store[2] == stage_5_record(3)
+    assert store.completed(lambda record: record['no']) == {0, 1, 3}
+
+
+def test_truncate_starts_over(tmp_path):
+    store = RecordStore(str(tmp_path / 'stage_5.jsonl'), 'stage_5')
+    with store.writer(truncate=True) as writer:
+        writer.write(stage_5_record(0))
+    with store.writer(truncate=True) as writer:
+        writer.write(stage_5_record(1))
+    assert list(store) == [stage_5_record(1)]
+
+
+def test_completion_marker_is_removed_when_the_store_is_written_again(tmp_path):
+    path = str(tmp_path / 'stage_5.jsonl')
+    store = RecordStore(path, 'stage_5')
+    with store.writer(truncate=True) as writer:
+        writer.write(stage_5_record(0))
+    store.mark_complete()
+    assert is_complete(path)
+    with store.writer():
+        assert not store.is_complete()
+
+
+def test_a_store_of_another_schema_is_refused(tmp_path):
+    path = str(tmp_path / 'stage_5.jsonl')
+    with RecordStore(path, 'stage_5').writer(truncate=True) as writer:
+        writer.write(stage_5_record(0))
+    with pytest.raises(SchemaError):
+        RecordStore(path, 'stage_6').writer()
+    with pytest.raises(SchemaError):
+        list(RecordStore(path, 'stage_6'))
@@ -0,0 +1,71 @@
+import pytest
+
+from structured import OutputError, loads, parse_fields, parse_output
+
+CATEGORIZE = '[{"Primary": "Fed raises rates", "Secondary": ["Rates go up"]}, {"Primary": "Storm", "Secondary": []}]'
+
+
+def test_valid_json_needs_no_repairs():
+    assert loads(CATEGORIZE) == (
+        [{"Primary": "Fed raises rates", "Secondary": ["Rates go up"]}, {"Primary": "Storm", "Secondary": []}], []
+    )
+
+
+def test_fenced_answer_with_prose_and_trailing_commas():
+    text = 'Here you go:\n```json\n{"a": [1, 2,], "b": "x",}\n```\nHope that helps.'
+    value, repairs = loads(text)
+    assert value == {"a": [1, 2], "b": "x"}
+    assert 'fence' in repairs and 'trailing_comma' in repairs
+
+
+def test_leading_and_trailing_text():
+    value, repairs = loads('Sure! {"a": 1} is the answer.')
+    assert value == {"a": 1}
+    assert 'leading_text' in repairs and 'trailing_text' in repairs
+
+
+def test_smart_and_unescaped_inner_quotes():
+    value, repairs = loads('{“title”: “The “big” one”}')
+    assert value == {"title": 'The "big" one'}
+    assert 'smart_quotes' in repairs and 'inner_quote' in repairs
+
+
+def test_python_literal():
+    value, repairs = loads("{'a': True, 'b': None}")
+    assert value == {"a": True, "b": None}
+    assert repairs[-1] == 'python_literal'
+
+
+def test_truncated_object_is_closed():
+    value, repairs = loads('{"a": "complete", "b": "cut o')
+    assert value == {"a": "complete"}
+    assert 'truncated' in repairs
+
+
+def test_truncated_list_keeps_the_complete_items():
+    text = CATEGORIZE[:CATEGORIZE.index('"Secondary": []')]
+    assert parse_output(text, 'categorize') == [{"Primary": "Fed raises rates", "Secondary": ["Rates go up"]}]
+
+
+def test_not_json_raises():
+    assert loads("I cannot help with that.") == (None, [])
+    with pytest.raises(OutputError, match="not JSON"):
+        parse_output("I cannot help with that.", 'categorize')
+
+
+def test_wrong_shape_raises():
+    with pytest.raises(OutputError, match=r"categorize\[0\] is missing 'Secondary'"):
+        parse_output('[{"Primary": "Fed raises rates"}]', 'categorize')
+    with pytest.raises(OutputError, match="must be a list"):
+        parse_output('{"Primary": "Fed raises rates", "Secondary": []}', 'categorize')
+    # extra keys are allowed
+    assert parse_output('[{"title": "A", "explanation": "B", "score": 1}]', 'impactful-news') == [
+        {"title": "A", "explanation": "B", "score": 1}
+    ]
+
+
+def test_parse_fields_takes_the_first_of_each_field():
+    text = "**Title:** Fed raises rates\n- summary: *Rates go up*\nTitle: ignored\nOther: x"
+    assert parse_fields(text, ['Title', 'Summary', 'Score']) == {
+        'Title': 'Fed raises rates', 'Summary': 'Rates go up', 'Score': None,
+    }
@@ -0,0 +1,73 @@
+import numpy as np
+
+from store import RecordStore
+from table import Stage1Table, Stage1Tables
+
+
+def record(title, category, day=None, week=None, month=None) -> dict:
+    return {
+        'title': title,
+        'category': category,
+        'summary': f"Summary of {title}",
+        'article': f"Article of {title}",
+        'token_count': 100,
+        'day_score': day,
+        'week_score': week,
+        'month_score': month,
+    }
+
+
+def test_top_k_is_best_first_and_keeps_stage_1_order_on_ties():
+    table = Stage1Table([
+        record('A', 'Politics', day='5'),
+        record('B', 'Politics', day='9'),
+        record('C', 'Politics', day='5'),
+        record('D', 'Sports', day='10'),
+        record('E', 'Politics', day='7'),
+        record('F', 'Politics', day='5'),
+    ])
+    assert [table.titles[row] for row in table.top_k('Politics', 'day', 10)] == ['B', 'E', 'A', 'C', 'F']
+    # the partial sort fills up with the earliest ties
+    assert [table.titles[row] for row in table.top_k('Politics', 'day', 3)] == ['B', 'E', 'A']
+    assert [table.titles[row] for row in table.top_k('Politics', 'day', 4)] == ['B', 'E', 'A', 'C']
+
+
+def test_top_k_skips_unscored_and_repeated_titles():
+    table = Stage1Table([
+        record('A', 'Politics', day='Score: 3'),
+        record('A', 'Politics', day='8'),
+        record('B', 'Politics', day=None, week='4'),
+        record('', 'Politics', day='9'),
+        record('C', 'Politics', day='not a number'),
+    ])
+    assert np.isnan(table.scores['day'][2])
+    assert [table.titles[row] for row in table.top_k('Politics', 'day', 10)] == ['A']
+    assert table.top_k('Politics', 'day', 10)[0] == 0
+    assert [table.titles[row] for row in table.top_k('Politics', 'week', 10)] == ['B']
+    assert table.top_k('Sports', 'day', 10).size == 0
+
+
+def test_timeframe_categories_have_a_scored_article():
+    table = Stage1Table([
+        record('A', 'Politics', day='1'),
+        record('B', 'Sports', week='2'),
+    ])
+    assert table.timeframe_categories('day') == ['Politics']
+    assert table.timeframe_categories('week') == ['Sports']
+    assert table.timeframe_categories('month') == []
+
+
+def test_tables_are_reloaded_when_the_file_changes(tmp_path):
+    path = str(tmp_path / 'stage_1.jsonl')
+    fields = RecordStore(path, 'stage_1').schema
+
+    def write(records):
+        with RecordStore(path, 'stage_1').writer(truncate=True) as writer:
+            writer.writerows({**dict.fromkeys(fields), **item} for item in records)
+
+    tables = Stage1Tables()
+    write([record('A', 'Politics', day='1')])
+    first = tables.get(path)
+    assert tables.get(path) is first
+    write([record('A', 'Politics', day='1'), record('B', 'Politics', day='2')])
+    assert len(tables.get(path)) == 2